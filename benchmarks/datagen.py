@@ -0,0 +1,220 @@
+"""
+Synthetic data generator for the DAO benchmarks.
+
+Creates the schema in an empty database and fills it with users, orgs, threads across every
+``FynixProducts`` value, branched messages and summaries. Activity is skewed the way production
+is: a few users own most of the threads (Zipf) and thread lengths are heavy tailed (Pareto).
+The same ``--seed`` always produces the same data.
+
+    python benchmarks/datagen.py --database-url postgresql+asyncpg://localhost/chat_threads_bench --scale 10k
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from chat_threads.threads.models import Thread, ThreadMessage, ThreadMessageSummary, to_search_vector
+from chat_threads.utils.constants import FynixProducts, Role, THREAD_PREVIEW_LENGTH
+from chat_threads.utils.orm_utils import Base
+
+# Number of thread_message rows per scale
+SCALES = {
+    "10k": 10_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+MESSAGES_PER_THREAD = 40
+THREADS_PER_USER = 20
+USERS_PER_ORG = 25
+PERSONAL_THREAD_RATIO = 0.3
+REGENERATION_RATIO = 0.1
+SUMMARY_EVERY = 20
+INSERT_BATCH_SIZE = 5000
+
+WORDS = (
+    "thread message agent deploy build function class error retry cache index query branch summary "
+    "token prompt model review document diagram pipeline latency schema migration request response "
+    "python postgres async session cursor page search stream window budget context user product"
+).split()
+# Kept out of the generated vocabulary so benchmarks can search for a term with a known, small hit count
+RARE_TERM = "zephyrine"
+
+
+def _zipf_weights(count: int, exponent: float = 1.1):
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def _sentence(rng: random.Random, min_words: int, max_words: int) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(min_words, max_words)))
+
+
+def user_email(user_index: int) -> str:
+    return f"user_{user_index}@example.com"
+
+
+def user_org(user_index: int) -> str:
+    return f"org_{user_index // USERS_PER_ORG}"
+
+
+class DataGenerator:
+
+    def __init__(self, message_count: int, seed: int = 42):
+        self.rng = random.Random(seed)
+        self.message_count = message_count
+        self.thread_count = max(1, message_count // MESSAGES_PER_THREAD)
+        self.user_count = max(1, self.thread_count // THREADS_PER_USER)
+        self.user_weights = _zipf_weights(self.user_count)
+        self.products = list(FynixProducts)
+        self.start_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def _thread_length(self) -> int:
+        # Pareto with mean ~MESSAGES_PER_THREAD and a long tail of very long agent threads
+        return max(1, int(self.rng.paretovariate(1.5) * MESSAGES_PER_THREAD / 3))
+
+    def generate(self):
+        """Yield ``(threads, messages, summaries)`` row batches until ``message_count`` messages exist."""
+        message_id = 0
+        thread_id = 0
+        threads, messages, summaries = [], [], []
+
+        while message_id < self.message_count:
+            thread_id += 1
+            user_index = self.rng.choices(range(self.user_count), cum_weights=self.user_weights)[0]
+            created_at = self.start_time + timedelta(minutes=self.rng.randint(0, 60 * 24 * 365))
+            thread_uuid = uuid.uuid4()
+            personal = self.rng.random() < PERSONAL_THREAD_RATIO
+
+            length = min(self._thread_length(), self.message_count - message_id)
+            parent_id = None
+            last_assistant = None
+            last_message = None
+            for position in range(length):
+                message_id += 1
+                role = Role.USER if position % 2 == 0 else Role.ASSISTANT
+                message_parent = parent_id
+                if role == Role.ASSISTANT and last_assistant and self.rng.random() < REGENERATION_RATIO:
+                    # Regeneration: a sibling of the previous answer
+                    message_parent = last_assistant["parent_message_id"]
+                content = _sentence(self.rng, 5, 40 if role == Role.USER else 200)
+                if self.rng.random() < 0.001:
+                    content = f"{content} {RARE_TERM}"
+                message = {
+                    "id": message_id,
+                    "thread_uuid": thread_uuid,
+                    "parent_message_id": message_parent,
+                    "content": content,
+                    "display_text": content,
+                    "role": role,
+                    "is_json": False,
+                    "is_deleted": False,
+                    "question_config": {"mode": "chat"},
+                    "prompt_details": {"model": "default", "temperature": 0.2},
+                    "created_at": created_at + timedelta(seconds=position * 30),
+                    "updated_at": created_at + timedelta(seconds=position * 30),
+                }
+                messages.append(message)
+                if role == Role.ASSISTANT:
+                    last_assistant = message
+                parent_id = message_id
+                last_message = message
+                if position and position % SUMMARY_EVERY == 0:
+                    summaries.append({
+                        "uuid": uuid.uuid4(),
+                        "thread_uuid": thread_uuid,
+                        "thread_message_id": message_id,
+                        "summary": _sentence(self.rng, 20, 60),
+                        "created_at": message["created_at"],
+                        "updated_at": message["created_at"],
+                    })
+
+            threads.append({
+                "id": thread_id,
+                "uuid": thread_uuid,
+                "title": _sentence(self.rng, 2, 6),
+                "user_id": user_index,
+                "user_email": user_email(user_index),
+                "is_deleted": self.rng.random() < 0.05,
+                "product": self.rng.choice(self.products),
+                "meta": {"source": "benchmark"},
+                "org_id": None if personal else user_org(user_index),
+                "created_at": created_at,
+                "updated_at": last_message["created_at"],
+                "last_message_id": last_message["id"],
+                "message_count": length,
+                "last_message_at": last_message["created_at"],
+                "last_message_preview": last_message["display_text"][:THREAD_PREVIEW_LENGTH],
+            })
+
+            if len(messages) >= INSERT_BATCH_SIZE:
+                yield threads, messages, summaries
+                threads, messages, summaries = [], [], []
+
+        if threads:
+            yield threads, messages, summaries
+
+
+async def create_schema(engine, drop: bool = False):
+    async with engine.begin() as connection:
+        if drop:
+            await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+
+
+async def populate(engine, scale: str, seed: int = 42, drop: bool = False) -> dict:
+    await create_schema(engine, drop=drop)
+    generator = DataGenerator(SCALES[scale], seed=seed)
+    counts = {"threads": 0, "messages": 0, "summaries": 0}
+    for threads, messages, summaries in generator.generate():
+        async with engine.begin() as connection:
+            await connection.execute(Thread.__table__.insert(), threads)
+            await connection.execute(ThreadMessage.__table__.insert(), messages)
+            # Generated display_text is the content, so the content is all there is to index
+            message_table = ThreadMessage.__table__
+            await connection.execute(message_table.update().where(
+                message_table.c.id.between(messages[0]["id"], messages[-1]["id"])
+            ).values(search_vector=to_search_vector(message_table.c.content),
+                     updated_at=message_table.c.updated_at))
+            if summaries:
+                await connection.execute(ThreadMessageSummary.__table__.insert(), summaries)
+        counts["threads"] += len(threads)
+        counts["messages"] += len(messages)
+        counts["summaries"] += len(summaries)
+
+    async with engine.begin() as connection:
+        # Rows were inserted with explicit ids, move the sequences past them
+        for table in (Thread.__table__, ThreadMessage.__table__):
+            await connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"(SELECT coalesce(max(id), 1) FROM {table.name}))"
+            ))
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text("VACUUM ANALYZE"))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--drop", action="store_true", help="drop the existing tables first")
+    args = parser.parse_args()
+
+    async def _run():
+        engine = create_async_engine(args.database_url)
+        try:
+            print(await populate(engine, args.scale, seed=args.seed, drop=args.drop))
+        finally:
+            await engine.dispose()
+
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    main()
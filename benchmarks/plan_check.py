@@ -0,0 +1,293 @@
+"""
+Query plan regression check.
+
+Runs every DAO query against a local database filled by ``datagen.py`` and EXPLAINs each statement it
+sends, with sequential scans and sorts disabled in the planner. A plan that still contains a ``Seq Scan``
+or a ``Sort`` has no index to serve it, and the check fails, unless the node is listed in ``ALLOWED`` with
+the reason it cannot be avoided. Everything runs in transactions that are rolled back.
+
+    python benchmarks/plan_check.py --database-url postgresql+asyncpg://localhost/chat_threads_bench \\
+        --scale 10k --generate
+
+It also runs as a test, skipped unless CHAT_THREADS_PLAN_CHECK_DATABASE_URL points at a database filled by
+``datagen.py``; with CHAT_THREADS_PLAN_CHECK_SCALE set the database is recreated and filled at that scale first:
+
+    CHAT_THREADS_PLAN_CHECK_DATABASE_URL=postgresql+asyncpg://localhost/chat_threads_bench \\
+        python -m pytest benchmarks/plan_check.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from datetime import timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import event, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from chat_threads.threads.dao import (
+    ThreadArchiveDao, ThreadDao, ThreadMessageBlobDao, ThreadMessageDao, ThreadMessageSummaryDao
+)
+from chat_threads.threads.models import Thread, ThreadMessage
+from chat_threads.utils.constants import ThreadSortOrder
+from chat_threads.utils.orm_utils import get_current_time
+
+# datagen.py sits next to this file, which is run as a script or collected by pytest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import SCALES, populate
+
+DATABASE_URL_ENV = "CHAT_THREADS_PLAN_CHECK_DATABASE_URL"
+SCALE_ENV = "CHAT_THREADS_PLAN_CHECK_SCALE"
+
+FLAGGED_NODES = {"Seq Scan", "Sort", "Incremental Sort"}
+
+# (case, node type) pairs that cannot be served by an index, with the reason. Only batch and admin work, and the
+# relevance ordering of search, belong here; queries on request paths get an index instead.
+ALLOWED: Dict[Tuple[str, str], str] = {
+    ("threads_search_ranked", "Sort"): "relevance: ts_rank is computed per match, after the GIN lookup",
+    ("summarization_candidates", "Sort"): "batch: the scheduler scan ranks active threads by their aggregated count",
+    ("bulk_restore_threads", "Seq Scan"): "admin: deleted threads are left out of the partial listing indexes",
+    ("stream_threads_export", "Seq Scan"): "batch: exports include deleted threads",
+    ("stream_messages_export", "Seq Scan"): "batch: exports include deleted threads",
+    ("stream_messages_export", "Sort"): "batch: messages of many threads in global id order",
+    ("stream_summaries_export", "Seq Scan"): "batch: exports include deleted threads",
+    ("stream_summaries_export", "Sort"): "batch: archived summaries are only indexed by thread",
+    ("archive_threads", "Seq Scan"): "batch: walks threads by id, filtering on age",
+}
+
+SKIPPED_PREFIXES = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "SET", "SHOW", "EXPLAIN")
+
+
+class StatementRecorder:
+    """Collects the statements the engine sends while a case runs."""
+
+    def __init__(self, engine):
+        self.statements: List[Tuple[str, object]] = []
+        self.recording = False
+        event.listen(engine.sync_engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.recording or statement.lstrip().startswith(SKIPPED_PREFIXES):
+            return
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        self.statements.append((statement, parameters))
+
+    def start(self):
+        self.statements = []
+        self.recording = True
+
+    def stop(self) -> List[Tuple[str, object]]:
+        self.recording = False
+        return self.statements
+
+
+def _plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def flagged_nodes(plan: dict) -> List[dict]:
+    return [node for node in _plan_nodes(plan) if node["Node Type"] in FLAGGED_NODES]
+
+
+async def _fixtures(session_factory) -> dict:
+    async with session_factory() as session:
+        owner = (await session.execute(
+            select(Thread.user_email, Thread.product, Thread.org_id)
+            .where(Thread.is_deleted == False)
+            .group_by(Thread.user_email, Thread.product, Thread.org_id)
+            .order_by(func.count().desc()).limit(1)
+        )).one()
+        thread = (await session.execute(
+            select(Thread.id, Thread.uuid, Thread.last_message_id, Thread.created_at)
+            .where(Thread.user_email == owner.user_email, Thread.is_deleted == False)
+            .order_by(Thread.message_count.desc()).limit(1)
+        )).one()
+        message_ids = (await session.execute(
+            select(ThreadMessage.id).where(ThreadMessage.thread_uuid == thread.uuid).order_by(ThreadMessage.id)
+        )).scalars().all()
+        hashes = (await session.execute(
+            select(ThreadMessage.question_config_hash).where(ThreadMessage.question_config_hash.isnot(None)).limit(5)
+        )).scalars().all()
+    return {
+        "user_email": owner.user_email,
+        "product": owner.product,
+        "org_id": owner.org_id,
+        "thread_uuid": thread.uuid,
+        "thread_created_at": thread.created_at,
+        "leaf_message_id": thread.last_message_id or message_ids[-1],
+        "message_ids": list(message_ids),
+        "middle_message_id": message_ids[len(message_ids) // 2],
+        "blob_hashes": list(hashes) or ["0" * 64],
+    }
+
+
+async def _consume(stream):
+    async for _ in stream:
+        pass
+
+
+def cases(f: dict) -> Dict[str, object]:
+    """Every DAO query, as ``name -> async operation(session)``."""
+    listing = dict(user_email=f["user_email"], product=f["product"], org_id=f["org_id"])
+    thread_uuid, leaf_message_id = f["thread_uuid"], f["leaf_message_id"]
+    now = get_current_time()
+
+    def threads(session):
+        return ThreadDao(session)
+
+    def messages(session):
+        return ThreadMessageDao(session)
+
+    def summaries(session):
+        return ThreadMessageSummaryDao(session)
+
+    return {
+        "get_thread_by_id": lambda s: threads(s).get_thread_by_id(thread_uuid),
+        "thread_exists": lambda s: threads(s).thread_exists(thread_uuid),
+        "get_thread_messages": lambda s: threads(s).get_thread_messages(thread_uuid),
+        "get_thread_messages_fast": lambda s: threads(s).get_thread_messages(thread_uuid, fast=True),
+        "get_threads_by_user_email": lambda s: threads(s).get_threads_by_user_email(
+            f["user_email"], f["product"], fast=True),
+        "threads_page": lambda s: threads(s).get_threads_with_pagination(
+            f["user_email"], f["product"], 3, 20, org_id=f["org_id"], light=True),
+        "threads_page_personal": lambda s: threads(s).get_threads_with_pagination(
+            f["user_email"], f["product"], 1, 20, light=True),
+        "threads_page_activity": lambda s: threads(s).get_threads_with_pagination(
+            f["user_email"], f["product"], 3, 20, org_id=f["org_id"], light=True,
+            sort_order=ThreadSortOrder.LAST_ACTIVITY),
+        "threads_cursor": lambda s: threads(s).get_threads_with_cursor(
+            f["user_email"], f["product"], 20, org_id=f["org_id"], light=True),
+        "threads_cursor_activity": lambda s: threads(s).get_threads_with_cursor(
+            f["user_email"], f["product"], 20, org_id=f["org_id"], light=True,
+            sort_order=ThreadSortOrder.LAST_ACTIVITY),
+        "threads_search_ranked": lambda s: threads(s).search_threads_ranked(
+            "deploy cache", f["user_email"], f["product"], 1, 20, org_id=f["org_id"]),
+        "bulk_get_threads": lambda s: threads(s).bulk_get_threads([thread_uuid], fast=True),
+        "update_thread": lambda s: threads(s).update_thread(thread_uuid, {"title": "plan check"}),
+        "record_new_messages": lambda s: threads(s).record_new_messages([(leaf_message_id + 1, thread_uuid, now, "x")]),
+        "update_message_preview": lambda s: threads(s).update_message_preview(thread_uuid, leaf_message_id, "x"),
+        "set_last_message_ids": lambda s: threads(s).set_last_message_ids({thread_uuid: leaf_message_id}),
+        "soft_delete_thread_by_uuid": lambda s: threads(s).soft_delete_thread_by_uuid(thread_uuid),
+        "bulk_soft_delete_threads": lambda s: threads(s).bulk_soft_delete_threads(**listing),
+        "bulk_restore_threads": lambda s: threads(s).bulk_restore_threads(**listing),
+        "stream_threads_export": lambda s: _consume(threads(s).stream_threads(org_id=f["org_id"])),
+        "get_thread_message_by_id": lambda s: messages(s).get_thread_message_by_id(leaf_message_id),
+        "messages_by_uuid": lambda s: messages(s).get_thread_messages_by_uuid(thread_uuid),
+        "stream_thread_messages": lambda s: _consume(messages(s).stream_thread_messages(thread_uuid)),
+        "messages_window_tail": lambda s: messages(s).get_thread_messages_window(thread_uuid, limit=50),
+        "messages_window_before": lambda s: messages(s).get_thread_messages_window(
+            thread_uuid, limit=50, before_id=f["middle_message_id"]),
+        "messages_window_since": lambda s: messages(s).get_thread_messages_window(
+            thread_uuid, limit=50, since_id=f["middle_message_id"]),
+        "message_ancestors": lambda s: messages(s).get_message_ancestors(leaf_message_id),
+        "message_siblings": lambda s: messages(s).get_message_siblings(leaf_message_id),
+        "context_rows_thread": lambda s: _consume(messages(s).stream_context_rows(thread_id=thread_uuid)),
+        "context_rows_branch": lambda s: _consume(messages(s).stream_context_rows(leaf_message_id=leaf_message_id)),
+        "set_search_vectors": lambda s: messages(s).set_search_vectors({leaf_message_id: "plan check"}),
+        "index_messages": lambda s: messages(s).index_messages(after_id=f["middle_message_id"], batch_size=100),
+        "stream_messages_export": lambda s: _consume(messages(s).stream_messages_of_threads(org_id=f["org_id"])),
+        "summaries_for_message_ids": lambda s: summaries(s).get_summaries_for_message_ids(f["message_ids"]),
+        "bulk_upsert_summaries": lambda s: summaries(s).bulk_upsert_summaries(
+            [(thread_uuid, leaf_message_id, "plan check")]),
+        "summarization_candidates": lambda s: summaries(s).get_summarization_candidates(
+            20, active_since=now - timedelta(days=1), limit=500),
+        "summarization_candidates_thread": lambda s: summaries(s).get_summarization_candidates(
+            20, thread_uuids=[thread_uuid]),
+        "stream_summaries_export": lambda s: _consume(summaries(s).stream_summaries_of_threads(org_id=f["org_id"])),
+        "get_blobs": lambda s: ThreadMessageBlobDao(s).get_blobs(f["blob_hashes"]),
+        "get_archived_thread": lambda s: ThreadArchiveDao(s).get_archived_thread(thread_uuid),
+        "get_archived_messages": lambda s: ThreadArchiveDao(s).get_archived_messages(thread_uuid),
+        "restore_archived_threads": lambda s: ThreadArchiveDao(s).restore_archived_threads([thread_uuid]),
+        "restore_for_write": lambda s: ThreadArchiveDao(s).restore_for_write([thread_uuid]),
+        "archive_threads": lambda s: ThreadArchiveDao(s).archive_threads(
+            inactive_before=f["thread_created_at"], batch_size=10),
+    }
+
+
+async def check(session_factory, recorder: StatementRecorder, only: Optional[Set[str]] = None) -> List[str]:
+    failures = []
+    fixtures = await _fixtures(session_factory)
+    for name, operation in cases(fixtures).items():
+        if only and name not in only:
+            continue
+        async with session_factory() as session:
+            recorder.start()
+            try:
+                await operation(session)
+            except Exception as e:
+                failures.append(f"{name}: failed to run: {e!r}")
+                recorder.stop()
+                await session.rollback()
+                continue
+            statements = recorder.stop()
+            if not statements:
+                failures.append(f"{name}: sent no statement")
+            await session.execute(text("SET LOCAL enable_seqscan = off"))
+            await session.execute(text("SET LOCAL enable_sort = off"))
+            connection = await session.connection()
+            for statement, parameters in statements:
+                result = await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+                plan = result.scalar()
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                for node in flagged_nodes(plan[0]["Plan"]):
+                    node_type = node["Node Type"]
+                    if (name, node_type) in ALLOWED:
+                        continue
+                    relation = node.get("Relation Name") or ", ".join(node.get("Sort Key", []))
+                    failures.append(f"{name}: {node_type} on {relation}\n    {' '.join(statement.split())[:300]}")
+            await session.rollback()
+        print(f"checked {name} ({len(statements)} statements)", file=sys.stderr)
+    return failures
+
+
+async def run_check(database_url: str, scale: Optional[str] = None, seed: int = 42,
+                    only: Optional[Set[str]] = None) -> List[str]:
+    """Check the database at ``database_url``, recreated and filled at ``scale`` first when given."""
+    engine = create_async_engine(database_url)
+    try:
+        if scale is not None:
+            await populate(engine, scale, seed=seed, drop=True)
+        async with engine.begin() as connection:
+            await connection.execute(text("ANALYZE"))
+        session_factory = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        return await check(session_factory, StatementRecorder(engine), only=only)
+    finally:
+        await engine.dispose()
+
+
+def test_query_plans():
+    import pytest
+
+    database_url = os.environ.get(DATABASE_URL_ENV)
+    if not database_url:
+        pytest.skip(f"{DATABASE_URL_ENV} is not set")
+    failures = asyncio.run(run_check(database_url, scale=os.environ.get(SCALE_ENV) or None))
+    assert not failures, "\n".join(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--generate", action="store_true", help="(re)create and fill the database first")
+    parser.add_argument("--case", action="append", help="only check these cases")
+    args = parser.parse_args()
+
+    failures = asyncio.run(run_check(args.database_url, scale=args.scale if args.generate else None, seed=args.seed,
+                                     only=set(args.case or [])))
+    for failure in failures:
+        print(failure)
+    if failures:
+        print(f"{len(failures)} plan regression(s)", file=sys.stderr)
+        sys.exit(1)
+    print("All query plans use indexes", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
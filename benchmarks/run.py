@@ -0,0 +1,224 @@
+"""
+DAO benchmark suite.
+
+Times the main ``ThreadDao`` / ``ThreadMessageDao`` / ``ThreadService`` paths against a local
+database filled by ``datagen.py`` and writes the results as JSON. Pass ``--compare`` with the
+JSON of a previous run to print the change for every benchmark.
+
+    python benchmarks/run.py --database-url postgresql+asyncpg://localhost/chat_threads_bench \\
+        --scale 10k --generate --output bench_output.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from chat_threads.threads.dao import ThreadMessageSummaryDao
+from chat_threads.threads.models import Thread, ThreadMessage
+from chat_threads.threads.serializers import CreateMessageRequest
+from chat_threads.threads.services import ThreadService
+from chat_threads.threads.writer import BatchedMessageWriter
+from chat_threads.utils.constants import Role
+
+from datagen import RARE_TERM, SCALES, populate
+
+
+class ConnectionHandler:
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+
+def _stats(durations: list) -> dict:
+    ordered = sorted(durations)
+    return {
+        "runs": len(ordered),
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": statistics.median(ordered) * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _package_version() -> str:
+    try:
+        from importlib.metadata import version
+        return version("chat_threads")
+    except Exception:
+        return "unknown"
+
+
+class BenchmarkSuite:
+
+    def __init__(self, session_factory, repeat: int = 20, write_count: int = 2000):
+        self.session_factory = session_factory
+        self.repeat = repeat
+        self.write_count = write_count
+        self.results = {}
+
+    async def timed(self, name: str, operation, repeat: int = None):
+        durations = []
+        for _ in range(repeat or self.repeat):
+            async with self.session_factory() as session:
+                service = ThreadService(ConnectionHandler(session))
+                start = time.perf_counter()
+                await operation(service, session)
+                durations.append(time.perf_counter() - start)
+                await session.rollback()
+        self.results[name] = _stats(durations)
+
+    async def _fixtures(self) -> dict:
+        async with self.session_factory() as session:
+            heaviest = (await session.execute(
+                select(Thread.user_email, Thread.product, Thread.org_id, func.count().label("threads"))
+                .where(Thread.is_deleted == False)
+                .group_by(Thread.user_email, Thread.product, Thread.org_id)
+                .order_by(func.count().desc()).limit(1)
+            )).one()
+            longest_thread = (await session.execute(
+                select(Thread.uuid, Thread.last_message_id).order_by(Thread.message_count.desc()).limit(1)
+            )).one()
+            message_ids = (await session.execute(
+                select(ThreadMessage.id).where(ThreadMessage.thread_uuid == longest_thread.uuid)
+            )).scalars().all()
+        return {
+            "user_email": heaviest.user_email,
+            "product": heaviest.product,
+            "org_id": heaviest.org_id,
+            "thread_count": heaviest.threads,
+            "thread_uuid": longest_thread.uuid,
+            "leaf_message_id": longest_thread.last_message_id,
+            "message_ids": message_ids,
+        }
+
+    async def run(self) -> dict:
+        f = await self._fixtures()
+        page_size = 20
+        last_page = max(1, (f["thread_count"] + page_size - 1) // page_size)
+        listing = dict(user_email=f["user_email"], product=f["product"], page_size=page_size, org_id=f["org_id"])
+
+        await self.timed("threads_page_first", lambda s, _: s.get_threads_with_pagination(page=1, **listing))
+        await self.timed("threads_page_deep", lambda s, _: s.get_threads_with_pagination(page=last_page, **listing))
+        await self.timed("threads_page_deep_light", lambda s, _: s.get_threads_with_pagination(
+            page=last_page, light=True, **listing))
+        await self.timed("threads_page_search", lambda s, _: s.get_threads_with_pagination(
+            page=1, query="deploy cache", **listing))
+        await self.timed("threads_page_search_deep", lambda s, _: s.get_threads_with_pagination(
+            page=5, query="deploy cache", **listing))
+        await self.timed("threads_cursor_first", lambda s, _: s.get_threads_with_cursor(**listing))
+        await self.timed("threads_search_ranked", lambda s, _: s.search_threads(
+            "deploy cache", f["user_email"], f["product"], org_id=f["org_id"]))
+        await self.timed("threads_search_rare_term", lambda s, _: s.search_threads(
+            RARE_TERM, f["user_email"], f["product"], org_id=f["org_id"]))
+
+        await self.timed("thread_messages_full", lambda s, _: s.get_thread_messages(f["thread_uuid"]))
+        await self.timed("thread_messages_fast", lambda s, _: s.get_thread_messages(f["thread_uuid"], fast=True))
+        await self.timed("thread_messages_tail_window", lambda s, _: s.get_thread_messages_window(
+            f["thread_uuid"], limit=50))
+        await self.timed("message_branch", lambda s, _: s.get_message_branch(f["leaf_message_id"]))
+        await self.timed("build_context", lambda s, _: s.build_context(8000, thread_id=f["thread_uuid"]))
+        await self.timed("summaries_for_thread", lambda _, session: ThreadMessageSummaryDao(
+            session).get_summaries_for_message_ids(f["message_ids"]))
+
+        await self._write_benchmarks(f)
+        return self.results
+
+    @staticmethod
+    def _message_request(f: dict, index: int) -> CreateMessageRequest:
+        return CreateMessageRequest(role=Role.USER.value, content=f"benchmark message {index}",
+                                    product=f["product"].value, thread_id=f["thread_uuid"])
+
+    async def _write_benchmarks(self, f: dict):
+        async with self.session_factory() as session:
+            service = ThreadService(ConnectionHandler(session))
+            start = time.perf_counter()
+            for index in range(self.write_count):
+                await service.create_thread_message(self._message_request(f, index),
+                                                    user_email=f["user_email"], org_id=f["org_id"])
+                await session.commit()
+            duration = time.perf_counter() - start
+        self.results["create_thread_message_throughput"] = {
+            "messages": self.write_count, "seconds": duration, "messages_per_second": self.write_count / duration
+        }
+
+        start = time.perf_counter()
+        async with BatchedMessageWriter(self.session_factory) as writer:
+            futures = [await writer.enqueue(self._message_request(f, index))
+                       for index in range(self.write_count)]
+            await asyncio.gather(*futures)
+        duration = time.perf_counter() - start
+        self.results["batched_writer_throughput"] = {
+            "messages": self.write_count, "seconds": duration, "messages_per_second": self.write_count / duration
+        }
+
+
+def compare(current: dict, previous: dict):
+    for name, stats in current["results"].items():
+        before = previous.get("results", {}).get(name)
+        if not before:
+            continue
+        key = "p50_ms" if "p50_ms" in stats else "messages_per_second"
+        change = (stats[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        print(f"{name:40s} {key:20s} {before[key]:12.2f} -> {stats[key]:12.2f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--generate", action="store_true", help="(re)create and fill the database first")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--write-count", type=int, default=2000)
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", help="JSON output of a previous run")
+    args = parser.parse_args()
+
+    async def _run():
+        engine = create_async_engine(args.database_url)
+        try:
+            if args.generate:
+                await populate(engine, args.scale, seed=args.seed, drop=True)
+            session_factory = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+            return await BenchmarkSuite(session_factory, repeat=args.repeat, write_count=args.write_count).run()
+        finally:
+            await engine.dispose()
+
+    results = asyncio.run(_run())
+    output = {
+        "meta": {
+            "version": _package_version(),
+            "git_commit": _git_commit(),
+            "scale": args.scale,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(output, output_file, indent=2, default=str)
+    print(json.dumps(output, indent=2, default=str))
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(output, json.load(previous_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of the per-row cost of turning thread rows into API output.
+
+Compares the default path (ORM object -> ``model_validate`` -> ``model_dump``) with the
+fast path used by ``fast=True`` / ``light=True`` reads (Core row -> plain dict). No database
+is needed, so this measures only the Python side of a read.
+
+    python benchmarks/serialization.py --rows 10000 --repeat 5
+"""
+import argparse
+import json
+import timeit
+import uuid
+from datetime import datetime, timezone
+
+from chat_threads.threads.models import Thread
+from chat_threads.threads.serializers import (
+    ThreadSchema, THREAD_FIELDS, THREAD_LIGHT_FIELDS, trusted_row_to_dict
+)
+from chat_threads.utils.constants import FynixProducts
+
+
+class _Row:
+    """Stand-in for a Core ``Row``: the fast path only relies on ``_mapping``."""
+
+    __slots__ = ("_mapping",)
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+
+
+def _thread_values(index: int) -> dict:
+    now = datetime.now(timezone.utc)
+    return {
+        "id": index,
+        "uuid": uuid.uuid4(),
+        "title": f"Thread {index}",
+        "product": FynixProducts.CO_PILOT,
+        "user_email": "user@example.com",
+        "user_id": index,
+        "created_at": now,
+        "updated_at": now,
+        "last_message_id": index * 10,
+        "is_deleted": False,
+        "meta": {"source": "web", "tags": ["a", "b", "c"]},
+        "org_id": "org_1",
+        "message_count": 10,
+        "last_message_at": now,
+        "last_message_preview": f"Last message of thread {index}",
+    }
+
+
+def run(rows: int, repeat: int) -> dict:
+    values = [_thread_values(index) for index in range(rows)]
+    orm_threads = [Thread(**thread_values) for thread_values in values]
+    full_rows = [_Row({field: thread_values[field] for field in THREAD_FIELDS}) for thread_values in values]
+    light_rows = [_Row({field: thread_values[field] for field in THREAD_LIGHT_FIELDS}) for thread_values in values]
+
+    cases = {
+        "orm_model_validate_dump": lambda: [ThreadSchema.model_validate(t).model_dump() for t in orm_threads],
+        "row_model_construct": lambda: [ThreadSchema.model_construct(**trusted_row_to_dict(r)) for r in full_rows],
+        "row_dict_fast": lambda: [trusted_row_to_dict(r) for r in full_rows],
+        "row_dict_light": lambda: [trusted_row_to_dict(r) for r in light_rows],
+    }
+    results = {}
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=1, repeat=repeat))
+        results[name] = {"total_seconds": best, "per_row_microseconds": best / rows * 1_000_000}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.rows, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import copy
+import hashlib
+import json
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+from chat_threads.threads.models import ThreadMessageBlob
+from chat_threads.utils.cache import LRUCache
+from chat_threads.utils.constants import BLOB_CACHE_MAX_SIZE, BLOB_CACHE_TTL
+from chat_threads.utils.orm_utils import pending_until_commit
+
+# JSON columns of ThreadMessage that can be stored once in thread_message_blob, and the column holding the hash
+BLOB_FIELDS = {
+    "question_config": "question_config_hash",
+    "prompt_details": "prompt_details_hash",
+}
+PENDING_BLOBS_KEY = "chat_threads_pending_blobs"
+
+
+def blob_hash(value) -> str:
+    """sha256 of the canonical JSON of ``value``: equal payloads share a hash whatever their key order."""
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _database_key(session) -> str:
+    """The database ``session`` writes to; every shard has its own ``thread_message_blob``."""
+    return str(session.sync_session.get_bind(ThreadMessageBlob).engine.url)
+
+
+class BlobStore:
+    """
+    Content-addressed storage for the ``question_config``/``prompt_details`` payloads that nearly every message
+    of a product repeats. With ``enabled`` a message stores the sha256 of each payload and the payload itself
+    is written once to ``thread_message_blob``. Reads resolve hashes with one lookup per page of messages, and
+    the in-process intern cache answers most of them without a query. Cache entries are kept per database, so
+    a blob stored on one shard never stands in for a blob missing on another.
+
+    Reads always resolve hashes, so rows written either way can be mixed and writing can be turned off again.
+    Only blobs from committed transactions are cached, so a rolled back write never hides a missing blob.
+    Resolved payloads are copies and safe to mutate.
+    """
+
+    def __init__(self, max_size: int = BLOB_CACHE_MAX_SIZE, ttl: float = BLOB_CACHE_TTL, enabled: bool = False):
+        self.enabled = enabled
+        self.cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    @property
+    def stats(self) -> dict:
+        return {**self.cache.stats.as_dict(), "size": len(self.cache)}
+
+    async def lookup(self, blob_dao, hashes: Iterable[str]) -> Dict[str, dict]:
+        database = _database_key(blob_dao.session)
+        blobs, missing = {}, []
+        for hash_value in set(hashes):
+            value = self.cache.get((database, hash_value))
+            if value is None:
+                missing.append(hash_value)
+            else:
+                blobs[hash_value] = value
+        if missing:
+            loaded = await blob_dao.get_blobs(missing)
+            for hash_value, value in loaded.items():
+                self.cache.set((database, hash_value), value)
+            blobs.update(loaded)
+        return blobs
+
+    @staticmethod
+    def _hashes(items, get) -> List[str]:
+        return [get(item, hash_field) for item in items for hash_field in BLOB_FIELDS.values()
+                if get(item, hash_field) is not None]
+
+    async def resolve_rows(self, blob_dao, rows: List[dict], keep_hashes: bool = False) -> List[dict]:
+        """Fill the blob fields of message dicts from their hashes, dropping the hash keys unless ``keep_hashes``."""
+        hashes = self._hashes(rows, lambda row, key: row.get(key))
+        blobs = await self.lookup(blob_dao, hashes) if hashes else {}
+        for row in rows:
+            for field, hash_field in BLOB_FIELDS.items():
+                hash_value = row.get(hash_field) if keep_hashes else row.pop(hash_field, None)
+                if hash_value is not None and row.get(field) is None and hash_value in blobs:
+                    row[field] = copy.deepcopy(blobs[hash_value])
+        return rows
+
+    async def resolve_messages(self, blob_dao, messages: list) -> list:
+        """Fill the blob fields of loaded ``ThreadMessage`` objects without marking them as modified."""
+        hashes = self._hashes(messages, getattr)
+        if not hashes:
+            return messages
+        blobs = await self.lookup(blob_dao, hashes)
+        for message in messages:
+            for field, hash_field in BLOB_FIELDS.items():
+                hash_value = getattr(message, hash_field)
+                if hash_value is not None and getattr(message, field) is None and hash_value in blobs:
+                    set_committed_value(message, field, copy.deepcopy(blobs[hash_value]))
+        return messages
+
+    async def dedupe(self, blob_dao, rows: List[dict]) -> List[dict]:
+        """
+        Replace the blob fields of message insert ``rows`` with hashes, writing the payloads not known to be
+        stored yet with one ``INSERT ... ON CONFLICT DO NOTHING``. Rows are left as they are when disabled.
+        """
+        if not self.enabled:
+            return rows
+        database = _database_key(blob_dao.session)
+        new_blobs = {}
+        for row in rows:
+            for field, hash_field in BLOB_FIELDS.items():
+                value = row.get(field)
+                if value is None:
+                    row[hash_field] = None
+                    continue
+                hash_value = blob_hash(value)
+                row[hash_field] = hash_value
+                row[field] = None
+                if self.cache.get((database, hash_value)) is None:
+                    new_blobs[hash_value] = value
+        if new_blobs:
+            await blob_dao.insert_blobs(new_blobs)
+            self._cache_after_commit(blob_dao.session, {(database, hash_value): value
+                                                         for hash_value, value in new_blobs.items()})
+        return rows
+
+    def _cache_after_commit(self, session, blobs: Dict[Tuple[str, str], dict]):
+        pending_until_commit(session, self, PENDING_BLOBS_KEY, dict, self._cache_committed).update(blobs)
+
+    def _cache_committed(self, blobs: Dict[Tuple[str, str], dict]):
+        for key, value in blobs.items():
+            self.cache.set(key, value)
+
+
+def keep_blob_values(message, values: dict):
+    """After a flush, give a new ``ThreadMessage`` back the payloads ``dedupe`` took out of its ``values``."""
+    for field in BLOB_FIELDS:
+        if getattr(message, field) is None and values.get(field) is not None:
+            set_committed_value(message, field, values[field])
+
+
+_blob_store = BlobStore()
+
+
+def get_blob_store() -> BlobStore:
+    return _blob_store
+
+
+def configure_blob_store(enabled: bool = True, max_size: int = BLOB_CACHE_MAX_SIZE, ttl: float = BLOB_CACHE_TTL):
+    """Turn content-addressed storage of new messages' payloads on or off for this process."""
+    global _blob_store
+    _blob_store = BlobStore(max_size=max_size, ttl=ttl, enabled=enabled)
+    return _blob_store
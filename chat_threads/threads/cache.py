@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+from uuid import UUID
+
+from chat_threads.threads.serializers import ThreadSchema
+from chat_threads.utils.cache import CacheBackend, CacheStats, LRUCache
+from chat_threads.utils.constants import THREAD_CACHE_MAX_SIZE, THREAD_CACHE_TTL
+from chat_threads.utils.orm_utils import peek_pending, pending_until_commit
+
+logger = logging.getLogger(__name__)
+
+PENDING_THREAD_WRITES_KEY = "chat_threads_pending_thread_writes"
+
+
+class ThreadCache:
+    """
+    Read-through cache for thread metadata looked up by uuid.
+    Lookups go to the in-process LRU first and then to the optional shared ``backend``.
+    Writes through ``ThreadDao`` invalidate or update the entry once their transaction commits, and leave it
+    alone when it rolls back; other processes only see the change once their local entry expires, so keep
+    ``ttl`` short when a shared backend is used.
+    """
+
+    KEY_PREFIX = "chat_threads:thread:"
+
+    def __init__(self, max_size: int = THREAD_CACHE_MAX_SIZE, ttl: float = THREAD_CACHE_TTL,
+                 backend: Optional[CacheBackend] = None):
+        self.ttl = ttl
+        self.backend = backend
+        self.local = LRUCache(max_size=max_size, ttl=ttl)
+        self.backend_stats = CacheStats()
+        self._backend_tasks = set()
+
+    def _key(self, thread_uuid: UUID) -> str:
+        return f"{self.KEY_PREFIX}{thread_uuid}"
+
+    @property
+    def stats(self) -> dict:
+        return {"local": self.local.stats.as_dict(), "backend": self.backend_stats.as_dict(), "size": len(self.local)}
+
+    async def get(self, thread_uuid: UUID) -> Optional[ThreadSchema]:
+        thread = self.local.get(thread_uuid)
+        if thread is not None:
+            return thread.model_copy()
+        if self.backend is None:
+            return None
+
+        payload = await self.backend.get(self._key(thread_uuid))
+        if payload is None:
+            self.backend_stats.misses += 1
+            return None
+        self.backend_stats.hits += 1
+        thread = ThreadSchema.model_validate_json(payload)
+        self.local.set(thread_uuid, thread)
+        return thread.model_copy()
+
+    async def set(self, thread: ThreadSchema):
+        self.local.set(thread.uuid, thread.model_copy())
+        if self.backend is not None:
+            await self.backend.set(self._key(thread.uuid), thread.model_dump_json(), self.ttl)
+
+    async def invalidate(self, thread_uuid: UUID):
+        self.local.delete(thread_uuid)
+        if self.backend is not None:
+            await self.backend.delete(self._key(thread_uuid))
+            self.backend_stats.invalidations += 1
+
+    async def update_fields(self, thread_uuid: UUID, values: dict):
+        """Apply a write to a cached thread (e.g. a new ``last_message_id``) without loading it when it is not cached."""
+        thread = self.local.peek(thread_uuid)
+        if thread is None:
+            if self.backend is not None:
+                await self.backend.delete(self._key(thread_uuid))
+            return
+        await self.set(thread.model_copy(update=values))
+
+    def invalidate_on_commit(self, session, thread_uuid: UUID):
+        """``invalidate`` once ``session`` commits, so no reader caches the row as it was before the write."""
+        self._pending(session)[thread_uuid] = None
+
+    def update_on_commit(self, session, thread_uuid: UUID, values: dict):
+        """``update_fields`` once ``session`` commits; a thread also invalidated in the transaction stays invalidated."""
+        pending = self._pending(session)
+        if thread_uuid not in pending:
+            pending[thread_uuid] = dict(values)
+        elif pending[thread_uuid] is not None:
+            pending[thread_uuid].update(values)
+
+    def written_in(self, session, thread_uuid: UUID) -> bool:
+        """Whether ``session`` has an uncommitted write to ``thread_uuid``; its reads of it must not be cached."""
+        pending = peek_pending(session, self, PENDING_THREAD_WRITES_KEY)
+        return pending is not None and thread_uuid in pending
+
+    def _pending(self, session) -> Dict[UUID, Optional[dict]]:
+        return pending_until_commit(session, self, PENDING_THREAD_WRITES_KEY, dict, self._apply_committed)
+
+    def _apply_committed(self, pending: Dict[UUID, Optional[dict]]):
+        for thread_uuid, values in pending.items():
+            self._apply(thread_uuid, values)
+
+    def _apply(self, thread_uuid: UUID, values: Optional[dict]):
+        # Runs inside the commit, where nothing can be awaited: the local entry changes now, the backend soon after
+        thread = self.local.peek(thread_uuid)
+        if values is None or thread is None:
+            self.local.delete(thread_uuid)
+            if self.backend is not None:
+                self._in_background(self.backend.delete(self._key(thread_uuid)))
+                self.backend_stats.invalidations += 1
+            return
+        thread = thread.model_copy(update=values)
+        self.local.set(thread_uuid, thread)
+        if self.backend is not None:
+            self._in_background(self.backend.set(self._key(thread_uuid), thread.model_dump_json(), self.ttl))
+
+    def _in_background(self, operation):
+        task = asyncio.ensure_future(operation)
+        self._backend_tasks.add(task)
+        task.add_done_callback(self._backend_task_done)
+
+    def _backend_task_done(self, task: asyncio.Task):
+        self._backend_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to update the shared thread cache", exc_info=task.exception())
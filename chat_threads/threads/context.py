@@ -0,0 +1,54 @@
+from typing import AsyncIterable, Callable
+
+from chat_threads.threads.serializers import ContextItem, ThreadContext
+from chat_threads.utils.constants import Role
+
+TokenCounter = Callable[[str], int]
+
+
+def count_characters(text: str) -> int:
+    return len(text)
+
+
+def _role_value(role) -> str:
+    return getattr(role, "value", role)
+
+
+async def assemble_context(rows: AsyncIterable, budget: int,
+                           token_counter: TokenCounter = count_characters) -> ThreadContext:
+    """
+    Build model context from ``(id, role, content, summary)`` rows ordered newest first.
+
+    Messages are kept verbatim while they fit in ``budget``. A summary stands for the conversation up to and
+    including its message, so once the next message no longer fits, the newest summary at or before that
+    point replaces everything older and reading stops. Without such a summary older messages are dropped.
+    """
+    items = []
+    total_tokens = 0
+    truncated = False
+    seen_ids = set()
+
+    async for message_id, role, content, summary in rows:
+        if message_id in seen_ids:
+            continue
+        seen_ids.add(message_id)
+
+        if not truncated:
+            tokens = token_counter(content or "")
+            if total_tokens + tokens <= budget:
+                items.append(ContextItem(message_id=message_id, role=_role_value(role), content=content or "",
+                                         tokens=tokens))
+                total_tokens += tokens
+                continue
+            truncated = True
+
+        if summary:
+            tokens = token_counter(summary)
+            if total_tokens + tokens <= budget:
+                items.append(ContextItem(message_id=message_id, role=Role.SYSTEM.value, content=summary,
+                                         is_summary=True, tokens=tokens))
+                total_tokens += tokens
+            break
+
+    items.reverse()
+    return ThreadContext(items=items, total_tokens=total_tokens, budget=budget, truncated=truncated)
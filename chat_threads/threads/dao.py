@@ -1,26 +1,149 @@
 from chat_threads.utils.dao import BaseDao
-from sqlalchemy import select, and_, update, func
+from sqlalchemy import (select, and_, or_, update, delete, insert, func, tuple_, literal_column, case, literal, bindparam,
+                        type_coerce, String, DateTime, Integer, exists)
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from typing import List, Optional
-from uuid import UUID
+import json
+from collections import defaultdict
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID, uuid4
 from chat_threads.utils.exceptions import (
     ThreadUpdateError, ThreadDeleteError
 )
-from chat_threads.threads.models import Thread, ThreadMessage, ThreadMessageSummary
-from chat_threads.threads.serializers import ThreadSchema, ThreadMessageSchema
+from chat_threads.threads.cache import ThreadCache
+from chat_threads.threads.blobs import BLOB_FIELDS, get_blob_store
+from chat_threads.threads.models import (
+    Thread, ThreadMessage, ThreadMessageBlob, ThreadMessageSummary, ThreadArchive, ThreadMessageArchive,
+    ThreadMessageSummaryArchive, message_search_text, to_search_vector
+)
+from chat_threads.threads.serializers import (
+    ThreadSchema, ThreadMessageSchema, BulkThreadsResult, BulkThreadUpdateResult, BulkSummaryUpsertResult, THREAD_FIELDS, THREAD_LIGHT_FIELDS, THREAD_MESSAGE_FIELDS, trusted_row_to_dict
+)
+from chat_threads.utils.pagination import (
+    CURSOR_NEXT, CURSOR_PREV, encode_cursor, decode_cursor, build_pagination, search_with_cursor
+)
+from chat_threads.utils.constants import (
+    ARCHIVE_BATCH_SIZE, BULK_OPERATION_BATCH_SIZE, EXPORT_CHUNK_SIZE, SEARCH_TEXT_CONFIG, THREAD_PREVIEW_LENGTH, ThreadSortOrder
+)
+from chat_threads.utils.compression import compression_enabled, compression_threshold, reference_display_text
+from chat_threads.utils.orm_utils import get_current_time
+
+
+def _ts_query(search_query: str):
+    return func.plainto_tsquery(literal_column(f"'{SEARCH_TEXT_CONFIG}'::regconfig"), search_query)
+
+
+def _message_matches(ts_query):
+    return ThreadMessage.search_vector.op('@@')(ts_query)
+
+
+def _thread_columns(light: bool = False):
+    return [getattr(Thread, field) for field in (THREAD_LIGHT_FIELDS if light else THREAD_FIELDS)]
+
+
+def _thread_activity_columns():
+    return [Thread.message_count, Thread.last_message_id, Thread.last_message_at, Thread.last_message_preview]
+
+
+def _thread_message_columns():
+    return [getattr(ThreadMessage, field) for field in THREAD_MESSAGE_FIELDS]
+
+
+def _blob_hash_columns():
+    return [getattr(ThreadMessage, hash_field) for hash_field in BLOB_FIELDS.values()]
+
+
+# Hot tables and their archive copies, see ThreadArchiveDao
+_ARCHIVE_MODELS = {Thread: ThreadArchive, ThreadMessage: ThreadMessageArchive,
+                   ThreadMessageSummary: ThreadMessageSummaryArchive}
+
+
+def _export_columns(model, table=None):
+    """``model``'s stored columns, taken from ``table`` (its archive table) when given."""
+    table = model.__table__ if table is None else table
+    # Derived columns (search_vector) are rebuilt by the importer
+    return [table.c[column.name] for column in model.__table__.columns if not column.info.get("derived")]
+
+
+def _hot_and_archive_tables(*models):
+    """The tables of ``models``, then the tables of their archive copies; exports read both."""
+    return [[model.__table__ for model in models], [_ARCHIVE_MODELS[model].__table__ for model in models]]
+
+
+def _thread_scope(user_email: Optional[str] = None, org_id: Optional[str] = None, product: Optional[str] = None,
+                  include_deleted: bool = True, threads=Thread.__table__):
+    conditions = []
+    if user_email is not None:
+        conditions.append(threads.c.user_email == user_email)
+    if org_id is not None:
+        conditions.append(threads.c.org_id == org_id)
+    if product is not None:
+        conditions.append(threads.c.product == product)
+    if not include_deleted:
+        conditions.append(threads.c.is_deleted == False)
+    return conditions
+
+
+async def _stream_partitions(result, chunk_size: int):
+    try:
+        async for rows in result.partitions(chunk_size):
+            yield rows
+    finally:
+        await result.close()
+
+
+def _batches(items: list, batch_size: int = BULK_OPERATION_BATCH_SIZE):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
 
 
 class ThreadDao(BaseDao):
 
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, thread_cache: Optional[ThreadCache] = None,
+                 archive_fallback: bool = True, fill_cache: bool = True):
+        """
+        With ``archive_fallback``, threads not found in the hot tables are looked up in the archive. Without
+        ``fill_cache`` the ``thread_cache`` is only read, e.g. on a replica whose rows may lag the primary.
+        """
         super().__init__(session=session, db_model=Thread)
+        self.thread_cache = thread_cache
+        self.archive_fallback = archive_fallback
+        self.fill_cache = fill_cache
 
     async def get_thread_by_id(self, thread_id: UUID):
+        if self.thread_cache is not None:
+            cached_thread = await self.thread_cache.get(thread_id)
+            if cached_thread is not None:
+                return cached_thread
+
         query = select(Thread).where(Thread.uuid == thread_id)
         result = await self._execute_query(query)
         thread = result.scalars().first()
-        return ThreadSchema.model_validate(thread)
+        if thread is None and self.archive_fallback:
+            thread = await ThreadArchiveDao(self.session).get_archived_thread(thread_id)
+        thread_schema = ThreadSchema.model_validate(thread)
+        await self._cache_read(thread_schema)
+        return thread_schema
+
+    async def _cache_read(self, thread: ThreadSchema):
+        # A thread this transaction wrote to is not cached until the write commits
+        if (self.thread_cache is not None and self.fill_cache
+                and not self.thread_cache.written_in(self.session, thread.uuid)):
+            await self.thread_cache.set(thread)
+
+    async def thread_exists(self, thread_uuid: UUID) -> bool:
+        """
+        Whether a thread with ``thread_uuid`` is stored in this database, deleted or not; archived threads
+        count too with ``archive_fallback``.
+        """
+        stored = exists().where(Thread.uuid == thread_uuid)
+        if self.archive_fallback:
+            stored = or_(stored, exists().where(ThreadArchive.uuid == thread_uuid))
+        result = await self._execute_query(select(stored))
+        return bool(result.scalar())
 
     async def update_thread(self, thread_uuid: UUID, update_values_dict: dict):
         update_query = update(Thread).where(Thread.uuid == thread_uuid,
@@ -28,24 +151,118 @@ class ThreadDao(BaseDao):
         result = await self._execute_query(update_query)
         if result.rowcount == 0:
             raise ThreadUpdateError("Thread to update not found")
+        if self.thread_cache is not None:
+            self.thread_cache.invalidate_on_commit(self.session, thread_uuid)
         return result
 
-    async def get_thread_messages(self, thread_id: UUID, filters: dict = None):
-        query = select(ThreadMessage, Thread).join(ThreadMessage).where(
-            Thread.uuid == thread_id).order_by(ThreadMessage.id)
+    async def record_new_messages(self, messages: Iterable[Tuple[int, UUID, datetime, Optional[str]]]):
+        """
+        Fold newly inserted ``(id, thread_uuid, created_at, display_text)`` messages into the activity columns of
+        their threads with a single ``UPDATE``. ``message_count`` grows by the number of new messages and
+        ``last_message_*`` follow the newest one, unless the thread already points at a newer message.
+        Run it in the transaction that inserts the messages so both stay consistent.
+        """
+        message_counts = defaultdict(int)
+        latest_messages = {}
+        for message_id, thread_uuid, created_at, display_text in messages:
+            message_counts[thread_uuid] += 1
+            if thread_uuid not in latest_messages or message_id > latest_messages[thread_uuid][0]:
+                latest_messages[thread_uuid] = (message_id, created_at,
+                                                (display_text or "")[:THREAD_PREVIEW_LENGTH] or None)
+        if not message_counts:
+            return
+
+        def per_thread(values: dict):
+            return case(values, value=Thread.uuid)
+
+        new_last_message_id = per_thread({thread_uuid: latest[0] for thread_uuid, latest in latest_messages.items()})
+        is_newer = new_last_message_id > func.coalesce(Thread.last_message_id, 0)
+        update_query = update(Thread).where(Thread.uuid.in_(list(message_counts))).values(
+            message_count=Thread.message_count + per_thread(dict(message_counts)),
+            last_message_id=case((is_newer, new_last_message_id), else_=Thread.last_message_id),
+            last_message_at=case((is_newer, per_thread(
+                {thread_uuid: latest[1] for thread_uuid, latest in latest_messages.items()})),
+                else_=Thread.last_message_at),
+            last_message_preview=case((is_newer, per_thread(
+                {thread_uuid: latest[2] for thread_uuid, latest in latest_messages.items()})),
+                else_=Thread.last_message_preview),
+        ).returning(Thread.uuid, Thread.updated_at, *_thread_activity_columns())
+        result = await self._execute_query(update_query)
+        if self.thread_cache is not None:
+            for row in result.all():
+                values = dict(row._mapping)
+                self.thread_cache.update_on_commit(self.session, values.pop("uuid"), values)
+
+    async def backfill_message_activity(self, after_id: int = 0, batch_size: int = 1000) -> Optional[int]:
+        """
+        Recompute the activity columns from ``thread_message`` for the next ``batch_size`` threads with an id
+        above ``after_id``. Returns the last thread id processed, or None once there is nothing left, so a
+        backfill can be resumed from any batch.
+        """
+        batch_query = select(Thread.id).where(Thread.id > after_id).order_by(Thread.id).limit(batch_size)
+        batch_result = await self._execute_query(batch_query)
+        thread_ids = batch_result.scalars().all()
+        if not thread_ids:
+            return None
+
+        def latest_message(column):
+            return select(column).where(ThreadMessage.thread_uuid == Thread.uuid).order_by(
+                ThreadMessage.id.desc()).limit(1).scalar_subquery()
+
+        update_query = update(Thread).where(Thread.id.in_(thread_ids)).values(
+            message_count=select(func.count()).where(ThreadMessage.thread_uuid == Thread.uuid).scalar_subquery(),
+            last_message_id=latest_message(ThreadMessage.id),
+            last_message_at=func.coalesce(latest_message(ThreadMessage.created_at), Thread.created_at),
+            # Compressed values and content references (starting with ESC) are not readable in SQL
+            last_message_preview=latest_message(case(
+                (func.left(ThreadMessage.display_text, 1) == func.chr(27), None),
+                else_=func.left(ThreadMessage.display_text, THREAD_PREVIEW_LENGTH)
+            )),
+        ).returning(Thread.uuid)
+        result = await self._execute_query(update_query)
+        if self.thread_cache is not None:
+            for thread_uuid in result.scalars().all():
+                self.thread_cache.invalidate_on_commit(self.session, thread_uuid)
+        return thread_ids[-1]
+
+    async def get_thread_messages(self, thread_id: UUID, filters: dict = None, fast: bool = False):
+        """
+        ``fast`` reads the schema columns as Core rows and builds the schemas with ``model_construct``,
+        skipping the ORM identity map and validation. Only use it for rows coming from our own tables.
+        """
+        if fast:
+            query = select(*_thread_message_columns(), *_blob_hash_columns()).where(
+                ThreadMessage.thread_uuid == thread_id).order_by(ThreadMessage.id)
+        else:
+            query = select(ThreadMessage, Thread).join(ThreadMessage).where(
+                Thread.uuid == thread_id).order_by(ThreadMessage.id)
         if filters and filters['roles']:
             query = query.where(ThreadMessage.role.in_(filters['roles']))
         result = await self._execute_query(query)
-        messages = result.scalars().all()
-        return [ThreadMessageSchema.model_validate(message) for message in messages]
+        blob_dao = ThreadMessageBlobDao(self.session)
+        if fast:
+            rows = await get_blob_store().resolve_rows(blob_dao, [trusted_row_to_dict(row) for row in result.all()])
+            messages = [ThreadMessageSchema.model_construct(**row) for row in rows]
+        else:
+            messages = await get_blob_store().resolve_messages(blob_dao, result.scalars().all())
+            messages = [ThreadMessageSchema.model_validate(message) for message in messages]
+        if not messages and self.archive_fallback:
+            # Also reached by empty hot threads: one indexed lookup on the archive, which has no rows for them
+            return await ThreadArchiveDao(self.session).get_archived_messages(
+                thread_id, roles=filters['roles'] if filters else None, fast=fast)
+        return self._serialized(messages)
 
-    async def get_threads_by_user_email(self, user_email: str, product: str) -> List[ThreadSchema]:
-        query = select(Thread).where(and_(Thread.user_email == user_email,
-                                          Thread.product == product,
-                                          Thread.is_deleted == False)).order_by(Thread.created_at.desc())
+    async def get_threads_by_user_email(self, user_email: str, product: str, fast: bool = False) -> List[ThreadSchema]:
+        query = select(*_thread_columns()) if fast else select(Thread)
+        query = query.where(and_(Thread.user_email == user_email,
+                                 Thread.product == product,
+                                 Thread.is_deleted == False)).order_by(Thread.created_at.desc())
         query_result = await self._execute_query(query)
+        if fast:
+            return self._serialized(
+                [ThreadSchema.model_construct(**trusted_row_to_dict(row)) for row in query_result.all()])
         results = query_result.scalars().all()
-        return [ThreadSchema.model_validate(result) for result in results]
+        return self._serialized([ThreadSchema.model_validate(result) for result in results])
 
     async def soft_delete_thread_by_uuid(self, thread_uuid):
         query = (update(Thread).where(Thread.uuid == thread_uuid,
@@ -54,23 +271,177 @@ class ThreadDao(BaseDao):
         result = await self._execute_query(query)
         if result.rowcount == 0:
             raise ThreadDeleteError("Thread to delete not found")
+        if self.thread_cache is not None:
+            self.thread_cache.invalidate_on_commit(self.session, thread_uuid)
         return ThreadSchema.model_validate(result)
 
-    async def search_in_thread_message(self, query: str, email: str, product: str):
-        search_query = select(Thread).distinct(Thread.id).join(ThreadMessage,
-                                                               Thread.uuid == ThreadMessage.thread_uuid).where(
-            Thread.user_email == email,
+    async def bulk_get_threads(self, thread_uuids: Iterable[UUID], include_deleted: bool = False,
+                               fast: bool = False) -> BulkThreadsResult:
+        """
+        Fetch many threads with one query per ``BULK_OPERATION_BATCH_SIZE`` uuids, after the cache.
+        Threads come back in the order of ``thread_uuids``; unknown (or deleted, unless ``include_deleted``)
+        uuids are reported in ``missing``.
+        """
+        thread_uuids = list(dict.fromkeys(thread_uuids))
+        found: Dict[UUID, ThreadSchema] = {}
+        to_load = thread_uuids
+        if self.thread_cache is not None:
+            to_load = []
+            for thread_uuid in thread_uuids:
+                cached_thread = await self.thread_cache.get(thread_uuid)
+                if cached_thread is None:
+                    to_load.append(thread_uuid)
+                elif include_deleted or not cached_thread.is_deleted:
+                    found[thread_uuid] = cached_thread
+
+        for batch in _batches(to_load):
+            conditions = [Thread.uuid.in_(batch)]
+            if not include_deleted:
+                conditions.append(Thread.is_deleted == False)
+            if fast:
+                result = await self._execute_query(select(*_thread_columns()).where(*conditions))
+                threads = [ThreadSchema.model_construct(**trusted_row_to_dict(row)) for row in result.all()]
+            else:
+                result = await self._execute_query(select(Thread).where(*conditions))
+                threads = [ThreadSchema.model_validate(thread) for thread in result.scalars().all()]
+            for thread in threads:
+                found[thread.uuid] = thread
+                await self._cache_read(thread)
+
+        return BulkThreadsResult(
+            threads=self._serialized([found[thread_uuid] for thread_uuid in thread_uuids if thread_uuid in found]),
+            missing=[thread_uuid for thread_uuid in thread_uuids if thread_uuid not in found]
+        )
+
+    @staticmethod
+    def _bulk_conditions(thread_uuids, user_email: Optional[str], org_id: Optional[str], product: Optional[str]):
+        if thread_uuids is None and user_email is None and org_id is None and product is None:
+            raise ValueError("Bulk thread updates need thread_uuids, user_email, org_id or product")
+        return _thread_scope(user_email, org_id, product)
+
+    async def _bulk_update(self, values: dict, conditions: list,
+                           thread_uuids: Optional[Iterable[UUID]]) -> BulkThreadUpdateResult:
+        def update_query(*where):
+            return (update(Thread).where(*where, *conditions).values(**values)
+                    .returning(Thread.uuid).execution_options(synchronize_session=False))
+
+        if thread_uuids is None:
+            result = await self._execute_query(update_query())
+            updated, missing = result.scalars().all(), []
+        else:
+            thread_uuids = list(dict.fromkeys(thread_uuids))
+            updated = []
+            for batch in _batches(thread_uuids):
+                result = await self._execute_query(update_query(Thread.uuid.in_(batch)))
+                updated.extend(result.scalars().all())
+            updated_uuids = set(updated)
+            missing = [thread_uuid for thread_uuid in thread_uuids if thread_uuid not in updated_uuids]
+
+        if self.thread_cache is not None:
+            for thread_uuid in updated:
+                self.thread_cache.invalidate_on_commit(self.session, thread_uuid)
+        return BulkThreadUpdateResult(updated=updated, missing=missing)
+
+    async def bulk_update_threads(self, update_values_dict: dict, thread_uuids: Optional[Iterable[UUID]] = None,
+                                  user_email: Optional[str] = None, org_id: Optional[str] = None,
+                                  product: Optional[str] = None) -> BulkThreadUpdateResult:
+        """
+        Apply the same values to every non deleted thread matching all the given filters, with one statement
+        (per ``BULK_OPERATION_BATCH_SIZE`` uuids). Requested uuids that were not updated are reported in ``missing``.
+        """
+        conditions = self._bulk_conditions(thread_uuids, user_email, org_id, product)
+        return await self._bulk_update(update_values_dict, conditions + [Thread.is_deleted == False], thread_uuids)
+
+    async def bulk_soft_delete_threads(self, thread_uuids: Optional[Iterable[UUID]] = None,
+                                       user_email: Optional[str] = None, org_id: Optional[str] = None,
+                                       product: Optional[str] = None) -> BulkThreadUpdateResult:
+        """Soft delete every thread matching all the given filters; already deleted threads count as missing."""
+        conditions = self._bulk_conditions(thread_uuids, user_email, org_id, product)
+        return await self._bulk_update({"is_deleted": True}, conditions + [Thread.is_deleted == False], thread_uuids)
+
+    async def bulk_restore_threads(self, thread_uuids: Optional[Iterable[UUID]] = None,
+                                   user_email: Optional[str] = None, org_id: Optional[str] = None,
+                                   product: Optional[str] = None) -> BulkThreadUpdateResult:
+        """Undo ``bulk_soft_delete_threads``; threads that are not deleted count as missing."""
+        conditions = self._bulk_conditions(thread_uuids, user_email, org_id, product)
+        return await self._bulk_update({"is_deleted": False}, conditions + [Thread.is_deleted == True], thread_uuids)
+
+    async def stream_threads(self, user_email: Optional[str] = None, org_id: Optional[str] = None,
+                             product: Optional[str] = None, include_deleted: bool = False,
+                             chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[list]:
+        """
+        Yield all stored columns of the matching threads as Core rows, ``chunk_size`` at a time, by id: the hot
+        threads first, then the archived ones.
+        """
+        for (threads,) in _hot_and_archive_tables(Thread):
+            query = select(*_export_columns(Thread, threads)).where(
+                *_thread_scope(user_email, org_id, product, include_deleted, threads=threads)
+            ).order_by(threads.c.id).execution_options(yield_per=chunk_size)
+            async for rows in _stream_partitions(await self._stream_query(query), chunk_size):
+                yield rows
+
+    async def update_message_preview(self, thread_uuid: UUID, message_id: int, display_text: Optional[str]):
+        """Refresh ``last_message_preview`` once a message is complete, if it is still the thread's last one."""
+        preview = display_text[:THREAD_PREVIEW_LENGTH] if display_text is not None else None
+        update_query = update(Thread).where(
+            Thread.uuid == thread_uuid, Thread.last_message_id == message_id
+        ).values(last_message_preview=preview).execution_options(synchronize_session=False)
+        result = await self._execute_query(update_query)
+        if result.rowcount and self.thread_cache is not None:
+            self.thread_cache.update_on_commit(self.session, thread_uuid, {"last_message_preview": preview})
+        return result
+
+    async def set_last_message_ids(self, last_message_ids: Dict[UUID, int]):
+        """Point many threads at their last message with one ``executemany`` update."""
+        if not last_message_ids:
+            return
+        table = Thread.__table__
+        query = update(table).where(table.c.uuid == bindparam("thread_uuid")).values(
+            last_message_id=bindparam("last_message_id"))
+        await self._execute_query(query, [{"thread_uuid": thread_uuid, "last_message_id": last_message_id}
+                                          for thread_uuid, last_message_id in last_message_ids.items()])
+        if self.thread_cache is not None:
+            for thread_uuid in last_message_ids:
+                self.thread_cache.invalidate_on_commit(self.session, thread_uuid)
+
+    async def search_threads_ranked(self, query: str, user_email: str, product: str, page: int, page_size: int,
+                                    org_id: Optional[str] = None):
+        """
+        Full-text search over message content served by the ``search_vector`` GIN index.
+        Matches are grouped per thread and ranked by their best matching message.
+        """
+        ts_query = _ts_query(query)
+        rank = func.max(func.ts_rank(ThreadMessage.search_vector, ts_query)).label("rank")
+        match_count = func.count(ThreadMessage.id).label("match_count")
+
+        filters = [
+            Thread.user_email == user_email,
             Thread.product == product,
             Thread.is_deleted == False,
-            ThreadMessage.content.ilike(f'%{query}%')
-        )
+            Thread.org_id == org_id if org_id else Thread.org_id.is_(None),
+            _message_matches(ts_query),
+        ]
+        count_query = select(func.count(func.distinct(Thread.id))).select_from(Thread).join(
+            ThreadMessage, Thread.uuid == ThreadMessage.thread_uuid).where(*filters)
+        total_count_result = await self._execute_query(count_query)
+        total_count = total_count_result.scalar()
+
+        search_query = select(Thread, rank, match_count).join(
+            ThreadMessage, Thread.uuid == ThreadMessage.thread_uuid
+        ).where(*filters).group_by(Thread.id).order_by(rank.desc(), Thread.id.desc())
+        if page_size > 0:
+            search_query = search_query.offset((page - 1) * page_size).limit(page_size)
 
         result = await self._execute_query(search_query)
-        threads = result.scalars().all()
-        return [ThreadSchema.model_validate(thread) for thread in threads]
+        threads = [
+            {**ThreadSchema.model_validate(thread).model_dump(), "rank": thread_rank, "match_count": thread_matches}
+            for thread, thread_rank, thread_matches in result.all()
+        ]
+        return {"threads": threads, "pagination": build_pagination(total_count, page, page_size)}
 
     @staticmethod
-    async def _get_threads_query(user_email: str, product: str, search_query: str = None, org_id: Optional[str] = None):
+    async def _get_threads_query(user_email: str, product: str, org_id: Optional[str] = None,
+                                 sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT):
         base_query = select(Thread).where(
             and_(
                 Thread.user_email == user_email,
@@ -84,17 +455,26 @@ class ThreadDao(BaseDao):
         else:
             base_query = base_query.where(Thread.org_id.is_(None))
 
-        if search_query:
-            base_query = base_query.join(ThreadMessage, Thread.uuid == ThreadMessage.thread_uuid).where(
-                ThreadMessage.content.ilike(f'%{search_query}%')
-            ).distinct(Thread.id)
-
-        base_query = base_query.order_by(Thread.created_at.desc() if not search_query else Thread.id.desc())
+        if sort_order == ThreadSortOrder.LAST_ACTIVITY:
+            base_query = base_query.order_by(Thread.last_message_at.desc(), Thread.id.desc())
+        else:
+            base_query = base_query.order_by(Thread.created_at.desc())
         return base_query
 
     async def get_threads_with_pagination(self, user_email: str, product: str, page: int,
-                                          page_size: int, query: str = None, org_id: Optional[str] = None):
-        search_query = await self._get_threads_query(user_email, product , search_query=query, org_id=org_id)
+                                          page_size: int, query: str = None, org_id: Optional[str] = None,
+                                          fast: bool = False, light: bool = False,
+                                          sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT):
+        """
+        ``fast`` selects only the schema columns and returns the rows as plain dicts without ORM objects or
+        validation; ``light`` does the same but also leaves out ``meta``, for thread list views.
+        ``ThreadSortOrder.LAST_ACTIVITY`` lists the most recently active threads first.
+        With a ``query`` this is ``search_threads_ranked``: matching threads best first, each with its ``rank``
+        and ``match_count``.
+        """
+        if query:
+            return await self.search_threads_ranked(query, user_email, product, page, page_size, org_id=org_id)
+        search_query = await self._get_threads_query(user_email, product, org_id=org_id, sort_order=sort_order)
 
         count_query = select(func.count()).select_from(search_query.subquery())
         total_count_result = await self._execute_query(count_query)
@@ -103,15 +483,19 @@ class ThreadDao(BaseDao):
         if page_size > 0:
             search_query = search_query.offset((page - 1) * page_size).limit(page_size)
 
-        result = await self._execute_query(search_query)
-        threads = result.scalars().all()
+        if fast or light:
+            result = await self._execute_query(search_query.with_only_columns(*_thread_columns(light)))
+            threads = self._serialized([trusted_row_to_dict(row) for row in result.all()])
+        else:
+            result = await self._execute_query(search_query)
+            threads = self._serialized([ThreadSchema.model_validate(t).model_dump() for t in result.scalars().all()])
 
         total_pages = (total_count + page_size - 1) // page_size if page_size > 0 else 1
         has_next = page < total_pages
         has_previous = page > 1
 
         return {
-            "threads": [ThreadSchema.model_validate(t).model_dump() for t in threads],
+            "threads": threads,
             "pagination": {
                 "total_count": total_count,
                 "total_pages": total_pages,
@@ -122,6 +506,82 @@ class ThreadDao(BaseDao):
             },
         }
 
+    async def get_threads_with_cursor(self, user_email: str, product: str, page_size: int,
+                                      cursor: Optional[str] = None, query: str = None,
+                                      org_id: Optional[str] = None, include_total_count: bool = False,
+                                      fast: bool = False, light: bool = False,
+                                      sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT):
+        """
+        Keyset pagination over the same listing as ``get_threads_with_pagination``.
+        Pages are keyed on ``(created_at, id)``, or ``(last_message_at, id)`` when sorting by activity, so the
+        cost of a page does not depend on how deep it is. The total count is only computed when asked for.
+        ``fast`` and ``light`` behave as in ``get_threads_with_pagination``. With a ``query`` the pages are those
+        of ``search_threads_ranked``, see ``search_with_cursor``.
+        """
+        if query:
+            return await search_with_cursor(
+                lambda page, size: self.search_threads_ranked(query, user_email, product, page, size, org_id=org_id),
+                page_size, cursor=cursor, include_total_count=include_total_count, sort_order=sort_order)
+        search_query = await self._get_threads_query(user_email, product, org_id=org_id, sort_order=sort_order)
+
+        total_count = None
+        if include_total_count:
+            count_query = select(func.count()).select_from(search_query.subquery())
+            total_count_result = await self._execute_query(count_query)
+            total_count = total_count_result.scalar()
+
+        direction, keys = decode_cursor(cursor, sort_order=sort_order) if cursor else (CURSOR_NEXT, None)
+        backwards = direction == CURSOR_PREV
+
+        if sort_order == ThreadSortOrder.LAST_ACTIVITY:
+            sort_columns = [Thread.last_message_at, Thread.id]
+        else:
+            sort_columns = [Thread.created_at, Thread.id]
+        sort_key = tuple_(*sort_columns)
+
+        if keys is not None:
+            cursor_key = tuple_(*keys)
+            search_query = search_query.where(sort_key > cursor_key if backwards else sort_key < cursor_key)
+
+        search_query = search_query.order_by(None).order_by(
+            *[column.asc() if backwards else column.desc() for column in sort_columns]
+        ).limit(page_size + 1)
+
+        projected = fast or light
+        if projected:
+            search_query = search_query.with_only_columns(*_thread_columns(light))
+        result = await self._execute_query(search_query)
+        threads = result.all() if projected else result.scalars().all()
+
+        has_more = len(threads) > page_size
+        threads = threads[:page_size]
+        if backwards:
+            threads.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, keys is not None
+
+        def _cursor_keys(thread):
+            return [getattr(thread, column.key) for column in sort_columns]
+
+        next_cursor = encode_cursor(CURSOR_NEXT, _cursor_keys(threads[-1]),
+                                    sort_order=sort_order) if threads and has_next else None
+        prev_cursor = encode_cursor(CURSOR_PREV, _cursor_keys(threads[0]),
+                                    sort_order=sort_order) if threads and has_previous else None
+
+        return {
+            "threads": self._serialized([trusted_row_to_dict(t) if projected else ThreadSchema.model_validate(t).model_dump()
+                                         for t in threads]),
+            "pagination": {
+                "page_size": page_size,
+                "next_cursor": next_cursor,
+                "prev_cursor": prev_cursor,
+                "has_next": has_next,
+                "has_previous": has_previous,
+                "total_count": total_count,
+            },
+        }
+
 
 class ThreadMessageDao(BaseDao):
 
@@ -129,10 +589,277 @@ class ThreadMessageDao(BaseDao):
         super().__init__(session, ThreadMessage)
 
     async def get_thread_messages_by_uuid(self, thread_id: UUID) -> List[ThreadMessage]:
-        query = select(ThreadMessage).join(Thread).filter(Thread.uuid == thread_id).order_by(ThreadMessage.created_at)
+        # Ids follow insert order, and ix_thread_message_thread_uuid_id serves them without a sort
+        query = select(ThreadMessage).join(Thread).filter(Thread.uuid == thread_id).order_by(ThreadMessage.id)
         result = await self._execute_query(query)
+        return await get_blob_store().resolve_messages(ThreadMessageBlobDao(self.session), result.scalars().all())
+
+    async def get_thread_message_by_id(self, message_id: int) -> Optional[ThreadMessage]:
+        result = await self._execute_query(select(ThreadMessage).where(ThreadMessage.id == message_id))
+        messages = await get_blob_store().resolve_messages(ThreadMessageBlobDao(self.session), result.scalars().all())
+        return messages[0] if messages else None
+
+    async def append_content(self, message_id: int, delta: str):
+        """Append ``delta`` to a streaming message in SQL, without sending or rewriting what is stored already."""
+        table = ThreadMessage.__table__
+        # Bypass the compressing column type: partial content is always stored as plain text
+        update_query = update(table).where(table.c.id == message_id, table.c.is_streaming == True).values(
+            content=type_coerce(table.c.content, String()) + literal(delta, String()))
+        result = await self._execute_query(update_query)
+        if result.rowcount == 0:
+            raise ThreadUpdateError("Streaming message to append to not found")
+        return result
+
+    async def finalize_streaming_message(self, message_id: int, content: str, display_text: str):
+        values = reference_display_text({"content": content, "display_text": display_text})
+        # Partial content is not searchable, the message is indexed once complete
+        values["search_vector"] = to_search_vector(message_search_text(content, display_text))
+        update_query = update(ThreadMessage).where(
+            ThreadMessage.id == message_id, ThreadMessage.is_streaming == True
+        ).values(is_streaming=False, **values).execution_options(synchronize_session=False)
+        result = await self._execute_query(update_query)
+        if result.rowcount == 0:
+            raise ThreadUpdateError("Streaming message to finalize not found")
+        return result
+
+    @staticmethod
+    def _thread_messages_query(thread_id: UUID, roles: Optional[List[str]] = None):
+        query = select(ThreadMessage).where(ThreadMessage.thread_uuid == thread_id)
+        if roles:
+            query = query.where(ThreadMessage.role.in_(roles))
+        return query
+
+    async def stream_thread_messages(self, thread_id: UUID, chunk_size: int = 100,
+                                     roles: Optional[List[str]] = None) -> AsyncIterator[List[ThreadMessageSchema]]:
+        """
+        Yield the messages of a thread oldest first, ``chunk_size`` at a time, through a server side cursor
+        so only one chunk is held in memory.
+        """
+        query = self._thread_messages_query(thread_id, roles).order_by(ThreadMessage.id).execution_options(
+            yield_per=chunk_size)
+        result = await self._stream_query(query, scalars=True)
+        blob_dao = ThreadMessageBlobDao(self.session)
+        try:
+            async for messages in result.partitions(chunk_size):
+                messages = await get_blob_store().resolve_messages(blob_dao, messages)
+                yield [ThreadMessageSchema.model_validate(message) for message in messages]
+        finally:
+            await result.close()
+
+    async def stream_search_rows(self, chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[list]:
+        """
+        Yield ``(thread_uuid, content, display_text, user_email, product, org_id)`` rows of the messages of every
+        thread that is not deleted (archived ones are not searched), ``chunk_size`` at a time, to fill a search index.
+        """
+        query = select(
+            ThreadMessage.thread_uuid, ThreadMessage.content, ThreadMessage.display_text,
+            Thread.user_email, Thread.product, Thread.org_id
+        ).join(
+            Thread, Thread.uuid == ThreadMessage.thread_uuid
+        ).where(
+            Thread.is_deleted == False
+        ).order_by(ThreadMessage.id).execution_options(yield_per=chunk_size)
+        async for rows in _stream_partitions(await self._stream_query(query), chunk_size):
+            yield rows
+
+    async def stream_messages_of_threads(self, user_email: Optional[str] = None, org_id: Optional[str] = None,
+                                         product: Optional[str] = None, include_deleted: bool = False,
+                                         chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[list]:
+        """
+        Yield all stored columns of the messages of the matching threads as Core rows, ``chunk_size`` at a time,
+        those of hot threads first, then those of archived ones. A thread's messages are all in one of them and
+        come by id, so a parent message always comes before its replies.
+        """
+        for messages, threads in _hot_and_archive_tables(ThreadMessage, Thread):
+            query = select(*_export_columns(ThreadMessage, messages)).join(
+                threads, threads.c.uuid == messages.c.thread_uuid
+            ).where(
+                *_thread_scope(user_email, org_id, product, include_deleted, threads=threads)
+            ).order_by(messages.c.id).execution_options(yield_per=chunk_size)
+            async for rows in _stream_partitions(await self._stream_query(query), chunk_size):
+                yield rows
+
+    async def compress_messages(self, after_id: int = 0, batch_size: int = 1000) -> Optional[int]:
+        """
+        Rewrite the next ``batch_size`` messages with an id above ``after_id`` that compression applies to, so
+        they are stored the way ``chat_threads.utils.compression`` is configured now. Returns the last message
+        id looked at, or None once there is nothing left, so the rewrite can be resumed from any batch.
+        """
+        threshold = compression_threshold()
+        if not compression_enabled() or threshold is None:
+            raise ValueError("Call chat_threads.utils.compression.configure_compression first")
+        query = select(ThreadMessage.id, ThreadMessage.content, ThreadMessage.display_text,
+                       ThreadMessage.question_config, ThreadMessage.prompt_details).where(
+            ThreadMessage.id > after_id
+        ).order_by(ThreadMessage.id).limit(batch_size)
+        rows = (await self._execute_query(query)).all()
+        if not rows:
+            return None
+
+        fields = ("content", "display_text", "question_config", "prompt_details")
+        parameters = []
+        for row in rows:
+            values = {field: getattr(row, field) for field in fields}
+            sizes = [len(value if isinstance(value, str) else json.dumps(value))
+                     for value in values.values() if value is not None]
+            same_as_content = values["display_text"] is not None and values["display_text"] == values["content"]
+            if not same_as_content and not any(size >= threshold for size in sizes):
+                continue
+            values = reference_display_text(values)
+            parameters.append({"message_id": row.id, **{f"new_{field}": values[field] for field in fields}})
+
+        if parameters:
+            table = ThreadMessage.__table__
+            update_query = update(table).where(table.c.id == bindparam("message_id")).values(
+                **{field: bindparam(f"new_{field}", type_=table.c[field].type) for field in fields})
+            await self._execute_query(update_query, parameters)
+        return rows[-1].id
+
+    async def set_search_vectors(self, search_texts: Dict[int, str]):
+        """
+        Index ``{message_id: search text}`` (see ``message_search_text``) for messages written without the ORM,
+        one ``UPDATE ... FROM unnest(...)`` per ``BULK_OPERATION_BATCH_SIZE`` messages.
+        """
+        table = ThreadMessage.__table__
+        for batch in _batches(list(search_texts.items())):
+            texts = select(
+                func.unnest(literal([message_id for message_id, _ in batch], ARRAY(Integer))).label("id"),
+                func.unnest(literal([search_text for _, search_text in batch], ARRAY(String))).label("search_text"),
+            ).subquery()
+            # Indexing is not an edit, keep updated_at as it is
+            update_query = update(table).where(table.c.id == texts.c.id).values(
+                search_vector=to_search_vector(texts.c.search_text), updated_at=table.c.updated_at)
+            await self._execute_query(update_query)
+
+    async def index_messages(self, after_id: int = 0, batch_size: int = 1000,
+                             only_compressed: bool = True) -> Optional[int]:
+        """
+        Rebuild ``search_vector`` for the next ``batch_size`` messages with an id above ``after_id``; with
+        ``only_compressed``, only for those whose content or display text is stored compressed (their vectors
+        were left empty before they were built from the plain text). Returns the last message id looked at,
+        or None once there is nothing left, so the backfill can be resumed from any batch.
+        """
+        batch_query = select(ThreadMessage.id).where(ThreadMessage.id > after_id).order_by(
+            ThreadMessage.id).limit(batch_size)
+        message_ids = (await self._execute_query(batch_query)).scalars().all()
+        if not message_ids:
+            return None
+        query = select(ThreadMessage.id, ThreadMessage.content, ThreadMessage.display_text).where(
+            ThreadMessage.id.in_(message_ids))
+        if only_compressed:
+            table = ThreadMessage.__table__
+            query = query.where(or_(func.left(table.c.content, 1) == func.chr(27),
+                                    func.left(table.c.display_text, 1) == func.chr(27)))
+        rows = (await self._execute_query(query)).all()
+        await self.set_search_vectors({row.id: message_search_text(row.content, row.display_text) for row in rows})
+        return message_ids[-1]
+
+    async def get_thread_messages_window(self, thread_id: UUID, limit: int = 50, since_id: Optional[int] = None,
+                                         before_id: Optional[int] = None, roles: Optional[List[str]] = None):
+        """
+        Fetch a window of at most ``limit`` messages, always returned oldest first.
+        Without ``since_id`` this is the tail of the thread (optionally ending before ``before_id``), which is what
+        a chat UI opens with and pages backwards through. With ``since_id`` it is the messages written after it,
+        for incremental polling. ``has_more`` tells whether messages exist past the window in that direction.
+        """
+        query = self._thread_messages_query(thread_id, roles)
+        if before_id is not None:
+            query = query.where(ThreadMessage.id < before_id)
+        if since_id is not None:
+            query = query.where(ThreadMessage.id > since_id).order_by(ThreadMessage.id.asc())
+        else:
+            query = query.order_by(ThreadMessage.id.desc())
+
+        result = await self._execute_query(query.limit(limit + 1))
         messages = result.scalars().all()
-        return messages
+        has_more = len(messages) > limit
+        messages = await get_blob_store().resolve_messages(ThreadMessageBlobDao(self.session), messages[:limit])
+        if since_id is None:
+            messages.reverse()
+
+        return {
+            "messages": self._serialized([ThreadMessageSchema.model_validate(message) for message in messages]),
+            "has_more": has_more,
+        }
+
+    @staticmethod
+    def _message_columns(columns: Optional[Sequence[str]] = None):
+        column_names = list(columns or ThreadMessageSchema.model_fields)
+        unknown_columns = set(column_names) - set(ThreadMessage.__table__.columns.keys())
+        if unknown_columns:
+            raise ValueError(f"Unknown thread message columns: {sorted(unknown_columns)}")
+        # Blob fields need their hash to be resolved
+        column_names += [BLOB_FIELDS[name] for name in column_names
+                         if name in BLOB_FIELDS and BLOB_FIELDS[name] not in column_names]
+        return [getattr(ThreadMessage, column_name) for column_name in column_names]
+
+    async def _message_rows(self, rows, columns: Optional[Sequence[str]] = None):
+        message_rows = await get_blob_store().resolve_rows(
+            ThreadMessageBlobDao(self.session), [dict(row._mapping) for row in rows],
+            keep_hashes=bool(columns and set(columns) & set(BLOB_FIELDS.values()))
+        )
+        if columns:
+            return message_rows
+        return [ThreadMessageSchema.model_validate(row) for row in message_rows]
+
+    @staticmethod
+    def _branch_cte(leaf_message_id: int):
+        ancestors = select(ThreadMessage.id, ThreadMessage.parent_message_id, literal(0).label("depth")).where(
+            ThreadMessage.id == leaf_message_id).cte("message_ancestors", recursive=True)
+        return ancestors.union_all(
+            select(ThreadMessage.id, ThreadMessage.parent_message_id, (ancestors.c.depth + 1).label("depth")).join(
+                ancestors, ThreadMessage.id == ancestors.c.parent_message_id)
+        )
+
+    async def get_message_ancestors(self, message_id: int, columns: Optional[Sequence[str]] = None):
+        """
+        Return the branch ending at ``message_id``, root first, with one recursive query that only follows
+        ``parent_message_id`` links. ``columns`` limits the projection and returns plain dicts instead of
+        ``ThreadMessageSchema`` objects.
+        """
+        ancestors = self._branch_cte(message_id)
+        query = select(*self._message_columns(columns)).join(ancestors, ThreadMessage.id == ancestors.c.id).order_by(
+            ancestors.c.depth.desc())
+        result = await self._execute_query(query)
+        return await self._message_rows(result.all(), columns)
+
+    async def get_message_siblings(self, message_id: int, columns: Optional[Sequence[str]] = None):
+        """
+        Return the alternative branches at the node ``message_id`` hangs from: every message of the same thread
+        with the same parent (regenerations, edits), including ``message_id`` itself, oldest first.
+        """
+        target = aliased(ThreadMessage)
+        query = select(*self._message_columns(columns)).join(target, and_(
+            target.thread_uuid == ThreadMessage.thread_uuid,
+            ThreadMessage.parent_message_id.isnot_distinct_from(target.parent_message_id),
+        )).where(target.id == message_id).order_by(ThreadMessage.id)
+        result = await self._execute_query(query)
+        return await self._message_rows(result.all(), columns)
+
+    async def stream_context_rows(self, thread_id: Optional[UUID] = None, leaf_message_id: Optional[int] = None,
+                                  chunk_size: int = 50):
+        """
+        Yield ``(id, role, content, summary)`` for the non deleted messages of a thread, or of the branch ending
+        at ``leaf_message_id``, newest first, each joined with its summary. Rows are read through a server side
+        cursor so a caller that stops early does not pay for the older part of the thread.
+        """
+        summary = ThreadMessageSummary.summary.label("summary")
+        query = select(ThreadMessage.id, ThreadMessage.role, ThreadMessage.content, summary).outerjoin(
+            ThreadMessageSummary, ThreadMessageSummary.thread_message_id == ThreadMessage.id
+        ).where(ThreadMessage.is_deleted == False)
+
+        if leaf_message_id is not None:
+            branch = self._branch_cte(leaf_message_id)
+            query = query.join(branch, ThreadMessage.id == branch.c.id).order_by(branch.c.depth)
+        else:
+            query = query.where(ThreadMessage.thread_uuid == thread_id).order_by(ThreadMessage.id.desc())
+
+        result = await self._stream_query(query.execution_options(yield_per=chunk_size))
+        try:
+            async for row in result:
+                yield row
+        finally:
+            await result.close()
 
 
 class ThreadMessageSummaryDao(BaseDao):
@@ -164,11 +891,229 @@ class ThreadMessageSummaryDao(BaseDao):
         update_query = update(ThreadMessageSummary).where(ThreadMessageSummary.uuid == summary_uuid).values(**update_values_dict)
         return await self._execute_query(update_query)
 
+    async def bulk_upsert_summaries(self, summaries: Iterable[Tuple[UUID, int, str]]) -> BulkSummaryUpsertResult:
+        """
+        Create or replace the summaries of many messages from ``(thread_uuid, thread_message_id, summary_text)``
+        with one ``INSERT ... ON CONFLICT (thread_message_id) DO UPDATE`` per ``BULK_OPERATION_BATCH_SIZE`` rows.
+        When a message is given more than once the last summary wins. Rerunning the same input is harmless.
+        """
+        now = get_current_time()
+        rows_by_message = {}
+        for thread_uuid, thread_message_id, summary_text in summaries:
+            rows_by_message[thread_message_id] = {
+                "uuid": uuid4(),
+                "thread_uuid": thread_uuid,
+                "thread_message_id": thread_message_id,
+                "summary": summary_text,
+                "created_at": now,
+                "updated_at": now,
+            }
+
+        created, updated = [], []
+        for batch in _batches(list(rows_by_message.values())):
+            insert_query = pg_insert(ThreadMessageSummary).values(batch)
+            upsert_query = insert_query.on_conflict_do_update(
+                index_elements=[ThreadMessageSummary.thread_message_id],
+                set_={"summary": insert_query.excluded.summary, "updated_at": insert_query.excluded.updated_at}
+            ).returning(
+                ThreadMessageSummary.thread_message_id,
+                # xmax is 0 only for rows this statement inserted
+                literal_column("xmax = 0").label("inserted")
+            )
+            result = await self._execute_query(upsert_query)
+            for thread_message_id, inserted in result.all():
+                (created if inserted else updated).append(thread_message_id)
+        return BulkSummaryUpsertResult(created=created, updated=updated)
+
+    async def get_summarization_candidates(self, threshold: int, thread_uuids: Optional[Iterable[UUID]] = None,
+                                           active_since: Optional[datetime] = None,
+                                           limit: Optional[int] = None) -> List[Tuple[UUID, int, int]]:
+        """
+        ``(thread_uuid, newest_message_id, unsummarized_count)`` of the non deleted threads with at least
+        ``threshold`` finished messages newer than their latest summary, most unsummarized first. Only threads
+        with ``message_count >= threshold`` are looked at, restricted to ``thread_uuids`` or to threads with a
+        message since ``active_since`` when given.
+        """
+        candidates = select(Thread.uuid).where(Thread.is_deleted == False, Thread.message_count >= threshold)
+        if thread_uuids is not None:
+            candidates = candidates.where(Thread.uuid.in_(list(thread_uuids)))
+        if active_since is not None:
+            candidates = candidates.where(Thread.last_message_at >= active_since)
+
+        summarized_id = select(func.coalesce(func.max(ThreadMessageSummary.thread_message_id), 0)).where(
+            ThreadMessageSummary.thread_uuid == ThreadMessage.thread_uuid).scalar_subquery()
+        unsummarized = func.count(ThreadMessage.id).label("unsummarized")
+        query = select(ThreadMessage.thread_uuid, func.max(ThreadMessage.id), unsummarized).where(
+            ThreadMessage.thread_uuid.in_(candidates),
+            ThreadMessage.is_deleted == False,
+            ThreadMessage.is_streaming == False,
+            ThreadMessage.id > summarized_id,
+        ).group_by(ThreadMessage.thread_uuid).having(func.count(ThreadMessage.id) >= threshold)
+        if limit is None:
+            # Every row is returned anyway, so order them here and let the groups come off
+            # ix_thread_message_thread_uuid_id without a sort
+            result = await self._execute_query(query)
+            return sorted((tuple(row) for row in result.all()), key=lambda row: row[2], reverse=True)
+        result = await self._execute_query(query.order_by(unsummarized.desc()).limit(limit))
+        return [tuple(row) for row in result.all()]
+
+    async def stream_summaries_of_threads(self, user_email: Optional[str] = None, org_id: Optional[str] = None,
+                                          product: Optional[str] = None, include_deleted: bool = False,
+                                          chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[list]:
+        """
+        Yield the summaries of the matching threads as Core rows, ``chunk_size`` at a time, those of hot threads
+        first, then those of archived ones.
+        """
+        for summaries, threads in _hot_and_archive_tables(ThreadMessageSummary, Thread):
+            query = select(*_export_columns(ThreadMessageSummary, summaries)).join(
+                threads, threads.c.uuid == summaries.c.thread_uuid
+            ).where(
+                *_thread_scope(user_email, org_id, product, include_deleted, threads=threads)
+            ).order_by(summaries.c.thread_message_id).execution_options(yield_per=chunk_size)
+            async for rows in _stream_partitions(await self._stream_query(query), chunk_size):
+                yield rows
+
     async def get_summaries(self, thread_message_ids: List[UUID]):
         """
        From a given list of thread message ids, find the relevant summaries.
        """
         query = select(ThreadMessageSummary).where(ThreadMessageSummary.thread_message_id.in_(thread_message_ids))
-        result = await self.session.execute(query)
+        result = await self._execute_query(query)
         return result.scalars().all()
 
+
+class ThreadMessageBlobDao(BaseDao):
+    """DAO for the content-addressed payloads in thread_message_blob, used through ``BlobStore``."""
+
+    def __init__(self, session: AsyncSession):
+        super().__init__(session, ThreadMessageBlob)
+
+    async def get_blobs(self, hashes: List[str]) -> Dict[str, dict]:
+        blobs = {}
+        for batch in _batches(hashes):
+            query = select(ThreadMessageBlob.hash, ThreadMessageBlob.value).where(ThreadMessageBlob.hash.in_(batch))
+            result = await self._execute_query(query)
+            blobs.update(result.all())
+        return blobs
+
+    async def insert_blobs(self, blobs: Dict[str, dict]):
+        """Store ``{hash: value}`` payloads; the ones already stored are skipped by ``ON CONFLICT DO NOTHING``."""
+        now = get_current_time()
+        rows = [{"hash": hash_value, "value": value, "created_at": now} for hash_value, value in blobs.items()]
+        for batch in _batches(rows):
+            insert_query = pg_insert(ThreadMessageBlob).values(batch).on_conflict_do_nothing(
+                index_elements=[ThreadMessageBlob.hash])
+            await self._execute_query(insert_query)
+
+
+def _move_rows(source, target, where, archived_at: Optional[datetime] = None):
+    """
+    ``WITH moved AS (DELETE FROM source ... RETURNING ...) INSERT INTO target SELECT ... FROM moved``: one
+    statement, so a row is never in both tables or in neither. Values are copied as stored.
+    """
+    names = [column.name for column in target.columns if column.name in source.c]
+    # Plain column names, so stored values are not run through the types' column expressions on the way
+    moved = delete(source).where(where).returning(
+        *[literal_column(f"{source.name}.{name}") for name in names]).cte("moved")
+    columns = [literal_column(f"moved.{name}") for name in names]
+    if archived_at is not None:
+        names.append("archived_at")
+        columns.append(literal(archived_at, DateTime(timezone=True)))
+    return insert(target).from_select(names, select(*columns).select_from(moved))
+
+
+class ThreadArchiveDao(BaseDao):
+    """
+    Moves threads with their messages and summaries between the hot tables and the ``*_archive`` tables.
+    Archived threads are read back by ``ThreadDao.get_thread_by_id`` and ``ThreadDao.get_thread_messages``.
+    """
+
+    def __init__(self, session: AsyncSession, thread_cache: Optional[ThreadCache] = None):
+        super().__init__(session, ThreadArchive)
+        self.thread_cache = thread_cache
+
+    async def _move_threads(self, thread_uuids: List[UUID], to_archive: bool):
+        tables = [(ThreadMessageSummary, ThreadMessageSummaryArchive), (ThreadMessage, ThreadMessageArchive),
+                  (Thread, ThreadArchive)]
+        if not to_archive:
+            # Parents first: threads, then messages, then summaries
+            tables = [(archive, hot) for hot, archive in reversed(tables)]
+        archived_at = get_current_time() if to_archive else None
+        for source, target in tables:
+            source_table = source.__table__
+            key = source_table.c.uuid if source in (Thread, ThreadArchive) else source_table.c.thread_uuid
+            await self._execute_query(_move_rows(source_table, target.__table__, key.in_(thread_uuids),
+                                                 archived_at=archived_at))
+        if self.thread_cache is not None:
+            for thread_uuid in thread_uuids:
+                self.thread_cache.invalidate_on_commit(self.session, thread_uuid)
+
+    async def archive_threads(self, inactive_before: Optional[datetime] = None,
+                              deleted_before: Optional[datetime] = None, after_id: int = 0,
+                              batch_size: int = ARCHIVE_BATCH_SIZE) -> Optional[int]:
+        """
+        Move the next ``batch_size`` threads with an id above ``after_id`` that had no message since
+        ``inactive_before``, or were soft deleted before ``deleted_before``, to the archive tables along with
+        their messages and summaries. Threads locked by another transaction are left for a later run.
+        Returns the last thread id moved, or None once there is nothing left.
+        """
+        conditions = []
+        if inactive_before is not None:
+            conditions.append(Thread.last_message_at < inactive_before)
+        if deleted_before is not None:
+            conditions.append(and_(Thread.is_deleted == True, Thread.updated_at < deleted_before))
+        if not conditions:
+            raise ValueError("Give inactive_before and/or deleted_before")
+        query = select(Thread.id, Thread.uuid).where(Thread.id > after_id, or_(*conditions)).order_by(
+            Thread.id).limit(batch_size).with_for_update(skip_locked=True)
+        rows = (await self._execute_query(query)).all()
+        if not rows:
+            return None
+        await self._move_threads([thread_uuid for _, thread_uuid in rows], to_archive=True)
+        return rows[-1][0]
+
+    async def restore_archived_threads(self, thread_uuids: Iterable[UUID]) -> List[UUID]:
+        """Move archived threads back to the hot tables. Returns the ones moved."""
+        thread_uuids = list(thread_uuids)
+        if not thread_uuids:
+            return []
+        query = select(ThreadArchive.uuid).where(ThreadArchive.uuid.in_(thread_uuids)).with_for_update()
+        found = list((await self._execute_query(query)).scalars().all())
+        if found:
+            await self._move_threads(found, to_archive=False)
+        return found
+
+    async def restore_for_write(self, thread_uuids: Iterable[UUID]) -> List[UUID]:
+        """
+        Make sure ``thread_uuids`` stay in the hot tables until the transaction ends, before messages are written
+        to them. Hot threads are locked ``FOR KEY SHARE``: an archive run skips them, or finishes first and the
+        thread is then found in the archive. Archived threads are moved back. Returns the ones restored.
+        """
+        thread_uuids = list(dict.fromkeys(thread_uuids))
+        if not thread_uuids:
+            return []
+        query = select(Thread.uuid).where(Thread.uuid.in_(thread_uuids)).with_for_update(read=True, key_share=True)
+        hot = set((await self._execute_query(query)).scalars().all())
+        archived = [thread_uuid for thread_uuid in thread_uuids if thread_uuid not in hot]
+        return await self.restore_archived_threads(archived) if archived else []
+
+    async def get_archived_thread(self, thread_uuid: UUID) -> Optional[ThreadSchema]:
+        query = select(*[getattr(ThreadArchive, field) for field in THREAD_FIELDS]).where(
+            ThreadArchive.uuid == thread_uuid)
+        row = (await self._execute_query(query)).first()
+        return ThreadSchema.model_validate(trusted_row_to_dict(row)) if row is not None else None
+
+    async def get_archived_messages(self, thread_uuid: UUID, roles: Optional[List[str]] = None,
+                                    fast: bool = False) -> List[ThreadMessageSchema]:
+        columns = [getattr(ThreadMessageArchive, field) for field in THREAD_MESSAGE_FIELDS]
+        columns += [getattr(ThreadMessageArchive, hash_field) for hash_field in BLOB_FIELDS.values()]
+        query = select(*columns).where(ThreadMessageArchive.thread_uuid == thread_uuid).order_by(
+            ThreadMessageArchive.id)
+        if roles:
+            query = query.where(ThreadMessageArchive.role.in_(roles))
+        result = await self._execute_query(query)
+        rows = await get_blob_store().resolve_rows(ThreadMessageBlobDao(self.session),
+                                                   [trusted_row_to_dict(row) for row in result.all()])
+        if fast:
+            return self._serialized([ThreadMessageSchema.model_construct(**row) for row in rows])
+        return self._serialized([ThreadMessageSchema.model_validate(row) for row in rows])
@@ -1,11 +1,16 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, JSON, Enum as SQLAEnum, Index
-from sqlalchemy.orm import relationship, Mapped
-from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, JSON, Enum as SQLAEnum, Index, DateTime, Table
+from sqlalchemy import event, func, inspect, literal, literal_column
+from sqlalchemy.orm import relationship, Mapped, deferred
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
+from sqlalchemy.dialects.postgresql import UUID, TSVECTOR
 
 import uuid
 
-from chat_threads.utils.constants import Role, FynixProducts
-from chat_threads.utils.orm_utils import Base, TimestampMixin
+from chat_threads.utils.compression import (
+    CompressedDisplayText, CompressedJSONB, CompressedText, CONTENT_REFERENCE, compression_enabled
+)
+from chat_threads.utils.constants import Role, FynixProducts, SEARCH_TEXT_CONFIG, THREAD_PREVIEW_LENGTH
+from chat_threads.utils.orm_utils import Base, TimestampMixin, get_current_time
 
 
 class Thread(Base, TimestampMixin):
@@ -21,43 +26,176 @@ class Thread(Base, TimestampMixin):
     meta = Column(JSON, default={})
     last_message_id = Column(Integer, nullable=True)
     org_id = Column(String, nullable=True, index=True)
+    # Maintained with every message insert, see ThreadDao.record_new_messages
+    message_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # The creation time until the first message, so activity listings and their cursors never meet a NULL
+    last_message_at = Column(DateTime(timezone=True), nullable=False, default=get_current_time,
+                             server_default=func.now())
+    last_message_preview = Column(String(THREAD_PREVIEW_LENGTH), nullable=True)
 
     messages = relationship("ThreadMessage", back_populates="thread")
 
-    __table_args__ = (
-        Index('ix_thread_user_email_product_is_deleted', 'user_email', 'product', 'is_deleted'),
-    )
+
+# Listings only ever read live threads, so the listing indexes leave deleted ones out. Each one matches the
+# filters and the ORDER BY of its query column for column; benchmarks/plan_check.py keeps them honest.
+
+# One owner's threads (an org's, or personal ones with org_id IS NULL) newest first, see
+# ThreadDao._get_threads_query; id breaks ties for the keyset cursor
+Index('ix_thread_user_created_at', Thread.user_email, Thread.product, Thread.org_id,
+      Thread.created_at.desc(), Thread.id.desc(), postgresql_where=Thread.is_deleted == False)
+# The same sorted by activity
+Index('ix_thread_user_last_activity', Thread.user_email, Thread.product, Thread.org_id,
+      Thread.last_message_at.desc(), Thread.id.desc(), postgresql_where=Thread.is_deleted == False)
+# A user's threads over all their orgs, see ThreadDao.get_threads_by_user_email
+Index('ix_thread_user_all_orgs_created_at', Thread.user_email, Thread.product, Thread.created_at.desc(),
+      postgresql_where=Thread.is_deleted == False)
+# Recently active threads, scanned by the summarization scheduler
+Index('ix_thread_last_message_at', Thread.last_message_at, postgresql_where=Thread.is_deleted == False)
 
 
 class ThreadMessage(TimestampMixin, Base):
     __tablename__ = 'thread_message'
 
     id = Column(Integer, primary_key=True)
-    thread_uuid = Column(UUID(as_uuid=True), ForeignKey('thread.uuid'), index=True)
+    thread_uuid = Column(UUID(as_uuid=True), ForeignKey('thread.uuid'))
     parent_message_id = Column(Integer, ForeignKey('thread_message.id'), nullable=True)
-    content = Column(String)
+    # Stored compressed above a size threshold once chat_threads.utils.compression is configured
+    content = Column(CompressedText(field="content"))
     role = Column(SQLAEnum(Role))
-    display_text = Column(String)
+    display_text = Column(CompressedDisplayText(field="display_text"))
     is_json = Column(Boolean, default=False)
     is_disliked = Column(Boolean, nullable=True)
     is_deleted = Column(Boolean, default=False)
+    # Set while an assistant response is still being appended, see threads/streaming.py
+    is_streaming = Column(Boolean, nullable=False, default=False, server_default='false')
     user_id = Column(Integer, nullable=True)
     # meta = Column(JSON, default={})
-    question_config = Column(JSONB, default={})
-    prompt_details = Column(JSONB, default={})
+    question_config = Column(CompressedJSONB(field="question_config"), default={})
+    prompt_details = Column(CompressedJSONB(field="prompt_details"), default={})
+    # Set instead of the two columns above when the payload lives in thread_message_blob, see threads/blobs.py
+    question_config_hash = Column(String(64), ForeignKey('thread_message_blob.hash'), nullable=True)
+    prompt_details_hash = Column(String(64), ForeignKey('thread_message_blob.hash'), nullable=True)
+    # Built from the plain text before it is compressed, see to_search_vector; only loaded when explicitly
+    # asked for. Derived columns are left out of exports and recomputed on import.
+    search_vector = deferred(Column(TSVECTOR, info={"derived": True}))
 
     # user = relationship("User", back_populates="thread_messages")
     thread = relationship("Thread", back_populates="messages")
     summary = relationship("ThreadMessageSummary", back_populates="message", uselist=False)
 
+    __table_args__ = (
+        Index('ix_thread_message_search_vector', 'search_vector', postgresql_using='gin'),
+        # Messages of a thread in id order, for every per-thread read. The flags make counting a thread's
+        # live, finished messages (SummarizationScheduler) an index-only scan.
+        Index('ix_thread_message_thread_uuid_id', 'thread_uuid', 'id',
+              postgresql_include=['is_deleted', 'is_streaming']),
+    )
+
+
+class ThreadMessageBlob(Base):
+    __tablename__ = 'thread_message_blob'
+
+    # sha256 of the canonical JSON of value
+    hash = Column(String(64), primary_key=True)
+    value = Column(CompressedJSONB(field="blob"), nullable=False)
+    created_at = Column(DateTime(timezone=True), default=get_current_time)
+
+
+def message_search_text(content, display_text) -> str:
+    """The text ``search_vector`` indexes: the content, and the display text when it says something else."""
+    if display_text is None or display_text is CONTENT_REFERENCE or display_text == content:
+        return content or ""
+    return f"{content or ''} {display_text}"
+
+
+def to_search_vector(search_text):
+    """The ``search_vector`` of ``search_text``, a plain string or a SQL expression of one."""
+    if isinstance(search_text, str):
+        search_text = literal(search_text, String())
+    return func.to_tsvector(literal_column(f"'{SEARCH_TEXT_CONFIG}'::regconfig"), search_text)
+
+
+@event.listens_for(ThreadMessage, "before_insert")
+def _index_new_message(mapper, connection, target):
+    target.search_vector = to_search_vector(message_search_text(target.content, target.display_text))
+
+
+@event.listens_for(ThreadMessage, "before_update")
+def _reindex_changed_message(mapper, connection, target):
+    attrs = inspect(target).attrs
+    if attrs.content.history.has_changes() or attrs.display_text.history.has_changes():
+        target.search_vector = to_search_vector(message_search_text(target.content, target.display_text))
+
+
+@event.listens_for(ThreadMessage, "before_insert")
+@event.listens_for(ThreadMessage, "before_update")
+def _reference_display_text(mapper, connection, target):
+    if not compression_enabled():
+        return
+    if inspect(target).attrs.content.history.has_changes():
+        # A stored reference would follow the new content, write display_text out again
+        flag_modified(target, "display_text")
+    if target.display_text is not None and target.display_text == target.content:
+        target.display_text = CONTENT_REFERENCE
+
+
+@event.listens_for(ThreadMessage, "after_insert")
+@event.listens_for(ThreadMessage, "after_update")
+def _resolve_display_text(mapper, connection, target):
+    if target.display_text is CONTENT_REFERENCE:
+        set_committed_value(target, "display_text", target.content)
+
 
 class ThreadMessageSummary(TimestampMixin, Base):
     __tablename__ = 'thread_message_summary'
 
     uuid = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    thread_uuid = Column(UUID(as_uuid=True), ForeignKey('thread.uuid'), index=True)
+    thread_uuid = Column(UUID(as_uuid=True), ForeignKey('thread.uuid'))
     thread_message_id = Column(Integer, ForeignKey('thread_message.id'), nullable=True)
     summary = Column(String)
 
     # Relationship back to the summarized message
-    message = relationship("ThreadMessage", back_populates="summary")
\ No newline at end of file
+    message = relationship("ThreadMessage", back_populates="summary")
+
+    __table_args__ = (
+        # One summary per message, the conflict target of ThreadMessageSummaryDao.bulk_upsert_summaries
+        Index('ix_thread_message_summary_thread_message_id', 'thread_message_id', unique=True),
+        # A thread's summaries, and its latest summarized message without touching the table
+        Index('ix_thread_message_summary_thread_uuid_message_id', 'thread_uuid', 'thread_message_id'),
+    )
+
+def _archive_table(model, name: str, *indexes) -> Table:
+    """
+    Cold copy of ``model``'s table, see ``ThreadArchiveDao``: the same columns and column types (so compressed
+    values stay compressed, and search vectors go along), minus foreign keys and the hot table's indexes.
+    """
+    columns = [Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False,
+                      nullable=column.nullable)
+               for column in model.__table__.columns]
+    return Table(name, Base.metadata, *columns,
+                 Column('archived_at', DateTime(timezone=True), nullable=False, default=get_current_time),
+                 *indexes)
+
+
+class ThreadArchive(Base):
+    __table__ = _archive_table(
+        Thread, 'thread_archive',
+        Index('ix_thread_archive_uuid', 'uuid', unique=True),
+        Index('ix_thread_archive_user_email_product', 'user_email', 'product'),
+        # Exports of an org, see ThreadDao.stream_threads
+        Index('ix_thread_archive_org_id', 'org_id'),
+    )
+
+
+class ThreadMessageArchive(Base):
+    __table__ = _archive_table(
+        ThreadMessage, 'thread_message_archive',
+        Index('ix_thread_message_archive_thread_uuid', 'thread_uuid', 'id'),
+    )
+
+
+class ThreadMessageSummaryArchive(Base):
+    __table__ = _archive_table(
+        ThreadMessageSummary, 'thread_message_summary_archive',
+        Index('ix_thread_message_summary_archive_thread_uuid', 'thread_uuid'),
+    )
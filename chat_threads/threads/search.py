@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import math
+import re
+from collections import defaultdict
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from uuid import UUID
+
+from chat_threads.threads.dao import ThreadDao
+from chat_threads.threads.models import message_search_text
+from chat_threads.utils.orm_utils import pending_until_commit
+from chat_threads.utils.pagination import build_pagination
+
+logger = logging.getLogger(__name__)
+
+PENDING_SEARCH_INDEX_KEY = "chat_threads_pending_search_index"
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def _product_key(product) -> str:
+    return str(getattr(product, "value", product))
+
+
+class IndexedMessage(NamedTuple):
+    """The fields of a message a search index reads, captured when it is written."""
+    thread_uuid: UUID
+    content: Optional[str]
+    display_text: Optional[str]
+
+
+class SearchBackend:
+    """
+    Interface used by ``ThreadService`` to keep a search index over message
+    ``content``/``display_text`` and to run ranked, per thread, paginated searches.
+    Every write path (``ThreadService``, ``BatchedMessageWriter``, ``StreamingMessage`` and the importer) hands
+    its messages to ``index_on_commit``, so the index only sees committed messages.
+    """
+
+    # False for backends whose index is maintained by the database itself
+    keeps_index = True
+
+    async def index_message(self, thread_message, user_email: str, product: str, org_id: Optional[str] = None):
+        raise NotImplementedError
+
+    def index_on_commit(self, session, thread_message, user_email: str, product: str, org_id: Optional[str] = None):
+        """
+        Index ``thread_message`` once the transaction of ``session`` commits; forgotten if it rolls back.
+        Its fields are read now, committed ORM objects are expired.
+        """
+        if not self.keeps_index:
+            return
+        indexed_message = IndexedMessage(thread_message.thread_uuid, thread_message.content,
+                                         thread_message.display_text)
+        pending_until_commit(session, self, PENDING_SEARCH_INDEX_KEY, list, self._index_committed).append(
+            (indexed_message, user_email, product, org_id))
+
+    async def index_messages_on_commit(self, session, thread_dao: ThreadDao, messages: Iterable[IndexedMessage]):
+        """
+        ``index_on_commit`` for messages whose thread owners are not at hand; they are read with one query.
+        Messages of deleted threads are left out, like ``rebuild`` does.
+        """
+        if not self.keeps_index:
+            return
+        messages = list(messages)
+        if not messages:
+            return
+        result = await thread_dao.bulk_get_threads({message.thread_uuid for message in messages}, fast=True)
+        threads = {thread.uuid: thread for thread in result.threads}
+        for message in messages:
+            thread = threads.get(message.thread_uuid)
+            if thread is not None:
+                self.index_on_commit(session, message, user_email=thread.user_email, product=thread.product,
+                                     org_id=thread.org_id)
+
+    def _index_committed(self, entries: list):
+        """Runs inside the commit, so the messages are indexed by a background task."""
+        task = asyncio.ensure_future(self._index_entries(list(entries)))
+        task.add_done_callback(self._log_index_failure)
+
+    async def _index_entries(self, entries: list):
+        for thread_message, user_email, product, org_id in entries:
+            await self.index_message(thread_message, user_email=user_email, product=product, org_id=org_id)
+
+    @staticmethod
+    def _log_index_failure(task: asyncio.Future):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to index committed thread messages", exc_info=task.exception())
+
+    async def rebuild(self, search_rows: AsyncIterator[list]) -> int:
+        """
+        Index the chunks of ``ThreadMessageDao.stream_search_rows`` (of every shard, one after the other), e.g. to
+        fill an in-process index after a restart. Returns the number of messages read.
+        """
+        indexed = 0
+        try:
+            async for rows in search_rows:
+                for row in rows:
+                    await self.index_message(IndexedMessage(row.thread_uuid, row.content, row.display_text),
+                                             user_email=row.user_email, product=row.product, org_id=row.org_id)
+                indexed += len(rows)
+        finally:
+            await search_rows.aclose()
+        return indexed
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Uses the ``thread_message.search_vector`` column and its GIN index. The DAOs write the column with every
+    message, so indexing is a no-op here.
+    """
+
+    keeps_index = False
+
+    async def index_message(self, thread_message, user_email: str, product: str, org_id: Optional[str] = None):
+        return None
+
+    async def remove_thread(self, thread_uuid: UUID):
+        return None
+
+    async def reindex_threads(self, thread_dao: ThreadDao, thread_uuids: List[UUID]):
+        return None
+
+    async def rebuild(self, search_rows: AsyncIterator[list]) -> int:
+        await search_rows.aclose()
+        return 0
+
+    async def search(self, thread_dao: ThreadDao, query: str, user_email: str, product: str, page: int,
+                     page_size: int, org_id: Optional[str] = None):
+        return await thread_dao.search_threads_ranked(query, user_email, product, page, page_size, org_id=org_id)
+
+
+class InMemorySearchBackend(SearchBackend):
+    """
+    In-process inverted index for backends without full-text search support.
+    Postings are partitioned by ``(user_email, product, org_id)`` so a search only touches
+    the caller's own threads. Matching threads are re-read from the database, which drops
+    deleted threads. The index lives in the process: call ``ThreadService.rebuild_search_index`` when it starts.
+    """
+
+    def __init__(self):
+        self._postings, self._thread_scopes = self._empty_index()
+        # Messages committed while a rebuild reads the table, added to the new index as well
+        self._committed_during_rebuild: Optional[list] = None
+
+    @staticmethod
+    def _empty_index():
+        postings: Dict[Tuple[str, str, Optional[str]], Dict[str, Dict[UUID, int]]] = defaultdict(
+            lambda: defaultdict(lambda: defaultdict(int))
+        )
+        thread_scopes: Dict[UUID, Tuple[str, str, Optional[str]]] = {}
+        return postings, thread_scopes
+
+    @staticmethod
+    def _add(postings, thread_scopes, thread_message, user_email: str, product: str, org_id: Optional[str]):
+        scope = (user_email, _product_key(product), org_id or None)
+        thread_uuid = thread_message.thread_uuid
+        scope_postings = postings[scope]
+        for term in tokenize(message_search_text(thread_message.content, thread_message.display_text)):
+            scope_postings[term][thread_uuid] += 1
+        thread_scopes[thread_uuid] = scope
+
+    async def index_message(self, thread_message, user_email: str, product: str, org_id: Optional[str] = None):
+        self._add(self._postings, self._thread_scopes, thread_message, user_email, product, org_id)
+
+    def _index_committed(self, entries: list):
+        for thread_message, user_email, product, org_id in entries:
+            self._add(self._postings, self._thread_scopes, thread_message, user_email, product, org_id)
+        if self._committed_during_rebuild is not None:
+            self._committed_during_rebuild.extend(entries)
+
+    async def rebuild(self, search_rows: AsyncIterator[list]) -> int:
+        """Build a new index from ``search_rows`` and swap it in; searches use the old one until then."""
+        postings, thread_scopes = self._empty_index()
+        indexed = 0
+        self._committed_during_rebuild = []
+        try:
+            async for rows in search_rows:
+                for row in rows:
+                    self._add(postings, thread_scopes, IndexedMessage(row.thread_uuid, row.content, row.display_text),
+                              row.user_email, row.product, row.org_id)
+                indexed += len(rows)
+            for thread_message, user_email, product, org_id in self._committed_during_rebuild:
+                self._add(postings, thread_scopes, thread_message, user_email, product, org_id)
+        finally:
+            self._committed_during_rebuild = None
+            await search_rows.aclose()
+        self._postings, self._thread_scopes = postings, thread_scopes
+        return indexed
+
+    async def remove_thread(self, thread_uuid: UUID):
+        scope = self._thread_scopes.pop(thread_uuid, None)
+        if scope is None:
+            return
+        postings = self._postings[scope]
+        for term in list(postings):
+            postings[term].pop(thread_uuid, None)
+            if not postings[term]:
+                del postings[term]
+
+    def _rank(self, query: str, scope) -> List[Tuple[UUID, float, int]]:
+        terms = set(tokenize(query))
+        postings = self._postings.get(scope)
+        if not terms or not postings or any(term not in postings for term in terms):
+            return []
+
+        # Every term has to match, the same as plainto_tsquery
+        candidates = set.intersection(*(set(postings[term]) for term in terms))
+        ranked = []
+        for thread_uuid in candidates:
+            frequencies = [postings[term][thread_uuid] for term in terms]
+            score = sum(1 + math.log(frequency) for frequency in frequencies)
+            ranked.append((thread_uuid, score, min(frequencies)))
+        ranked.sort(key=lambda item: item[1], reverse=True)
+        return ranked
+
+    async def search(self, thread_dao: ThreadDao, query: str, user_email: str, product: str, page: int,
+                     page_size: int, org_id: Optional[str] = None):
+        ranked = self._rank(query, (user_email, _product_key(product), org_id or None))
+        if page_size > 0:
+            page_items = ranked[(page - 1) * page_size:page * page_size]
+        else:
+            page_items = ranked
+
+        scores = {thread_uuid: (score, matches) for thread_uuid, score, matches in page_items}
+        threads = (await thread_dao.bulk_get_threads([thread_uuid for thread_uuid, _, _ in page_items])).threads
+        results = [
+            {**thread.model_dump(), "rank": scores[thread.uuid][0], "match_count": scores[thread.uuid][1]}
+            for thread in threads
+        ]
+        return {"threads": results, "pagination": build_pagination(len(ranked), page, page_size)}
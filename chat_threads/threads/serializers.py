@@ -1,8 +1,9 @@
+from enum import Enum
 from uuid import UUID
 from datetime import datetime
 
 from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List
 
 
 class CreateThreadRequest(BaseModel):
@@ -27,6 +28,18 @@ class CreateMessageRequest(BaseModel):
     question_config: Optional[dict] = None
     prompt_details: Optional[dict] = None
 
+    def to_message_values(self) -> dict:
+        return {
+            "content": self.content,
+            "role": self.role,
+            "display_text": self.display_text or self.content,
+            "thread_uuid": self.thread_id,
+            "parent_message_id": self.parent_message_id or None,
+            "is_json": self.is_json,
+            "question_config": self.question_config or None,
+            "prompt_details": self.prompt_details or {}
+        }
+
 class ThreadSchema(BaseModel):
     id: int
     uuid: UUID
@@ -40,6 +53,9 @@ class ThreadSchema(BaseModel):
     is_deleted: bool
     meta: Optional[Dict[str, Any]] = None
     org_id: Optional[str] = None
+    message_count: int = 0
+    last_message_at: Optional[datetime] = None
+    last_message_preview: Optional[str] = None
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -56,6 +72,58 @@ class ThreadMessageSchema(BaseModel):
     is_json: bool = False
     is_disliked: Optional[bool] = None
     is_deleted: bool = False
+    is_streaming: bool = False
     user_id: Optional[int] = None
     question_config: Optional[dict] = None
-    prompt_details: Optional[dict] = None
\ No newline at end of file
+    prompt_details: Optional[dict] = None
+
+
+THREAD_FIELDS = tuple(ThreadSchema.model_fields)
+THREAD_LIGHT_FIELDS = tuple(field for field in THREAD_FIELDS if field != "meta")
+THREAD_MESSAGE_FIELDS = tuple(ThreadMessageSchema.model_fields)
+
+
+def trusted_row_to_dict(row) -> dict:
+    """
+    Turn a Core row read from our own tables into a plain dict without any validation.
+    Enum members become their values, the rest is left as the driver returned it.
+    """
+    return {key: value.value if isinstance(value, Enum) else value for key, value in row._mapping.items()}
+
+
+class BulkThreadsResult(BaseModel):
+    threads: List[ThreadSchema]
+    missing: List[UUID] = []
+
+
+class BulkThreadUpdateResult(BaseModel):
+    updated: List[UUID]
+    missing: List[UUID] = []
+
+
+class BulkSummaryUpsertResult(BaseModel):
+    created: List[int]
+    updated: List[int]
+
+
+class ContextItem(BaseModel):
+    message_id: int
+    role: str
+    content: str
+    is_summary: bool = False
+    tokens: int
+
+
+class SummaryRequest(BaseModel):
+    """What a summarizer gets: the messages after ``previous_summary``, oldest first, up to ``message_id``."""
+    thread_uuid: UUID
+    message_id: int
+    previous_summary: Optional[str] = None
+    messages: List[ContextItem]
+
+
+class ThreadContext(BaseModel):
+    items: List[ContextItem]
+    total_tokens: int
+    budget: int
+    truncated: bool = False
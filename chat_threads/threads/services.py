@@ -1,36 +1,115 @@
+import logging
 import uuid
-from typing import List, Optional
+from datetime import timedelta
+from typing import Callable, Iterable, List, Optional, Tuple
 
-from chat_threads.threads.dao import ThreadDao, ThreadMessageDao
-from chat_threads.threads.serializers import CreateThreadRequest, CreateMessageRequest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from chat_threads.threads.blobs import get_blob_store, keep_blob_values
+from chat_threads.threads.dao import (
+    ThreadDao, ThreadMessageDao, ThreadMessageSummaryDao, ThreadMessageBlobDao, ThreadArchiveDao
+)
+from chat_threads.threads.serializers import CreateThreadRequest, CreateMessageRequest, ThreadSchema
+from chat_threads.threads.cache import ThreadCache
+from chat_threads.threads.context import TokenCounter, assemble_context, count_characters
+from chat_threads.threads.search import SearchBackend, PostgresSearchBackend
+from chat_threads.threads.streaming import StreamingMessage
+from chat_threads.threads.summarization import SummarizationScheduler
 
 from chat_threads.threads.models import Thread
+from chat_threads.utils.compression import get_compression_stats
+from chat_threads.utils.constants import ARCHIVE_BATCH_SIZE, EXPORT_CHUNK_SIZE, STREAMING_FLUSH_BYTES, STREAMING_FLUSH_INTERVAL, ThreadSortOrder
+from chat_threads.utils.orm_utils import get_current_time
+from chat_threads.utils.pagination import search_with_cursor
+from chat_threads.utils.routing import ReadYourWritesTracker
+
+logger = logging.getLogger(__name__)
+
 
 class ThreadService:
 
-    def __init__(self, connection_handler):
+    def __init__(self, connection_handler, search_backend: Optional[SearchBackend] = None,
+                 thread_cache: Optional[ThreadCache] = None, reader_session=None,
+                 consistency: Optional[ReadYourWritesTracker] = None,
+                 uuid_factory: Callable[[], uuid.UUID] = uuid.uuid4,
+                 summary_scheduler: Optional[SummarizationScheduler] = None):
+        """
+        ``reader_session`` (or ``connection_handler.reader_session``) points read-only methods at a replica.
+        With a ``consistency`` tracker, reads for a user or thread written through this service stay on the
+        primary until the session commits and the replica has caught up. ``uuid_factory`` makes the uuids of
+        new threads.
+        With a ``summary_scheduler``, threads that get new messages are checked for summarization once the
+        session commits.
+        """
         self.connection_handler = connection_handler
-        self.thread_dao = ThreadDao(session=connection_handler.session)
+        self.uuid_factory = uuid_factory
+        self.summary_scheduler = summary_scheduler
+        self.thread_dao = ThreadDao(session=connection_handler.session, thread_cache=thread_cache)
         self.thread_message_dao = ThreadMessageDao(session=connection_handler.session)
+        self.thread_message_summary_dao = ThreadMessageSummaryDao(session=connection_handler.session)
+        self.search_backend = search_backend or PostgresSearchBackend()
+        self.consistency = consistency
+
+        self.reader_session = reader_session or getattr(connection_handler, "reader_session", None)
+        if self.reader_session is None or self.reader_session is connection_handler.session:
+            self.reader_session = None
+            self.thread_reader_dao = self.thread_dao
+            self.thread_message_reader_dao = self.thread_message_dao
+        else:
+            # Replica rows may lag: the cache is only filled from the primary and by committed writes
+            self.thread_reader_dao = ThreadDao(session=self.reader_session, thread_cache=thread_cache,
+                                               fill_cache=False)
+            self.thread_message_reader_dao = ThreadMessageDao(session=self.reader_session)
+
+    @staticmethod
+    def _user_key(user_email: str):
+        return "user", user_email
+
+    @staticmethod
+    def _thread_key(thread_uuid: uuid.UUID):
+        return "thread", str(thread_uuid)
+
+    def _record_write(self, *keys):
+        if self.consistency is not None:
+            self.consistency.record_write_on_commit(self.connection_handler.session, *keys)
+
+    async def _use_primary(self, *keys) -> bool:
+        if self.reader_session is None:
+            return True
+        if self.consistency is None:
+            return False
+        if self.consistency.written_in(self.connection_handler.session, *keys):
+            # Not committed yet: only the writing session sees it
+            return True
+        return await self.consistency.requires_primary(self.reader_session, *keys)
+
+    async def _thread_reader(self, *keys) -> ThreadDao:
+        return self.thread_dao if await self._use_primary(*keys) else self.thread_reader_dao
+
+    async def _message_reader(self, *keys) -> ThreadMessageDao:
+        return self.thread_message_dao if await self._use_primary(*keys) else self.thread_message_reader_dao
 
     async def update_thread(self, thread_id: uuid.UUID, update_thread_request: CreateThreadRequest):
         update_values = {}
         for attr, value in vars(update_thread_request).items():
             if value is not None:
                 update_values[attr] = value
-        return await self.thread_dao.update_thread(thread_uuid=thread_id,
-                                                   update_values_dict=update_values)
+        result = await self.thread_dao.update_thread(thread_uuid=thread_id,
+                                                     update_values_dict=update_values)
+        self._record_write(self._thread_key(thread_id))
+        return result
 
     async def create_thread(self, create_thread_request: CreateThreadRequest):
         thread = self.thread_dao.add_object({
             "title": create_thread_request.title or "New Chat",
-            "uuid": uuid.uuid4(),
+            "uuid": self.uuid_factory(),
             "user_email": create_thread_request.requested_by,
             "user_id": create_thread_request.user_id or None,
             "product": create_thread_request.product,
             "meta": create_thread_request.meta or {},
             "org_id": create_thread_request.org_id or None
         })
+        self._record_write(self._user_key(thread.user_email), self._thread_key(thread.uuid))
         return thread
 
     async def create_thread_message(self, create_message_request: CreateMessageRequest, user_email: str, org_id: Optional[str] = None):
@@ -44,41 +123,260 @@ class ThreadService:
                 org_id=org_id
             ))
             create_message_request.thread_id = thread.uuid
-        thread_message = self.thread_message_dao.add_object({
-            "content": create_message_request.content,
-            "role": create_message_request.role,
-            "display_text": create_message_request.display_text or create_message_request.content,
-            "thread_uuid": create_message_request.thread_id,
-            "parent_message_id": create_message_request.parent_message_id or None,
-            "is_json": create_message_request.is_json,
-            "question_config": create_message_request.question_config or None,
-            "prompt_details": create_message_request.prompt_details or {}
-        })
+        else:
+            # Keep the thread out of a running archive batch, or bring it back if it was archived already
+            await ThreadArchiveDao(self.connection_handler.session, thread_cache=self.thread_dao.thread_cache
+                                   ).restore_for_write([create_message_request.thread_id])
+        message_values = create_message_request.to_message_values()
+        stored_values = await get_blob_store().dedupe(ThreadMessageBlobDao(self.connection_handler.session),
+                                                      [dict(message_values)])
+        thread_message = self.thread_message_dao.add_object(stored_values[0])
+        await self.thread_message_dao._flush()
+        keep_blob_values(thread_message, message_values)
+        await self.thread_dao.record_new_messages([(thread_message.id, thread_message.thread_uuid,
+                                                    thread_message.created_at, thread_message.display_text)])
+        self.search_backend.index_on_commit(self.connection_handler.session, thread_message, user_email=user_email,
+                                            product=create_message_request.product, org_id=org_id)
+        if self.summary_scheduler is not None:
+            self.summary_scheduler.notify_after_commit(self.connection_handler.session, thread_message.thread_uuid)
+        self._record_write(self._user_key(user_email), self._thread_key(thread_message.thread_uuid))
         return thread_message
 
-    async def list_threads_by_email(self, user_email: str, product: str):
-        return await self.thread_dao.get_threads_by_user_email(user_email=user_email, product=product)
+    async def list_threads_by_email(self, user_email: str, product: str, fast: bool = False):
+        thread_dao = await self._thread_reader(self._user_key(user_email))
+        return await thread_dao.get_threads_by_user_email(user_email=user_email, product=product, fast=fast)
 
-    async def update_thread_message(self, thread_id: uuid.UUID, update_message_request: CreateMessageRequest):
-        thread_message = await self.thread_message_dao.get_thread_messages_by_id(thread_id)
+    async def update_thread_message(self, message_id: int, update_message_request: CreateMessageRequest):
+        thread_message = await self.thread_message_dao.get_thread_message_by_id(message_id)
 
         if thread_message:
             thread_message.content = update_message_request.content
-            thread_message.display_text = update_message_request.display_text
+            thread_message.display_text = update_message_request.display_text or update_message_request.content
+            await self.thread_message_dao._flush()
+            self._record_write(self._thread_key(thread_message.thread_uuid))
             return thread_message
         else:
-            # Handle the case where the thread message with the given UUID is not found
+            # Handle the case where the thread message with the given id is not found
             return None
 
+    async def open_message_stream(self, create_message_request: CreateMessageRequest,
+                                  session_factory: Callable[[], AsyncSession], user_email: Optional[str] = None,
+                                  flush_interval: float = STREAMING_FLUSH_INTERVAL,
+                                  flush_bytes: int = STREAMING_FLUSH_BYTES) -> StreamingMessage:
+        """
+        Start an assistant message that is appended to while it is generated, see ``StreamingMessage``.
+        Flushes commit on their own through ``session_factory``, independently of this service's session.
+        """
+        stream = await StreamingMessage.open(session_factory, create_message_request, flush_interval=flush_interval,
+                                             flush_bytes=flush_bytes, thread_cache=self.thread_dao.thread_cache,
+                                             search_backend=self.search_backend)
+        keys = [self._thread_key(stream.thread_uuid)]
+        if user_email is not None:
+            keys.append(self._user_key(user_email))
+        if self.consistency is not None:
+            # The stream committed its message through its own session already
+            self.consistency.record_write(*keys)
+        return stream
+
     async def soft_delete_thread(self, thread_uuid):
-        return await self.thread_dao.soft_delete_thread_by_uuid(thread_uuid)
+        deleted_thread = await self.thread_dao.soft_delete_thread_by_uuid(thread_uuid)
+        await self.search_backend.remove_thread(thread_uuid)
+        self._record_write(self._thread_key(thread_uuid))
+        return deleted_thread
+
+    async def get_threads(self, thread_uuids: Iterable[uuid.UUID], include_deleted: bool = False, fast: bool = False):
+        thread_uuids = list(thread_uuids)
+        thread_dao = await self._thread_reader(*[self._thread_key(thread_uuid) for thread_uuid in thread_uuids])
+        return await thread_dao.bulk_get_threads(thread_uuids, include_deleted=include_deleted, fast=fast)
+
+    def _record_bulk_write(self, result, user_email: Optional[str]):
+        keys = [self._thread_key(thread_uuid) for thread_uuid in result.updated]
+        if user_email is not None:
+            keys.append(self._user_key(user_email))
+        self._record_write(*keys)
+
+    async def soft_delete_threads(self, thread_uuids: Optional[Iterable[uuid.UUID]] = None,
+                                  user_email: Optional[str] = None, org_id: Optional[str] = None,
+                                  product: Optional[str] = None):
+        result = await self.thread_dao.bulk_soft_delete_threads(thread_uuids, user_email=user_email,
+                                                                org_id=org_id, product=product)
+        for thread_uuid in result.updated:
+            await self.search_backend.remove_thread(thread_uuid)
+        self._record_bulk_write(result, user_email)
+        return result
+
+    async def restore_threads(self, thread_uuids: Optional[Iterable[uuid.UUID]] = None,
+                              user_email: Optional[str] = None, org_id: Optional[str] = None,
+                              product: Optional[str] = None):
+        result = await self.thread_dao.bulk_restore_threads(thread_uuids, user_email=user_email,
+                                                            org_id=org_id, product=product)
+        await self.search_backend.reindex_threads(self.thread_dao, result.updated)
+        self._record_bulk_write(result, user_email)
+        return result
+
+    async def upsert_summaries(self, summaries: Iterable[Tuple[uuid.UUID, int, str]]):
+        return await self.thread_message_summary_dao.bulk_upsert_summaries(summaries)
+
+    async def get_thread_messages(self, thread_id: uuid.UUID, fast: bool = False):
+        thread_dao = await self._thread_reader(self._thread_key(thread_id))
+        return await thread_dao.get_thread_messages(thread_id, fast=fast)
+
+    async def stream_thread_messages(self, thread_id: uuid.UUID, chunk_size: int = 100,
+                                     roles: Optional[List[str]] = None):
+        message_dao = await self._message_reader(self._thread_key(thread_id))
+        chunks = message_dao.stream_thread_messages(thread_id, chunk_size=chunk_size, roles=roles)
+        try:
+            async for messages in chunks:
+                yield messages
+        finally:
+            await chunks.aclose()
+
+    async def get_thread_messages_window(self, thread_id: uuid.UUID, limit: int = 50, since_id: Optional[int] = None,
+                                         before_id: Optional[int] = None, roles: Optional[List[str]] = None):
+        message_dao = await self._message_reader(self._thread_key(thread_id))
+        return await message_dao.get_thread_messages_window(thread_id, limit=limit, since_id=since_id,
+                                                            before_id=before_id, roles=roles)
+
+    async def get_message_branch(self, message_id: int, columns: Optional[List[str]] = None,
+                                 thread_id: Optional[uuid.UUID] = None):
+        """``thread_id`` is only used to route the read; without it the read goes to the primary."""
+        message_dao = await self._message_reader(self._thread_key(thread_id)) if thread_id else self.thread_message_dao
+        return await message_dao.get_message_ancestors(message_id, columns=columns)
+
+    async def get_message_siblings(self, message_id: int, columns: Optional[List[str]] = None,
+                                   thread_id: Optional[uuid.UUID] = None):
+        message_dao = await self._message_reader(self._thread_key(thread_id)) if thread_id else self.thread_message_dao
+        return await message_dao.get_message_siblings(message_id, columns=columns)
+
+    async def build_context(self, budget: int, thread_id: Optional[uuid.UUID] = None,
+                            leaf_message_id: Optional[int] = None, token_counter: TokenCounter = count_characters):
+        """
+        Assemble model context for a thread, or for the branch ending at ``leaf_message_id``, within ``budget``
+        as measured by ``token_counter``: recent messages verbatim and older ones replaced by their summary.
+        """
+        if thread_id is None and leaf_message_id is None:
+            raise ValueError("Either thread_id or leaf_message_id is required")
+        message_dao = await self._message_reader(self._thread_key(thread_id)) if thread_id else self.thread_message_dao
+        rows = message_dao.stream_context_rows(thread_id=thread_id, leaf_message_id=leaf_message_id)
+        try:
+            return await assemble_context(rows, budget, token_counter=token_counter)
+        finally:
+            await rows.aclose()
+
+    async def search_thread_by_content(self, query: str, email: str, product: str, org_id: Optional[str] = None):
+        """Every thread ``search_threads`` finds, best match first, as ``ThreadSchema``; prefer ``search_threads``."""
+        result = await self.search_threads(query, email, product, page=1, page_size=0, org_id=org_id)
+        return [ThreadSchema.model_validate(thread) for thread in result["threads"]]
+
+    async def search_threads(self, query: str, user_email: str, product: str, page: int = 1, page_size: int = 10,
+                             org_id: Optional[str] = None):
+        thread_dao = await self._thread_reader(self._user_key(user_email))
+        return await self.search_backend.search(thread_dao, query, user_email, product, page, page_size,
+                                                org_id=org_id)
+
+    async def rebuild_search_index(self, chunk_size: int = EXPORT_CHUNK_SIZE) -> int:
+        """
+        Fill the search backend's own index from the stored messages, e.g. an ``InMemorySearchBackend`` when the
+        process starts. Returns the number of messages read; nothing to do for ``PostgresSearchBackend``.
+        """
+        return await self.search_backend.rebuild(self.thread_message_dao.stream_search_rows(chunk_size=chunk_size))
+
+    async def get_threads_with_pagination(self, user_email: str, product: str, page: int, page_size: int, query: str=None, org_id: Optional[str] = None,
+                                          fast: bool = False, light: bool = False,
+                                          sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT) -> List[Thread]:
+        """With a ``query``, the page of ``search_threads``, which ignores ``fast``, ``light`` and ``sort_order``."""
+        if query:
+            return await self.search_threads(query, user_email, product, page=page, page_size=page_size,
+                                             org_id=org_id)
+        thread_dao = await self._thread_reader(self._user_key(user_email))
+        return await thread_dao.get_threads_with_pagination(user_email, product, page, page_size, org_id=org_id,
+                                                            fast=fast, light=light, sort_order=sort_order)
+
+    async def get_threads_with_cursor(self, user_email: str, product: str, page_size: int, cursor: Optional[str] = None,
+                                      query: str = None, org_id: Optional[str] = None,
+                                      include_total_count: bool = False, fast: bool = False, light: bool = False,
+                                      sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT):
+        """With a ``query``, the pages of ``search_threads`` behind cursors, see ``search_with_cursor``."""
+        if query:
+            return await search_with_cursor(
+                lambda page, size: self.search_threads(query, user_email, product, page=page, page_size=size,
+                                                       org_id=org_id),
+                page_size, cursor=cursor, include_total_count=include_total_count, sort_order=sort_order)
+        thread_dao = await self._thread_reader(self._user_key(user_email))
+        return await thread_dao.get_threads_with_cursor(user_email, product, page_size, cursor=cursor,
+                                                        org_id=org_id, include_total_count=include_total_count,
+                                                        fast=fast, light=light, sort_order=sort_order)
+
+    async def backfill_thread_activity(self, batch_size: int = 1000, after_id: int = 0) -> int:
+        """
+        Fill ``message_count``/``last_message_*`` for threads written before they were maintained.
+        Commits after every batch and returns the last thread id processed; pass a logged id as ``after_id``
+        to resume an interrupted run.
+        """
+        while True:
+            last_thread_id = await self.thread_dao.backfill_message_activity(after_id=after_id, batch_size=batch_size)
+            if last_thread_id is None:
+                return after_id
+            await self.thread_dao._commit()
+            logger.info("Backfilled thread activity up to thread id %s", last_thread_id)
+            after_id = last_thread_id
 
-    async def get_thread_messages(self, thread_id: uuid.UUID):
-        return await self.thread_dao.get_thread_messages(thread_id)
+    async def backfill_message_compression(self, batch_size: int = 1000, after_id: int = 0) -> int:
+        """
+        Compress the messages written before compression was configured, and store ``display_text`` equal to
+        ``content`` as a reference. Commits after every batch and returns the last message id processed;
+        pass a logged id as ``after_id`` to resume. ``get_compression_stats()`` reports the bytes saved.
+        """
+        while True:
+            last_message_id = await self.thread_message_dao.compress_messages(after_id=after_id, batch_size=batch_size)
+            if last_message_id is None:
+                return after_id
+            await self.thread_message_dao._commit()
+            logger.info("Compressed thread messages up to message id %s (%s)", last_message_id,
+                        get_compression_stats().as_dict())
+            after_id = last_message_id
 
-    async def search_thread_by_content(self, query: str, email: str, product: str):
-        return await self.thread_dao.search_in_thread_message(query, email, product)
+    async def backfill_search_vectors(self, batch_size: int = 1000, after_id: int = 0,
+                                      only_compressed: bool = True) -> int:
+        """
+        Rebuild ``search_vector`` from the plain text of messages stored compressed, which were left out of
+        search while the column was generated by the database (``only_compressed=False`` re-indexes every
+        message). Commits after every batch and returns the last message id processed; pass a logged id as
+        ``after_id`` to resume.
+        """
+        while True:
+            last_message_id = await self.thread_message_dao.index_messages(
+                after_id=after_id, batch_size=batch_size, only_compressed=only_compressed)
+            if last_message_id is None:
+                return after_id
+            await self.thread_message_dao._commit()
+            logger.info("Indexed thread messages up to message id %s", last_message_id)
+            after_id = last_message_id
 
-    async def get_threads_with_pagination(self, user_email: str, product: str, page: int, page_size: int, query: str=None, org_id: Optional[str] = None) -> List[Thread]:
+    async def archive_threads(self, inactive_for: Optional[timedelta] = None,
+                              deleted_for: Optional[timedelta] = None, batch_size: int = ARCHIVE_BATCH_SIZE,
+                              after_id: int = 0) -> int:
+        """
+        Move threads without a message for ``inactive_for``, and threads soft deleted ``deleted_for`` ago, to
+        the archive tables with their messages and summaries. Commits after every batch and returns the last
+        thread id moved; pass a logged id as ``after_id`` to resume. Archived threads stay readable through
+        ``get_thread_messages``.
+        """
+        now = get_current_time()
+        archive_dao = ThreadArchiveDao(self.connection_handler.session, thread_cache=self.thread_dao.thread_cache)
+        while True:
+            last_thread_id = await archive_dao.archive_threads(
+                inactive_before=now - inactive_for if inactive_for is not None else None,
+                deleted_before=now - deleted_for if deleted_for is not None else None,
+                after_id=after_id, batch_size=batch_size)
+            if last_thread_id is None:
+                return after_id
+            await archive_dao._commit()
+            logger.info("Archived threads up to thread id %s", last_thread_id)
+            after_id = last_thread_id
 
-        return await self.thread_dao.get_threads_with_pagination(user_email, product, page, page_size, query, org_id)
+    async def restore_archived_threads(self, thread_uuids: Iterable[uuid.UUID]) -> List[uuid.UUID]:
+        archive_dao = ThreadArchiveDao(self.connection_handler.session, thread_cache=self.thread_dao.thread_cache)
+        restored = await archive_dao.restore_archived_threads(thread_uuids)
+        self._record_write(*[self._thread_key(thread_uuid) for thread_uuid in restored])
+        return restored
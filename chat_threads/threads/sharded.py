@@ -0,0 +1,247 @@
+import asyncio
+import heapq
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from chat_threads.threads.cache import ThreadCache
+from chat_threads.threads.context import TokenCounter, count_characters
+from chat_threads.threads.dao import ThreadDao, ThreadMessageDao
+from chat_threads.threads.search import SearchBackend
+from chat_threads.threads.serializers import (BulkThreadUpdateResult, BulkThreadsResult, CreateMessageRequest,
+                                              CreateThreadRequest)
+from chat_threads.threads.services import ThreadService
+from chat_threads.utils.constants import EXPORT_CHUNK_SIZE, ThreadSortOrder
+from chat_threads.utils.exceptions import ThreadNotFoundError
+from chat_threads.utils.sharding import ShardRouter
+
+
+class ShardConnection:
+    """The connection handler ``ThreadService`` expects, for one shard session."""
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+
+class ShardedThreadService:
+    """
+    ``ThreadService`` over several databases that each hold a slice of the tenants, as placed by ``router``.
+
+    Threads live on the shard of their org, or of their user for personal threads, so listings, searches
+    and everything about one thread run on a single shard. Each call opens a session on its shard and
+    commits its writes, as one transaction per shard. Calls that span tenants (a user's threads over all
+    their orgs, admin bulk operations) query every shard concurrently and merge the results; their writes
+    commit shard by shard, not atomically.
+    """
+
+    def __init__(self, router: ShardRouter, search_backend: Optional[SearchBackend] = None,
+                 thread_cache: Optional[ThreadCache] = None):
+        self.router = router
+        self.search_backend = search_backend
+        self.thread_cache = thread_cache
+
+    def _service(self, shard: str, session: AsyncSession) -> ThreadService:
+        return ThreadService(ShardConnection(session), search_backend=self.search_backend,
+                             thread_cache=self.thread_cache,
+                             uuid_factory=lambda: self.router.new_thread_uuid(shard))
+
+    async def _run(self, shard: str, operation: Callable[[ThreadService], object], commit: bool = False):
+        async with self.router.session(shard) as session:
+            result = await operation(self._service(shard, session))
+            if commit:
+                await session.commit()
+            return result
+
+    async def _run_everywhere(self, operation: Callable[[ThreadService], object], commit: bool = False,
+                              shards: Optional[List[str]] = None) -> Dict[str, object]:
+        async def on_shard(shard: str, session: AsyncSession):
+            result = await operation(self._service(shard, session))
+            if commit:
+                await session.commit()
+            return result
+
+        return await self.router.fan_out(on_shard, shards=shards)
+
+    async def locate_thread(self, thread_uuid: uuid.UUID) -> str:
+        """
+        The shard holding ``thread_uuid``. A shard read from the uuid itself is confirmed with one indexed
+        lookup, as uuids made before sharding may look encoded; threads not found there are searched for on
+        every shard. Found locations are remembered.
+        """
+        location = self.router.locations.get(thread_uuid)
+        if location is not None:
+            return location
+        candidate = await self.router.candidate_shard(thread_uuid)
+        if candidate is not None and await self._run(candidate, lambda service: service.thread_dao.thread_exists(
+                thread_uuid)):
+            await self.router.remember(thread_uuid, candidate)
+            return candidate
+
+        other_shards = [shard for shard in self.router.shards if shard != candidate]
+        found = await self.router.fan_out(
+            lambda shard, session: ThreadDao(session).thread_exists(thread_uuid), shards=other_shards)
+        for shard in other_shards:
+            if found[shard]:
+                await self.router.remember(thread_uuid, shard)
+                return shard
+        raise ThreadNotFoundError(f"Thread {thread_uuid} not found on any shard")
+
+    def owner_shard(self, user_email: Optional[str], org_id: Optional[str] = None) -> str:
+        return self.router.shard_for_owner(org_id, user_email)
+
+    async def create_thread(self, create_thread_request: CreateThreadRequest):
+        shard = self.owner_shard(create_thread_request.requested_by, create_thread_request.org_id)
+        thread = await self._run(shard, lambda service: service.create_thread(create_thread_request), commit=True)
+        await self.router.remember(thread.uuid, shard)
+        return thread
+
+    async def create_thread_message(self, create_message_request: CreateMessageRequest, user_email: str,
+                                    org_id: Optional[str] = None):
+        if create_message_request.thread_id is None:
+            shard = self.owner_shard(user_email, org_id)
+        else:
+            shard = await self.locate_thread(create_message_request.thread_id)
+        return await self._run(shard, lambda service: service.create_thread_message(
+            create_message_request, user_email, org_id=org_id), commit=True)
+
+    async def update_thread(self, thread_id: uuid.UUID, update_thread_request: CreateThreadRequest):
+        shard = await self.locate_thread(thread_id)
+        return await self._run(shard, lambda service: service.update_thread(thread_id, update_thread_request),
+                               commit=True)
+
+    async def soft_delete_thread(self, thread_uuid: uuid.UUID):
+        shard = await self.locate_thread(thread_uuid)
+        return await self._run(shard, lambda service: service.soft_delete_thread(thread_uuid), commit=True)
+
+    async def get_thread(self, thread_id: uuid.UUID):
+        shard = await self.locate_thread(thread_id)
+        return await self._run(shard, lambda service: service.thread_dao.get_thread_by_id(thread_id))
+
+    async def get_thread_messages(self, thread_id: uuid.UUID, fast: bool = False):
+        shard = await self.locate_thread(thread_id)
+        return await self._run(shard, lambda service: service.get_thread_messages(thread_id, fast=fast))
+
+    async def get_thread_messages_window(self, thread_id: uuid.UUID, limit: int = 50, since_id: Optional[int] = None,
+                                         before_id: Optional[int] = None, roles: Optional[List[str]] = None):
+        shard = await self.locate_thread(thread_id)
+        return await self._run(shard, lambda service: service.get_thread_messages_window(
+            thread_id, limit=limit, since_id=since_id, before_id=before_id, roles=roles))
+
+    async def build_context(self, budget: int, thread_id: uuid.UUID, leaf_message_id: Optional[int] = None,
+                            token_counter: TokenCounter = count_characters):
+        """Message ids are only unique within a shard, so ``thread_id`` is required to find ``leaf_message_id``."""
+        shard = await self.locate_thread(thread_id)
+        return await self._run(shard, lambda service: service.build_context(
+            budget, thread_id=thread_id, leaf_message_id=leaf_message_id, token_counter=token_counter))
+
+    async def get_threads_with_pagination(self, user_email: str, product: str, page: int, page_size: int,
+                                          query: str = None, org_id: Optional[str] = None, fast: bool = False,
+                                          light: bool = False,
+                                          sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT):
+        return await self._run(self.owner_shard(user_email, org_id), lambda service: service.get_threads_with_pagination(
+            user_email, product, page, page_size, query=query, org_id=org_id, fast=fast, light=light,
+            sort_order=sort_order))
+
+    async def get_threads_with_cursor(self, user_email: str, product: str, page_size: int, cursor: Optional[str] = None,
+                                      query: str = None, org_id: Optional[str] = None,
+                                      include_total_count: bool = False, fast: bool = False, light: bool = False,
+                                      sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT):
+        return await self._run(self.owner_shard(user_email, org_id), lambda service: service.get_threads_with_cursor(
+            user_email, product, page_size, cursor=cursor, query=query, org_id=org_id,
+            include_total_count=include_total_count, fast=fast, light=light, sort_order=sort_order))
+
+    async def search_threads(self, query: str, user_email: str, product: str, page: int = 1, page_size: int = 10,
+                             org_id: Optional[str] = None):
+        return await self._run(self.owner_shard(user_email, org_id), lambda service: service.search_threads(
+            query, user_email, product, page=page, page_size=page_size, org_id=org_id))
+
+    async def list_threads_by_email(self, user_email: str, product: str, fast: bool = False):
+        """A user's threads in every org and their personal ones, newest first, gathered from all shards."""
+        results = await self._run_everywhere(
+            lambda service: service.list_threads_by_email(user_email, product, fast=fast))
+        return list(heapq.merge(*results.values(), key=lambda thread: thread.created_at, reverse=True))
+
+    async def search_thread_by_content(self, query: str, email: str, product: str, org_id: Optional[str] = None):
+        return await self._run(self.owner_shard(email, org_id), lambda service: service.search_thread_by_content(
+            query, email, product, org_id=org_id))
+
+    async def _group_by_shard(self, thread_uuids: List[uuid.UUID]) -> Dict[Optional[str], List[uuid.UUID]]:
+        groups: Dict[Optional[str], List[uuid.UUID]] = {}
+        for thread_uuid in thread_uuids:
+            groups.setdefault(await self.router.candidate_shard(thread_uuid), []).append(thread_uuid)
+        return groups
+
+    async def get_threads(self, thread_uuids: Iterable[uuid.UUID], include_deleted: bool = False,
+                          fast: bool = False) -> BulkThreadsResult:
+        """
+        Fetch threads from any shard with one bulk read per shard, all shards at once. Uuids that are not on
+        the shard they point to (or point to none) are then looked for on every shard.
+        """
+        thread_uuids = list(dict.fromkeys(thread_uuids))
+        found = {}
+        groups = await self._group_by_shard(thread_uuids)
+        unresolved = groups.pop(None, [])
+
+        async def fetch(shard: str, uuids: List[uuid.UUID]):
+            result = await self._run(shard, lambda service: service.get_threads(
+                uuids, include_deleted=include_deleted, fast=fast))
+            for thread in result.threads:
+                found[thread.uuid] = thread
+                self.router.locations.set(thread.uuid, shard)
+            return result.missing
+
+        for missing in await asyncio.gather(*(fetch(shard, uuids) for shard, uuids in groups.items())):
+            unresolved.extend(missing)
+        if unresolved:
+            results = await self._run_everywhere(lambda service: service.get_threads(
+                unresolved, include_deleted=include_deleted, fast=fast))
+            for shard, result in results.items():
+                for thread in result.threads:
+                    found[thread.uuid] = thread
+                    self.router.locations.set(thread.uuid, shard)
+        return BulkThreadsResult(threads=[found[thread_uuid] for thread_uuid in thread_uuids if thread_uuid in found],
+                                 missing=[thread_uuid for thread_uuid in thread_uuids if thread_uuid not in found])
+
+    @staticmethod
+    def _merge_updates(thread_uuids: Optional[List[uuid.UUID]], results: Iterable[BulkThreadUpdateResult]):
+        updated = [thread_uuid for result in results for thread_uuid in result.updated]
+        missing = []
+        if thread_uuids is not None:
+            updated_uuids = set(updated)
+            missing = [thread_uuid for thread_uuid in thread_uuids if thread_uuid not in updated_uuids]
+        return BulkThreadUpdateResult(updated=updated, missing=missing)
+
+    async def soft_delete_threads(self, thread_uuids: Optional[Iterable[uuid.UUID]] = None,
+                                  user_email: Optional[str] = None, org_id: Optional[str] = None,
+                                  product: Optional[str] = None) -> BulkThreadUpdateResult:
+        """``ThreadService.soft_delete_threads`` on every shard, e.g. to delete all of a user's threads."""
+        thread_uuids = list(thread_uuids) if thread_uuids is not None else None
+        results = await self._run_everywhere(lambda service: service.soft_delete_threads(
+            thread_uuids, user_email=user_email, org_id=org_id, product=product), commit=True)
+        return self._merge_updates(thread_uuids, results.values())
+
+    async def restore_threads(self, thread_uuids: Optional[Iterable[uuid.UUID]] = None,
+                              user_email: Optional[str] = None, org_id: Optional[str] = None,
+                              product: Optional[str] = None) -> BulkThreadUpdateResult:
+        thread_uuids = list(thread_uuids) if thread_uuids is not None else None
+        results = await self._run_everywhere(lambda service: service.restore_threads(
+            thread_uuids, user_email=user_email, org_id=org_id, product=product), commit=True)
+        return self._merge_updates(thread_uuids, results.values())
+
+    async def rebuild_search_index(self, chunk_size: int = EXPORT_CHUNK_SIZE) -> int:
+        """``ThreadService.rebuild_search_index`` over the messages of every shard, read one shard after another."""
+        if self.search_backend is None:
+            return 0
+
+        async def search_rows():
+            for shard in self.router.shards:
+                async with self.router.session(shard) as session:
+                    rows = ThreadMessageDao(session).stream_search_rows(chunk_size=chunk_size)
+                    try:
+                        async for chunk in rows:
+                            yield chunk
+                    finally:
+                        await rows.aclose()
+
+        return await self.search_backend.rebuild(search_rows())
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from typing import Callable, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from chat_threads.threads.blobs import get_blob_store
+from chat_threads.threads.cache import ThreadCache
+from chat_threads.threads.dao import ThreadArchiveDao, ThreadDao, ThreadMessageDao, ThreadMessageBlobDao
+from chat_threads.threads.search import IndexedMessage, SearchBackend
+from chat_threads.threads.serializers import CreateMessageRequest
+from chat_threads.utils.compression import CONTENT_REFERENCE, TAG
+from chat_threads.utils.constants import Role, STREAMING_FLUSH_BYTES, STREAMING_FLUSH_INTERVAL
+from chat_threads.utils.exceptions import MessageStreamClosedError
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingMessage:
+    """
+    An assistant message written while it is generated.
+
+    ``open`` inserts the message with empty content and ``is_streaming`` set. ``append`` only buffers; the
+    buffered text is appended in the database (``content = content || delta``, never a full rewrite) once
+    ``flush_bytes`` are buffered or ``flush_interval`` seconds after the previous flush. ``finalize`` writes
+    the complete message and clears ``is_streaming`` in one transaction. Every flush commits on its own, so
+    readers always see a prefix of the response, and see ``display_text`` follow ``content`` until the end.
+
+    Leaving ``async with`` finalizes the message, keeping what was generated when an exception stopped it.
+    A ``search_backend`` that keeps its own index gets the message once ``finalize`` commits.
+    """
+
+    def __init__(self, session_factory: Callable[[], AsyncSession], message_id: int, thread_uuid,
+                 flush_interval: float = STREAMING_FLUSH_INTERVAL, flush_bytes: int = STREAMING_FLUSH_BYTES,
+                 thread_cache: Optional[ThreadCache] = None, search_backend: Optional[SearchBackend] = None):
+        self.session_factory = session_factory
+        self.message_id = message_id
+        self.thread_uuid = thread_uuid
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.thread_cache = thread_cache
+        self.search_backend = search_backend
+        self.flush_count = 0
+        self.finalized = False
+        self._chunks: List[str] = []
+        self._pending: List[str] = []
+        self._pending_bytes = 0
+        self._flushed_any = False
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+
+    @classmethod
+    async def open(cls, session_factory: Callable[[], AsyncSession], create_message_request: CreateMessageRequest,
+                   flush_interval: float = STREAMING_FLUSH_INTERVAL, flush_bytes: int = STREAMING_FLUSH_BYTES,
+                   thread_cache: Optional[ThreadCache] = None,
+                   search_backend: Optional[SearchBackend] = None) -> "StreamingMessage":
+        """Insert and commit the in-progress message. ``create_message_request.content`` is its first chunk."""
+        if create_message_request.thread_id is None:
+            raise ValueError("StreamingMessage needs the thread_id of an existing thread")
+        values = create_message_request.to_message_values()
+        first_chunk = values["content"]
+        values.update(role=Role.ASSISTANT.value, content="", display_text=CONTENT_REFERENCE, is_streaming=True)
+
+        async with session_factory() as session:
+            async with session.begin():
+                message_dao = ThreadMessageDao(session=session)
+                await ThreadArchiveDao(session, thread_cache=thread_cache).restore_for_write(
+                    [values["thread_uuid"]])
+                stored_values = await get_blob_store().dedupe(ThreadMessageBlobDao(session), [values])
+                message = message_dao.add_object(stored_values[0])
+                await message_dao._flush()
+                await ThreadDao(session=session, thread_cache=thread_cache).record_new_messages(
+                    [(message.id, message.thread_uuid, message.created_at, "")])
+                message_id, thread_uuid = message.id, message.thread_uuid
+
+        stream = cls(session_factory, message_id, thread_uuid, flush_interval=flush_interval,
+                     flush_bytes=flush_bytes, thread_cache=thread_cache, search_backend=search_backend)
+        if first_chunk:
+            await stream.append(first_chunk)
+        return stream
+
+    @property
+    def content(self) -> str:
+        return "".join(self._chunks)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self.finalized:
+            # A failed background flush was logged already and is covered by the final write
+            self._error = None
+            await self.finalize()
+
+    def _check_open(self):
+        if self.finalized:
+            raise MessageStreamClosedError()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    async def append(self, chunk: str):
+        self._check_open()
+        if not chunk:
+            return
+        self._chunks.append(chunk)
+        self._pending.append(chunk)
+        self._pending_bytes += len(chunk.encode("utf-8"))
+        if self._pending_bytes >= self.flush_bytes or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(max(0.0, self._last_flush + self.flush_interval - time.monotonic()))
+            self._timer = None
+            await self.flush()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Raised from the next append or finalize
+            logger.exception("Failed to flush streaming message %s", self.message_id)
+            self._error = e
+
+    def _cancel_timer(self):
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+
+    async def flush(self):
+        """Append the buffered text to the stored message now."""
+        async with self._lock:
+            self._cancel_timer()
+            if not self._pending or self.finalized:
+                return
+            # Chunks appended while the update runs stay pending for the next flush
+            flushed_chunks = len(self._pending)
+            delta = "".join(self._pending)
+            if not self._flushed_any and delta.startswith(TAG):
+                # Stored text starting with ESC is escaped, see chat_threads.utils.compression
+                delta = TAG + delta
+            async with self.session_factory() as session:
+                async with session.begin():
+                    await ThreadMessageDao(session=session).append_content(self.message_id, delta)
+            del self._pending[:flushed_chunks]
+            self._pending_bytes = sum(len(chunk.encode("utf-8")) for chunk in self._pending)
+            self._flushed_any = True
+            self._last_flush = time.monotonic()
+            self.flush_count += 1
+
+    async def finalize(self, display_text: Optional[str] = None):
+        """Store the complete message, with ``display_text`` defaulting to the content, and close the stream."""
+        self._check_open()
+        async with self._lock:
+            self._cancel_timer()
+            content = self.content
+            display_text = display_text or content
+            async with self.session_factory() as session:
+                async with session.begin():
+                    await ThreadMessageDao(session=session).finalize_streaming_message(
+                        self.message_id, content, display_text)
+                    thread_dao = ThreadDao(session=session, thread_cache=self.thread_cache)
+                    await thread_dao.update_message_preview(self.thread_uuid, self.message_id, display_text)
+                    if self.search_backend is not None:
+                        await self.search_backend.index_messages_on_commit(
+                            session, thread_dao, [IndexedMessage(self.thread_uuid, content, display_text)])
+            self._pending, self._pending_bytes = [], 0
+            self.finalized = True
+            self.flush_count += 1
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import math
+from datetime import timedelta
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from chat_threads.threads.context import TokenCounter, count_characters
+from chat_threads.threads.dao import ThreadMessageDao, ThreadMessageSummaryDao
+from chat_threads.threads.serializers import ContextItem, SummaryRequest
+from chat_threads.utils.cache import LRUCache
+from chat_threads.utils.constants import (
+    SUMMARY_FLUSH_INTERVAL, SUMMARY_MAX_CONCURRENCY, SUMMARY_MAX_PENDING, SUMMARY_MESSAGE_THRESHOLD,
+    SUMMARY_POLL_INTERVAL, SUMMARY_SCAN_LIMIT, SUMMARY_SCAN_WINDOW, SUMMARY_WRITE_BATCH_SIZE
+)
+from chat_threads.utils.orm_utils import get_current_time, pending_until_commit
+
+logger = logging.getLogger(__name__)
+
+PENDING_NOTIFICATIONS_KEY = "chat_threads_pending_summaries"
+
+Summarizer = Callable[[SummaryRequest], Awaitable[Optional[str]]]
+
+
+class SummarizationStats:
+
+    def __init__(self):
+        self.scheduled = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.failed = 0
+        self.written = 0
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class SummarizationScheduler:
+    """
+    Summarizes threads in the background, off the request path.
+
+    A thread is due once it has ``threshold`` finished messages newer than its latest summary. Due threads are
+    found by a scan every ``poll_interval`` seconds (threads active in the last ``scan_window`` seconds) and by
+    ``notify``, which the request path calls after writing a message. A thread is queued at most once at a time:
+    a notify for a thread that is already queued is absorbed, and one for a thread being summarized queues it
+    again afterwards. At most ``max_concurrency`` calls to ``summarizer`` run at once. The queue holds
+    ``max_pending`` threads; the scan waits for room, ``notify`` never blocks and drops the thread instead,
+    leaving it to the next scan.
+
+    ``summarizer`` gets the messages of the branch ending at the newest message since the previous summary,
+    plus that summary, and returns the new one (or None to skip). Summaries are written with
+    ``bulk_upsert_summaries`` in batches of ``write_batch_size``, at most ``flush_interval`` seconds apart.
+    Whether a thread is due is always read from the database, so a restarted scheduler picks up where the
+    last one stopped and rewriting a summary is harmless.
+    """
+
+    def __init__(self, session_factory: Callable[[], AsyncSession], summarizer: Summarizer,
+                 threshold: int = SUMMARY_MESSAGE_THRESHOLD, max_concurrency: int = SUMMARY_MAX_CONCURRENCY,
+                 max_pending: int = SUMMARY_MAX_PENDING, write_batch_size: int = SUMMARY_WRITE_BATCH_SIZE,
+                 flush_interval: float = SUMMARY_FLUSH_INTERVAL, poll_interval: Optional[float] = SUMMARY_POLL_INTERVAL,
+                 scan_limit: int = SUMMARY_SCAN_LIMIT, scan_window: Optional[float] = SUMMARY_SCAN_WINDOW,
+                 token_counter: TokenCounter = count_characters):
+        self.session_factory = session_factory
+        self.summarizer = summarizer
+        self.threshold = threshold
+        self.max_concurrency = max_concurrency
+        self.write_batch_size = write_batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.scan_limit = scan_limit
+        self.scan_window = scan_window
+        self.token_counter = token_counter
+        self.stats = SummarizationStats()
+        self._queue: "asyncio.Queue[UUID]" = asyncio.Queue(maxsize=max_pending)
+        self._queued = set()
+        self._running = set()
+        self._renotified = set()
+        # Newest message of threads whose branch was too short to summarize, not worth reloading until it changes.
+        # Kept as long as the scan looks back, or until evicted when there is no scan window.
+        self._skipped_at = LRUCache(max_size=max_pending,
+                                    ttl=self.scan_window if self.scan_window is not None else math.inf)
+        self._results: List[Tuple[UUID, int, str]] = []
+        self._write_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self._poll_task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.max_concurrency)]
+        self._tasks.append(asyncio.create_task(self._flush_periodically()))
+        if self.poll_interval is not None:
+            self._poll_task = asyncio.create_task(self._poll())
+            self._tasks.append(self._poll_task)
+
+    async def close(self):
+        """Stop scanning, finish the queued threads and write every pending summary."""
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        await self.drain()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def drain(self):
+        """Wait until every queued thread is summarized and its summary written."""
+        if not self._tasks:
+            self.start()
+        await self._queue.join()
+        await self.flush()
+
+    def notify(self, thread_uuid: UUID) -> bool:
+        """Ask for ``thread_uuid`` to be checked. Returns False when it was dropped because the queue is full."""
+        if thread_uuid in self._queued:
+            self.stats.coalesced += 1
+            return True
+        if thread_uuid in self._running:
+            self._renotified.add(thread_uuid)
+            self.stats.coalesced += 1
+            return True
+        try:
+            self._queue.put_nowait(thread_uuid)
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+            return False
+        self._queued.add(thread_uuid)
+        self.stats.scheduled += 1
+        return True
+
+    def notify_after_commit(self, session: AsyncSession, thread_uuid: UUID):
+        """``notify`` once ``session`` commits, so the check sees the new messages; forgotten on rollback."""
+        pending_until_commit(session, self, PENDING_NOTIFICATIONS_KEY, set, self._notify_committed).add(thread_uuid)
+
+    def _notify_committed(self, thread_uuids: Set[UUID]):
+        for thread_uuid in thread_uuids:
+            self.notify(thread_uuid)
+
+    async def _schedule(self, thread_uuid: UUID):
+        if thread_uuid in self._queued or thread_uuid in self._running:
+            self.stats.coalesced += 1
+            return
+        self._queued.add(thread_uuid)
+        await self._queue.put(thread_uuid)
+        self.stats.scheduled += 1
+
+    async def scan(self) -> int:
+        """Queue the due threads, waiting for room in the queue. Returns how many were found."""
+        active_since = None
+        if self.scan_window is not None:
+            active_since = get_current_time() - timedelta(seconds=self.scan_window)
+        async with self.session_factory() as session:
+            candidates = await ThreadMessageSummaryDao(session).get_summarization_candidates(
+                self.threshold, active_since=active_since, limit=self.scan_limit)
+        for thread_uuid, newest_message_id, _ in candidates:
+            if self._skipped_at.get(thread_uuid) != newest_message_id:
+                await self._schedule(thread_uuid)
+        return len(candidates)
+
+    async def run_once(self) -> int:
+        """Scan, summarize everything found and write it, e.g. from a cron job. Returns the summaries written."""
+        written = self.stats.written
+        if not self._tasks:
+            self.start()
+        await self.scan()
+        await self.drain()
+        return self.stats.written - written
+
+    async def _poll(self):
+        while True:
+            try:
+                await self.scan()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to scan for threads to summarize")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _work(self):
+        while True:
+            thread_uuid = await self._queue.get()
+            self._queued.discard(thread_uuid)
+            self._running.add(thread_uuid)
+            try:
+                await self._summarize(thread_uuid)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats.failed += 1
+                logger.exception("Failed to summarize thread %s", thread_uuid)
+            finally:
+                self._running.discard(thread_uuid)
+                if thread_uuid in self._renotified:
+                    self._renotified.discard(thread_uuid)
+                    self.notify(thread_uuid)
+                self._queue.task_done()
+
+    async def _load_request(self, thread_uuid: UUID) -> Optional[SummaryRequest]:
+        async with self.session_factory() as session:
+            candidates = await ThreadMessageSummaryDao(session).get_summarization_candidates(
+                self.threshold, thread_uuids=[thread_uuid])
+            if not candidates:
+                return None
+            _, newest_message_id, _ = candidates[0]
+            if self._skipped_at.get(thread_uuid) == newest_message_id:
+                return None
+
+            messages, previous_summary = [], None
+            rows = ThreadMessageDao(session).stream_context_rows(leaf_message_id=newest_message_id)
+            try:
+                async for message_id, role, content, summary in rows:
+                    if summary:
+                        previous_summary = summary
+                        break
+                    messages.append(ContextItem(message_id=message_id, role=getattr(role, "value", role),
+                                                content=content or "", tokens=self.token_counter(content or "")))
+            finally:
+                await rows.aclose()
+
+        if len(messages) < self.threshold:
+            # Other branches made the thread look due, this one is not
+            self._skipped_at.set(thread_uuid, newest_message_id)
+            return None
+        self._skipped_at.delete(thread_uuid)
+        messages.reverse()
+        return SummaryRequest(thread_uuid=thread_uuid, message_id=newest_message_id,
+                              previous_summary=previous_summary, messages=messages)
+
+    async def _summarize(self, thread_uuid: UUID):
+        # The session is closed before calling the summarizer, no connection is held while it runs
+        summary_request = await self._load_request(thread_uuid)
+        if summary_request is None:
+            self.stats.skipped += 1
+            return
+        summary = await self.summarizer(summary_request)
+        if not summary:
+            self.stats.skipped += 1
+            return
+        self._results.append((thread_uuid, summary_request.message_id, summary))
+        if len(self._results) >= self.write_batch_size:
+            await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to write thread summaries")
+
+    async def flush(self):
+        """Write the summaries produced so far in one transaction per ``write_batch_size`` summaries."""
+        async with self._write_lock:
+            while self._results:
+                batch = self._results[:self.write_batch_size]
+                async with self.session_factory() as session:
+                    async with session.begin():
+                        await ThreadMessageSummaryDao(session).bulk_upsert_summaries(batch)
+                del self._results[:len(batch)]
+                self.stats.written += len(batch)
+
@@ -0,0 +1,286 @@
+"""
+Streaming NDJSON export and bulk import of threads with their messages and summaries.
+
+An export is one JSON object per line: a header, then every thread, then every message (by id, so
+parents come first) and then every summary, each as ``{"type": ..., "data": {...}}``. Rows are read
+through server side cursors, so memory stays flat however large the history is.
+
+    chat-threads-transfer export --database-url postgresql+asyncpg://... --org-id org_1 --output org_1.ndjson.gz
+    chat-threads-transfer import --database-url postgresql+asyncpg://... --input org_1.ndjson.gz
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+from datetime import datetime
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, TextIO
+from uuid import UUID, uuid4
+
+from sqlalchemy import DateTime
+from sqlalchemy import Enum as SQLAEnum
+from sqlalchemy.dialects.postgresql import UUID as PGUUID
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from chat_threads.threads.blobs import get_blob_store
+from chat_threads.threads.dao import ThreadDao, ThreadMessageDao, ThreadMessageSummaryDao, ThreadMessageBlobDao
+from chat_threads.threads.models import Thread, ThreadMessage, ThreadMessageSummary, message_search_text
+from chat_threads.threads.search import IndexedMessage, SearchBackend
+from chat_threads.threads.serializers import trusted_row_to_dict
+from chat_threads.utils.compression import reference_display_text
+from chat_threads.utils.constants import BULK_OPERATION_BATCH_SIZE, EXPORT_CHUNK_SIZE
+from chat_threads.utils.orm_utils import get_current_time
+
+EXPORT_FORMAT_VERSION = 1
+
+THREAD_RECORD = "thread"
+MESSAGE_RECORD = "message"
+SUMMARY_RECORD = "summary"
+# Import order; rows of a type are only inserted once all the rows they reference are
+RECORD_TYPES = (THREAD_RECORD, MESSAGE_RECORD, SUMMARY_RECORD)
+RECORD_MODELS = {THREAD_RECORD: Thread, MESSAGE_RECORD: ThreadMessage, SUMMARY_RECORD: ThreadMessageSummary}
+
+
+def _json_default(value):
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"Cannot export {type(value).__name__}")
+
+
+def _record(record_type: str, data: dict) -> str:
+    return json.dumps({"type": record_type, "data": data}, default=_json_default, separators=(",", ":")) + "\n"
+
+
+def _decode_row(model, data: dict) -> dict:
+    """Turn the JSON values of an exported row back into the Python values of ``model``'s columns."""
+    columns = model.__table__.c
+    row = {}
+    for name, value in data.items():
+        if name not in columns:
+            continue
+        column_type = columns[name].type
+        if value is not None:
+            if isinstance(column_type, SQLAEnum):
+                value = column_type.enum_class(value)
+            elif isinstance(column_type, PGUUID):
+                value = UUID(value)
+            elif isinstance(column_type, DateTime):
+                value = datetime.fromisoformat(value)
+        row[name] = value
+    return row
+
+
+def open_ndjson(path: str, mode: str = "r") -> TextIO:
+    """Open an export file for text ``mode`` ``"r"`` or ``"w"``; ``.gz`` paths are gzip compressed, ``-`` is stdio."""
+    if path == "-":
+        stream = sys.stdin if mode == "r" else sys.stdout
+        return open(stream.fileno(), mode, encoding="utf-8", closefd=False)
+    opener = gzip.open if path.endswith(".gz") else open
+    return opener(path, f"{mode}t", encoding="utf-8")
+
+
+async def export_threads(session: AsyncSession, output: TextIO, user_email: Optional[str] = None,
+                         org_id: Optional[str] = None, product: Optional[str] = None,
+                         include_deleted: bool = False, chunk_size: int = EXPORT_CHUNK_SIZE) -> Dict[str, int]:
+    """
+    Write the threads matching all the given filters, their messages and their summaries to ``output`` as NDJSON.
+    Only ``chunk_size`` rows are held in memory at a time. Returns the number of rows written per type.
+    """
+    scope = dict(user_email=user_email, org_id=org_id, product=product, include_deleted=include_deleted,
+                 chunk_size=chunk_size)
+    output.write(_record("header", {
+        "format_version": EXPORT_FORMAT_VERSION,
+        "exported_at": get_current_time(),
+        "user_email": user_email,
+        "org_id": org_id,
+        "product": product,
+    }))
+    streams = {
+        THREAD_RECORD: ThreadDao(session).stream_threads(**scope),
+        MESSAGE_RECORD: ThreadMessageDao(session).stream_messages_of_threads(**scope),
+        SUMMARY_RECORD: ThreadMessageSummaryDao(session).stream_summaries_of_threads(**scope),
+    }
+    blob_dao = ThreadMessageBlobDao(session)
+    counts = dict.fromkeys(RECORD_TYPES, 0)
+    for record_type, rows_stream in streams.items():
+        async for rows in rows_stream:
+            rows = [trusted_row_to_dict(row) for row in rows]
+            if record_type == MESSAGE_RECORD:
+                # Exports carry the payloads themselves, the target database may not have the blobs
+                rows = await get_blob_store().resolve_rows(blob_dao, rows)
+            output.write("".join(_record(record_type, row) for row in rows))
+            counts[record_type] += len(rows)
+    return counts
+
+
+class ThreadImporter:
+    """
+    Loads exported records in batches of ``batch_size`` with ``COPY`` (or one ``executemany`` insert).
+
+    Threads and messages get new ids from the database; ``parent_message_id``, ``last_message_id`` and the
+    message ids of summaries are remapped to them. Uuids are kept, so importing into the database the export
+    came from fails on the unique thread uuid, unless ``new_uuids`` gives every thread and summary a new one.
+    Nothing is committed; a ``search_backend`` that keeps its own index gets the messages once the caller commits.
+    """
+
+    def __init__(self, session: AsyncSession, batch_size: int = BULK_OPERATION_BATCH_SIZE, new_uuids: bool = False,
+                 search_backend: Optional[SearchBackend] = None):
+        self.session = session
+        self.batch_size = batch_size
+        self.new_uuids = new_uuids
+        self.search_backend = search_backend
+        self.thread_dao = ThreadDao(session)
+        self.daos = {
+            THREAD_RECORD: self.thread_dao,
+            MESSAGE_RECORD: ThreadMessageDao(session),
+            SUMMARY_RECORD: ThreadMessageSummaryDao(session),
+        }
+        self.pending: Dict[str, List[dict]] = {record_type: [] for record_type in RECORD_TYPES}
+        self.counts = dict.fromkeys(RECORD_TYPES, 0)
+        self.counts["skipped_summaries"] = 0
+        self.thread_uuids: Dict[UUID, UUID] = {}
+        self.message_ids: Dict[int, int] = {}
+        self.last_message_ids: Dict[UUID, int] = {}
+
+    async def add(self, record_type: str, data: dict):
+        if record_type not in self.pending:
+            return
+        # Everything this row may reference has to be in the database first
+        for earlier_type in RECORD_TYPES[:RECORD_TYPES.index(record_type)]:
+            await self._flush(earlier_type)
+        self.pending[record_type].append(_decode_row(RECORD_MODELS[record_type], data))
+        if len(self.pending[record_type]) >= self.batch_size:
+            await self._flush(record_type)
+
+    async def finish(self) -> Dict[str, int]:
+        for record_type in RECORD_TYPES:
+            await self._flush(record_type)
+        await self.thread_dao.set_last_message_ids({
+            thread_uuid: self.message_ids[last_message_id]
+            for thread_uuid, last_message_id in self.last_message_ids.items() if last_message_id in self.message_ids
+        })
+        self.last_message_ids = {}
+        return self.counts
+
+    def _prepare_threads(self, rows: List[dict]) -> List[dict]:
+        for row in rows:
+            row.pop("id", None)
+            thread_uuid = uuid4() if self.new_uuids else row["uuid"]
+            self.thread_uuids[row["uuid"]] = thread_uuid
+            row["uuid"] = thread_uuid
+            last_message_id = row.pop("last_message_id", None)
+            if last_message_id is not None:
+                self.last_message_ids[thread_uuid] = last_message_id
+            row["last_message_id"] = None
+            # Exports made before the activity columns were backfilled may not have it
+            row["last_message_at"] = row.get("last_message_at") or row.get("created_at") or get_current_time()
+        return rows
+
+    async def _prepare_messages(self, rows: List[dict]) -> List[dict]:
+        new_ids = await self.daos[MESSAGE_RECORD].allocate_ids(len(rows))
+        for row, new_id in zip(rows, new_ids):
+            self.message_ids[row["id"]] = new_id
+        for row in rows:
+            row["id"] = self.message_ids[row["id"]]
+            row["thread_uuid"] = self.thread_uuids.get(row["thread_uuid"], row["thread_uuid"])
+            # A parent outside the export cannot be linked
+            row["parent_message_id"] = self.message_ids.get(row.get("parent_message_id"))
+            reference_display_text(row)
+        return await get_blob_store().dedupe(ThreadMessageBlobDao(self.daos[MESSAGE_RECORD].session), rows)
+
+    def _prepare_summaries(self, rows: List[dict]) -> List[dict]:
+        prepared = []
+        for row in rows:
+            thread_message_id = self.message_ids.get(row.get("thread_message_id"))
+            if thread_message_id is None:
+                self.counts["skipped_summaries"] += 1
+                continue
+            row["thread_message_id"] = thread_message_id
+            row["thread_uuid"] = self.thread_uuids.get(row["thread_uuid"], row["thread_uuid"])
+            if self.new_uuids:
+                row["uuid"] = uuid4()
+            prepared.append(row)
+        return prepared
+
+    async def _flush(self, record_type: str):
+        rows, self.pending[record_type] = self.pending[record_type], []
+        if not rows:
+            return
+        if record_type == THREAD_RECORD:
+            rows = self._prepare_threads(rows)
+        elif record_type == MESSAGE_RECORD:
+            rows = await self._prepare_messages(rows)
+        else:
+            rows = self._prepare_summaries(rows)
+        await self.daos[record_type].bulk_copy(rows)
+        if record_type == MESSAGE_RECORD:
+            # COPY cannot build search vectors; index the plain text, stored values may be compressed
+            await self.daos[MESSAGE_RECORD].set_search_vectors({
+                row["id"]: message_search_text(row.get("content"), row.get("display_text")) for row in rows})
+            if self.search_backend is not None:
+                await self.search_backend.index_messages_on_commit(self.session, self.thread_dao, [
+                    IndexedMessage(row["thread_uuid"], row.get("content"), row.get("display_text")) for row in rows])
+        self.counts[record_type] += len(rows)
+
+
+async def import_threads(session: AsyncSession, lines: Iterable[str], batch_size: int = BULK_OPERATION_BATCH_SIZE,
+                         new_uuids: bool = False, search_backend: Optional[SearchBackend] = None) -> Dict[str, int]:
+    """Load an export produced by ``export_threads`` from ``lines``. Returns the number of rows inserted per type."""
+    importer = ThreadImporter(session, batch_size=batch_size, new_uuids=new_uuids, search_backend=search_backend)
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record["type"] == "header" and record["data"]["format_version"] != EXPORT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported export format version {record['data']['format_version']}")
+        await importer.add(record["type"], record["data"])
+    return await importer.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", required=True)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write threads, messages and summaries as NDJSON")
+    export_parser.add_argument("--output", default="-", help="file path, .gz to compress, - for stdout")
+    export_parser.add_argument("--user-email")
+    export_parser.add_argument("--org-id")
+    export_parser.add_argument("--product")
+    export_parser.add_argument("--include-deleted", action="store_true")
+    export_parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+
+    import_parser = commands.add_parser("import", help="load an NDJSON export")
+    import_parser.add_argument("--input", default="-", help="file path, .gz if compressed, - for stdin")
+    import_parser.add_argument("--batch-size", type=int, default=BULK_OPERATION_BATCH_SIZE)
+    import_parser.add_argument("--new-uuids", action="store_true", help="give imported threads new uuids")
+    args = parser.parse_args()
+
+    async def _run():
+        engine = create_async_engine(args.database_url)
+        try:
+            async with AsyncSession(engine) as session:
+                if args.command == "export":
+                    with open_ndjson(args.output, "w") as output:
+                        return await export_threads(session, output, user_email=args.user_email,
+                                                    org_id=args.org_id, product=args.product,
+                                                    include_deleted=args.include_deleted,
+                                                    chunk_size=args.chunk_size)
+                with open_ndjson(args.input, "r") as lines:
+                    counts = await import_threads(session, lines, batch_size=args.batch_size,
+                                                  new_uuids=args.new_uuids)
+                await session.commit()
+                return counts
+        finally:
+            await engine.dispose()
+
+    print(json.dumps(asyncio.run(_run())), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from chat_threads.threads.cache import ThreadCache
+from chat_threads.threads.blobs import get_blob_store
+from chat_threads.threads.dao import ThreadArchiveDao, ThreadDao, ThreadMessageDao, ThreadMessageBlobDao
+from chat_threads.threads.models import ThreadMessage, message_search_text, to_search_vector
+from chat_threads.threads.search import IndexedMessage, SearchBackend
+from chat_threads.threads.serializers import CreateMessageRequest
+from chat_threads.utils.compression import reference_display_text
+from chat_threads.utils.constants import (
+    MESSAGE_WRITER_MAX_BATCH_SIZE, MESSAGE_WRITER_MAX_FLUSH_LATENCY, MESSAGE_WRITER_MAX_PENDING
+)
+from chat_threads.utils.exceptions import MessageWriterClosedError
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedMessageWriter:
+    """
+    Group-commit writer for high volume message ingestion.
+
+    ``enqueue`` returns a future that resolves to the id of the inserted message. Queued messages are
+    written by a background task in batches of up to ``max_batch_size``, at most ``max_flush_latency``
+    seconds after the first message of the batch arrived. Each batch is one transaction made of a single
+    multi-row ``INSERT ... RETURNING`` and a single ``UPDATE`` of the activity columns (``last_message_id``,
+    ``message_count``...) of every thread it touched. Once ``max_pending`` messages are queued, ``enqueue``
+    waits for the writer to catch up. When a batch violates a constraint, e.g. a message for an unknown thread,
+    its messages are retried one per transaction so only the offending ones fail.
+
+    Messages must belong to existing threads; use ``ThreadService.create_thread_message`` to start a thread.
+    With a ``search_backend`` that keeps its own index, each batch is indexed once it commits.
+    """
+
+    def __init__(self, session_factory: Callable[[], AsyncSession],
+                 max_batch_size: int = MESSAGE_WRITER_MAX_BATCH_SIZE,
+                 max_flush_latency: float = MESSAGE_WRITER_MAX_FLUSH_LATENCY,
+                 max_pending: int = MESSAGE_WRITER_MAX_PENDING,
+                 thread_cache: Optional[ThreadCache] = None, search_backend: Optional[SearchBackend] = None):
+        self.session_factory = session_factory
+        self.max_batch_size = max_batch_size
+        self.max_flush_latency = max_flush_latency
+        self.thread_cache = thread_cache
+        self.search_backend = search_backend
+        self._queue: "asyncio.Queue[Tuple[dict, asyncio.Future]]" = asyncio.Queue(maxsize=max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, create_message_request: CreateMessageRequest) -> asyncio.Future:
+        if self._closed:
+            raise MessageWriterClosedError()
+        if create_message_request.thread_id is None:
+            raise ValueError("BatchedMessageWriter needs the thread_id of an existing thread")
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((create_message_request.to_message_values(), future))
+        return future
+
+    async def write(self, create_message_request: CreateMessageRequest) -> int:
+        return await (await self.enqueue(create_message_request))
+
+    async def close(self):
+        """Stop accepting messages and wait until everything already queued is written."""
+        self._closed = True
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _next_batch(self) -> List[Tuple[dict, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_flush_latency
+        while len(batch) < self.max_batch_size:
+            if self._queue.empty():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+                if self._queue.empty():
+                    break
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write(self, batch: List[Tuple[dict, asyncio.Future]]):
+        try:
+            message_ids = await self._flush(batch)
+        except IntegrityError as e:
+            if len(batch) == 1:
+                self._fail(batch, e)
+                return
+            logger.warning("A batch of %d thread messages violates a constraint, writing them one by one",
+                           len(batch))
+            for item in batch:
+                await self._write([item])
+        except Exception as e:
+            self._fail(batch, e)
+        else:
+            for (_, future), message_id in zip(batch, message_ids):
+                if not future.done():
+                    future.set_result(message_id)
+
+    @staticmethod
+    def _fail(batch: List[Tuple[dict, asyncio.Future]], error: Exception):
+        logger.error("Failed to write a batch of %d thread messages", len(batch), exc_info=error)
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]) -> List[int]:
+        async with self.session_factory() as session:
+            async with session.begin():
+                message_dao = ThreadMessageDao(session=session)
+                thread_dao = ThreadDao(session=session, thread_cache=self.thread_cache)
+                await ThreadArchiveDao(session, thread_cache=self.thread_cache).restore_for_write(
+                    {values["thread_uuid"] for values, _ in batch})
+
+                stored_values = await get_blob_store().dedupe(
+                    ThreadMessageBlobDao(session), [reference_display_text(dict(values)) for values, _ in batch])
+                # Indexed from the plain text, the stored values may be compressed
+                stored_values = [
+                    dict(stored, search_vector=to_search_vector(
+                        message_search_text(values.get("content"), values.get("display_text"))))
+                    for stored, (values, _) in zip(stored_values, batch)
+                ]
+                rows = await message_dao.bulk_insert_returning(stored_values, ThreadMessage.id,
+                                                               ThreadMessage.thread_uuid, ThreadMessage.created_at)
+                # Postgres returns the rows of a multi-row VALUES insert in the order they were listed
+                await thread_dao.record_new_messages([
+                    (message_id, thread_uuid, created_at, values["display_text"])
+                    for (message_id, thread_uuid, created_at), (values, _) in zip(rows, batch)
+                ])
+                if self.search_backend is not None:
+                    await self.search_backend.index_messages_on_commit(session, thread_dao, [
+                        IndexedMessage(values["thread_uuid"], values.get("content"), values.get("display_text"))
+                        for values, _ in batch
+                    ])
+
+        return [message_id for message_id, _, _ in rows]
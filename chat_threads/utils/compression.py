@@ -0,0 +1,212 @@
+"""
+Opt-in compression of large text and JSON columns.
+
+``CompressedText`` and ``CompressedJSONB`` store values of at least ``threshold`` bytes as base64 encoded
+zlib once ``configure_compression`` has been called; until then they behave like ``String`` and ``JSONB``.
+Reads always decode, so compressed and plain rows can live side by side and compression can be turned off
+again without a migration.
+
+Compressed and tagged text starts with ``\\x1b`` (ESC); plain text that starts with it is escaped with a
+second one. A tagged ``display_text`` may also be a reference to the ``content`` of the same row, which
+``CompressedDisplayText`` resolves in SQL when the column is selected.
+"""
+import base64
+import json
+import zlib
+from typing import Optional
+
+from sqlalchemy import String, case, literal
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.types import TypeDecorator
+
+from chat_threads.utils.constants import COMPRESSION_LEVEL, COMPRESSION_THRESHOLD
+from chat_threads.utils.instrumentation import get_default_instrumentation
+
+TAG = "\x1b"
+COMPRESSED_TEXT_PREFIX = TAG + "z"
+CONTENT_REFERENCE_MARKER = TAG + "="
+ESCAPED_TEXT_PREFIX = TAG + TAG
+COMPRESSED_JSON_KEY = "__chat_threads_zlib__"
+
+
+class _ContentReference:
+    """Stands for "same as ``content``" in the ``display_text`` of a row about to be written."""
+
+    def __repr__(self):
+        return "CONTENT_REFERENCE"
+
+
+CONTENT_REFERENCE = _ContentReference()
+
+
+class CompressionStats:
+
+    def __init__(self):
+        self.compressed_values = 0
+        self.content_references = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.raw_bytes - self.stored_bytes
+
+    def as_dict(self) -> dict:
+        return {
+            "compressed_values": self.compressed_values,
+            "content_references": self.content_references,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "saved_bytes": self.saved_bytes,
+        }
+
+
+class CompressionSettings:
+
+    def __init__(self):
+        self.threshold: Optional[int] = None
+        self.level = COMPRESSION_LEVEL
+        self.stats = CompressionStats()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold is not None
+
+
+_settings = CompressionSettings()
+
+
+def configure_compression(threshold: Optional[int] = COMPRESSION_THRESHOLD, level: int = COMPRESSION_LEVEL):
+    """Compress values of at least ``threshold`` bytes written from now on; ``None`` turns compression off."""
+    _settings.threshold = threshold
+    _settings.level = level
+
+
+def compression_enabled() -> bool:
+    return _settings.enabled
+
+
+def compression_threshold() -> Optional[int]:
+    return _settings.threshold
+
+
+def get_compression_stats() -> CompressionStats:
+    """Bytes written and saved by this process since it started."""
+    return _settings.stats
+
+
+def _record_saving(field: str, raw_bytes: int, stored_bytes: int, reference: bool = False):
+    stats = _settings.stats
+    if reference:
+        stats.content_references += 1
+    else:
+        stats.compressed_values += 1
+    stats.raw_bytes += raw_bytes
+    stats.stored_bytes += stored_bytes
+    instrumentation = get_default_instrumentation()
+    if instrumentation.enabled:
+        instrumentation.observe_compression(field, raw_bytes, stored_bytes)
+
+
+def _compress(raw: bytes) -> str:
+    return base64.b64encode(zlib.compress(raw, _settings.level)).decode("ascii")
+
+
+def _decompress(payload: str) -> bytes:
+    return zlib.decompress(base64.b64decode(payload))
+
+
+def encode_text(value: Optional[str], field: str = "text") -> Optional[str]:
+    if value is None:
+        return None
+    if value is CONTENT_REFERENCE:
+        return CONTENT_REFERENCE_MARKER
+    if _settings.enabled and len(value) >= _settings.threshold:
+        raw = value.encode("utf-8")
+        stored = COMPRESSED_TEXT_PREFIX + _compress(raw)
+        if len(stored) < len(raw):
+            _record_saving(field, len(raw), len(stored))
+            return stored
+    if value.startswith(TAG):
+        return TAG + value
+    return value
+
+
+def decode_text(value: Optional[str]) -> Optional[str]:
+    if value is None or not value.startswith(TAG):
+        return value
+    if value.startswith(COMPRESSED_TEXT_PREFIX):
+        return _decompress(value[len(COMPRESSED_TEXT_PREFIX):]).decode("utf-8")
+    if value.startswith(ESCAPED_TEXT_PREFIX):
+        return value[1:]
+    # An unresolved content reference, only seen when display_text is read outside a SELECT list
+    return value
+
+
+def reference_display_text(values: dict) -> dict:
+    """Replace a ``display_text`` equal to ``content`` in insert/update ``values`` with a reference to it."""
+    display_text = values.get("display_text")
+    if _settings.enabled and display_text is not None and display_text == values.get("content"):
+        _record_saving("display_text", len(display_text.encode("utf-8")), len(CONTENT_REFERENCE_MARKER),
+                       reference=True)
+        values["display_text"] = CONTENT_REFERENCE
+    return values
+
+
+class CompressedText(TypeDecorator):
+    """``String`` compressed above the configured threshold."""
+
+    impl = String
+    cache_ok = True
+
+    def __init__(self, *args, field: str = "text", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.field = field
+
+    def process_bind_param(self, value, dialect):
+        return encode_text(value, self.field)
+
+    def process_result_value(self, value, dialect):
+        return decode_text(value)
+
+
+class CompressedDisplayText(CompressedText):
+    """
+    ``CompressedText`` that may also hold a reference to the ``content`` column of its row. Selecting the
+    column selects ``content`` in its place for those rows, so readers never see the reference.
+    """
+
+    def column_expression(self, column):
+        content = column.table.c.get("content")
+        if content is None:
+            return column
+        return case((column == literal(CONTENT_REFERENCE_MARKER, String()), content), else_=column)
+
+
+class CompressedJSONB(TypeDecorator):
+    """``JSONB`` whose serialized value is replaced by ``{COMPRESSED_JSON_KEY: <zlib>}`` above the threshold."""
+
+    impl = JSONB
+    cache_ok = True
+
+    def __init__(self, *args, field: str = "json", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.field = field
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not _settings.enabled:
+            return value
+        raw = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        if len(raw) < _settings.threshold:
+            return value
+        payload = _compress(raw)
+        stored_bytes = len(payload) + len(COMPRESSED_JSON_KEY) + 6
+        if stored_bytes >= len(raw):
+            return value
+        _record_saving(self.field, len(raw), stored_bytes)
+        return {COMPRESSED_JSON_KEY: payload}
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, dict) and len(value) == 1 and COMPRESSED_JSON_KEY in value:
+            return json.loads(_decompress(value[COMPRESSED_JSON_KEY]))
+        return value
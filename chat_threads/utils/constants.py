@@ -3,6 +3,41 @@ from enum import Enum
 IND_TIME_ZONE = "Asia/Kolkata"
 UTC_TIME_ZONE = "UTC"
 PROMETHEUS_LOG_TIME = 30
+SEARCH_TEXT_CONFIG = "simple"
+THREAD_CACHE_MAX_SIZE = 10000
+THREAD_CACHE_TTL = 300
+MESSAGE_WRITER_MAX_BATCH_SIZE = 500
+MESSAGE_WRITER_MAX_FLUSH_LATENCY = 0.01
+MESSAGE_WRITER_MAX_PENDING = 5000
+THREAD_PREVIEW_LENGTH = 200
+SLOW_QUERY_THRESHOLD = 0.5
+# Rows (or uuids) sent per statement by the bulk DAO operations
+BULK_OPERATION_BATCH_SIZE = 1000
+# Threads moved per transaction by ThreadArchiveDao.archive_threads, with all their messages
+ARCHIVE_BATCH_SIZE = 100
+EXPORT_CHUNK_SIZE = 1000
+# Bytes from which CompressedText/CompressedJSONB values are stored compressed, once enabled
+COMPRESSION_THRESHOLD = 4096
+COMPRESSION_LEVEL = 6
+STREAMING_FLUSH_INTERVAL = 0.5
+STREAMING_FLUSH_BYTES = 4096
+BLOB_CACHE_MAX_SIZE = 10000
+# Blobs never change, the ttl only bounds how long an unused one stays in memory
+BLOB_CACHE_TTL = 24 * 60 * 60
+REPLICA_MIN_PRIMARY_WINDOW = 1.0
+REPLICA_LAG_PROBE_INTERVAL = 5.0
+# Thread uuid -> shard locations remembered per process; threads only move during a migration
+SHARD_LOCATION_CACHE_SIZE = 100000
+SHARD_LOCATION_CACHE_TTL = 60 * 60
+# Unsummarized messages after which a thread is summarized in the background, see threads/summarization.py
+SUMMARY_MESSAGE_THRESHOLD = 20
+SUMMARY_MAX_CONCURRENCY = 4
+SUMMARY_MAX_PENDING = 1000
+SUMMARY_WRITE_BATCH_SIZE = 100
+SUMMARY_FLUSH_INTERVAL = 1.0
+SUMMARY_POLL_INTERVAL = 60.0
+SUMMARY_SCAN_LIMIT = 500
+SUMMARY_SCAN_WINDOW = 24 * 60 * 60
 
 
 class Role(str, Enum):
@@ -17,3 +52,8 @@ class FynixProducts(str, Enum):
     DEVAS = "devas"
     MERMAID = "mermaid"
     AGENTIX = "agentix"
+
+
+class ThreadSortOrder(str, Enum):
+    CREATED_AT = "created_at"
+    LAST_ACTIVITY = "last_activity"
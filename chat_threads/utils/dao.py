@@ -1,14 +1,25 @@
-from sqlalchemy import inspect, update, func
+import json
+import sys
+import time
+from enum import Enum
+from typing import List, Optional
+
+from sqlalchemy import inspect, insert, update, func, select, JSON
+from sqlalchemy import Enum as SQLAEnum
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm.attributes import flag_modified, flag_dirty
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.types import TypeDecorator
+
+from chat_threads.utils.instrumentation import QueryInstrumentation, get_default_instrumentation
 
 
 class BaseDao:
 
-    def __init__(self, session: AsyncSession, db_model):
+    def __init__(self, session: AsyncSession, db_model, instrumentation: Optional[QueryInstrumentation] = None):
         self.session = session
         self.db_model = db_model
+        self.instrumentation = instrumentation
 
     async def _flush(self):
         await self.session.flush()
@@ -16,8 +27,61 @@ class BaseDao:
     async def _commit(self):
         await self.session.commit()
 
-    async def _execute_query(self, query):
-        return await self.session.execute(query)
+    def _get_instrumentation(self) -> QueryInstrumentation:
+        return self.instrumentation or get_default_instrumentation()
+
+    def _dao_method(self, depth: int = 2) -> str:
+        return f"{type(self).__name__}.{sys._getframe(depth).f_code.co_name}"
+
+    async def _execute_query(self, query, parameters: Optional[List[dict]] = None):
+        """Run ``query``, as one ``executemany`` when given a list of ``parameters``, measured when instrumented."""
+        instrumentation = self._get_instrumentation()
+        if not instrumentation.enabled:
+            return await self.session.execute(query, parameters)
+
+        dao_method = self._dao_method()
+        start = time.perf_counter()
+        try:
+            result = await self.session.execute(query, parameters)
+        except Exception:
+            instrumentation.observe_error(dao_method, time.perf_counter() - start)
+            raise
+        duration = time.perf_counter() - start
+
+        if result.returns_rows and not getattr(query, "is_dml", False):
+            # Buffer the rows so they can be counted; callers get an equivalent result back
+            frozen_result = result.freeze()
+            rows = len(frozen_result.data)
+            result = frozen_result()
+        else:
+            # INSERT/UPDATE/DELETE (RETURNING or not) keep their result, and with it rowcount
+            rows = result.rowcount if result.rowcount >= 0 else None
+        await instrumentation.after_query(self.session, dao_method, query, duration, rows)
+        return result
+
+    async def _stream_query(self, query, scalars: bool = False):
+        """Run ``query`` through a server side cursor; only the time to open the cursor is measured."""
+        stream = self.session.stream_scalars if scalars else self.session.stream
+        instrumentation = self._get_instrumentation()
+        if not instrumentation.enabled:
+            return await stream(query)
+
+        dao_method = self._dao_method()
+        start = time.perf_counter()
+        try:
+            result = await stream(query)
+        except Exception:
+            instrumentation.observe_error(dao_method, time.perf_counter() - start)
+            raise
+        await instrumentation.after_query(self.session, dao_method, query, time.perf_counter() - start, None)
+        return result
+
+    def _serialized(self, items):
+        """Report how many rows a DAO method turned into output, and hand them back."""
+        instrumentation = self._get_instrumentation()
+        if instrumentation.enabled:
+            instrumentation.observe_serialized(self._dao_method(), len(items))
+        return items
 
     def get_orm_object(self, **kwargs):
         return self.db_model(**kwargs)
@@ -67,3 +131,69 @@ class BaseDao:
         except IntegrityError as e:
             self.session.rollback()
             raise e
+
+    async def bulk_insert_returning(self, mappings, *returning_columns):
+        """
+        Insert all ``mappings`` with a single multi-row ``INSERT ... RETURNING``.
+        Unlike ``bulk_insert`` this neither commits nor discards generated keys.
+        """
+        insert_query = insert(self.db_model).values(mappings).returning(*returning_columns)
+        result = await self._execute_query(insert_query)
+        return result.all()
+
+    async def allocate_ids(self, count: int) -> List[int]:
+        """Reserve ``count`` values of the primary key sequence, to insert rows that reference each other."""
+        table = self.db_model.__table__
+        pk_field_name = inspect(self.db_model).primary_key[0].name
+        query = select(func.nextval(func.pg_get_serial_sequence(table.name, pk_field_name))).select_from(
+            func.generate_series(1, count))
+        result = await self._execute_query(query)
+        return result.scalars().all()
+
+    @staticmethod
+    def _copy_value(column, value, dialect):
+        column_type = column.type
+        if isinstance(column_type, TypeDecorator):
+            # COPY skips SQLAlchemy's bind processing, apply it here
+            value = column_type.process_bind_param(value, dialect)
+            column_type = column_type.impl
+        if value is None:
+            return None
+        if isinstance(column_type, SQLAEnum) and isinstance(value, Enum):
+            return value.name
+        if isinstance(column_type, JSON):
+            return json.dumps(value)
+        return value
+
+    async def bulk_copy(self, mappings: List[dict]):
+        """
+        Load ``mappings`` (all with the same keys) with ``COPY`` when the driver is asyncpg, and with a single
+        ``executemany`` insert otherwise. Runs in the session's transaction and does not commit.
+        """
+        if not mappings:
+            return
+        table = self.db_model.__table__
+        connection = await self.session.connection()
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = getattr(raw_connection, "driver_connection", None)
+        if not hasattr(driver_connection, "copy_records_to_table"):
+            await self._execute_query(insert(table), mappings)
+            return
+
+        # The asyncpg adapter opens its transaction on the first statement; make sure COPY runs inside it
+        await connection.execute(select(1))
+        columns = list(mappings[0])
+        records = [tuple(self._copy_value(table.c[name], mapping[name], connection.dialect) for name in columns)
+                   for mapping in mappings]
+        instrumentation = self._get_instrumentation()
+        start = time.perf_counter()
+        try:
+            await driver_connection.copy_records_to_table(table.name, records=records, columns=columns)
+        except Exception:
+            if instrumentation.enabled:
+                instrumentation.observe_error(self._dao_method(1), time.perf_counter() - start)
+            raise
+        if instrumentation.enabled:
+            # Reported as the INSERT it stands for, COPY has no SQLAlchemy statement
+            await instrumentation.after_query(self.session, self._dao_method(1), insert(table),
+                                              time.perf_counter() - start, len(records))
@@ -22,3 +22,23 @@ class ThreadUpdateError(ThreadException):
 class ThreadDeleteError(ThreadException):
     DEFAULT_MESSAGE = "Thread deletion failed: Thread not found"
     ERROR_CODE = 1252
+
+
+class InvalidCursorError(ThreadException):
+    DEFAULT_MESSAGE = "Invalid pagination cursor"
+    ERROR_CODE = 1253
+
+
+class MessageWriterClosedError(ThreadException):
+    DEFAULT_MESSAGE = "Message writer is closed"
+    ERROR_CODE = 1254
+
+
+class MessageStreamClosedError(ThreadException):
+    DEFAULT_MESSAGE = "Streaming message is already finalized"
+    ERROR_CODE = 1255
+
+
+class ThreadNotFoundError(ThreadException):
+    DEFAULT_MESSAGE = "Thread not found on any shard"
+    ERROR_CODE = 1256
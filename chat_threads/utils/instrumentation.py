@@ -0,0 +1,157 @@
+import logging
+import random
+from typing import Optional
+
+from sqlalchemy.sql import Select
+
+from chat_threads.utils.constants import SLOW_QUERY_THRESHOLD
+
+try:
+    import prometheus_client
+except ImportError:  # pragma: no cover - optional dependency
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+
+def _bind_shape(value) -> str:
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+class QueryInstrumentation:
+    """
+    Receives timings for the queries run through ``BaseDao``.
+
+    On its own it logs queries slower than ``slow_query_threshold`` seconds, with the compiled SQL and the
+    type/size of each bind parameter (never the values), and runs ``EXPLAIN`` for a ``explain_sample_rate``
+    fraction of ``SELECT`` statements. Subclasses export the measurements by overriding the ``observe_*`` hooks.
+    """
+
+    enabled = True
+
+    def __init__(self, slow_query_threshold: Optional[float] = SLOW_QUERY_THRESHOLD, explain_sample_rate: float = 0.0):
+        self.slow_query_threshold = slow_query_threshold
+        self.explain_sample_rate = explain_sample_rate
+
+    def observe_query(self, dao_method: str, duration: float, rows: Optional[int]):
+        pass
+
+    def observe_error(self, dao_method: str, duration: float):
+        pass
+
+    def observe_serialized(self, dao_method: str, rows: int):
+        pass
+
+    def observe_slow_query(self, dao_method: str, duration: float):
+        pass
+
+    def observe_compression(self, field: str, raw_bytes: int, stored_bytes: int):
+        pass
+
+    async def after_query(self, session, dao_method: str, query, duration: float, rows: Optional[int]):
+        self.observe_query(dao_method, duration, rows)
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            self.observe_slow_query(dao_method, duration)
+            self.log_slow_query(session, dao_method, query, duration, rows)
+        if self.explain_sample_rate and isinstance(query, Select) and random.random() < self.explain_sample_rate:
+            await self.explain(session, dao_method, query)
+
+    @staticmethod
+    def _dialect(session):
+        return session.sync_session.get_bind().dialect
+
+    def log_slow_query(self, session, dao_method: str, query, duration: float, rows: Optional[int]):
+        try:
+            compiled = query.compile(dialect=self._dialect(session))
+            statement = str(compiled)
+            bind_shapes = {name: _bind_shape(value) for name, value in compiled.params.items()}
+        except Exception:
+            statement, bind_shapes = str(query), {}
+        logger.warning("Slow query in %s took %.3fs (%s rows): %s; binds=%s",
+                       dao_method, duration, rows, statement, bind_shapes)
+
+    async def explain(self, session, dao_method: str, query):
+        try:
+            statement = query.compile(dialect=self._dialect(session), compile_kwargs={"literal_binds": True})
+            connection = await session.connection()
+            result = await connection.exec_driver_sql(f"EXPLAIN {statement}")
+            plan = "\n".join(row[0] for row in result.all())
+        except Exception:
+            logger.debug("Could not EXPLAIN query of %s", dao_method, exc_info=True)
+            return None
+        logger.info("Query plan for %s:\n%s", dao_method, plan)
+        return plan
+
+
+class NoopInstrumentation(QueryInstrumentation):
+    """Default instrumentation: ``BaseDao`` checks ``enabled`` and skips all measuring."""
+
+    enabled = False
+
+    def __init__(self):
+        super().__init__(slow_query_threshold=None)
+
+
+class PrometheusInstrumentation(QueryInstrumentation):
+    """Exports per DAO method latency histograms and row counters through ``prometheus_client``."""
+
+    def __init__(self, registry=None, namespace: str = "chat_threads", buckets=None, **kwargs):
+        if prometheus_client is None:
+            raise ImportError("PrometheusInstrumentation requires prometheus_client: pip install chat_threads[prometheus]")
+        super().__init__(**kwargs)
+        registry = registry or prometheus_client.REGISTRY
+        histogram_kwargs = {"buckets": buckets} if buckets else {}
+        self.query_seconds = prometheus_client.Histogram(
+            "dao_query_seconds", "Latency of DAO queries", ["dao_method"], namespace=namespace,
+            registry=registry, **histogram_kwargs)
+        self.query_rows = prometheus_client.Counter(
+            "dao_query_rows", "Rows returned or affected by DAO queries", ["dao_method"], namespace=namespace,
+            registry=registry)
+        self.query_errors = prometheus_client.Counter(
+            "dao_query_errors", "DAO queries that raised", ["dao_method"], namespace=namespace, registry=registry)
+        self.rows_serialized = prometheus_client.Counter(
+            "dao_rows_serialized", "Rows turned into schemas or dicts by DAO methods", ["dao_method"],
+            namespace=namespace, registry=registry)
+        self.slow_queries = prometheus_client.Counter(
+            "dao_slow_queries", "DAO queries slower than the slow query threshold", ["dao_method"],
+            namespace=namespace, registry=registry)
+        self.compression_raw_bytes = prometheus_client.Counter(
+            "storage_raw_bytes", "Size of values written compressed or as a reference, before", ["field"],
+            namespace=namespace, registry=registry)
+        self.compression_saved_bytes = prometheus_client.Counter(
+            "storage_saved_bytes", "Bytes saved by compression and content references", ["field"],
+            namespace=namespace, registry=registry)
+
+    def observe_query(self, dao_method: str, duration: float, rows: Optional[int]):
+        self.query_seconds.labels(dao_method).observe(duration)
+        if rows is not None and rows >= 0:
+            self.query_rows.labels(dao_method).inc(rows)
+
+    def observe_error(self, dao_method: str, duration: float):
+        self.query_seconds.labels(dao_method).observe(duration)
+        self.query_errors.labels(dao_method).inc()
+
+    def observe_serialized(self, dao_method: str, rows: int):
+        self.rows_serialized.labels(dao_method).inc(rows)
+
+    def observe_slow_query(self, dao_method: str, duration: float):
+        self.slow_queries.labels(dao_method).inc()
+
+    def observe_compression(self, field: str, raw_bytes: int, stored_bytes: int):
+        self.compression_raw_bytes.labels(field).inc(raw_bytes)
+        self.compression_saved_bytes.labels(field).inc(raw_bytes - stored_bytes)
+
+
+_default_instrumentation: QueryInstrumentation = NoopInstrumentation()
+
+
+def get_default_instrumentation() -> QueryInstrumentation:
+    return _default_instrumentation
+
+
+def set_default_instrumentation(instrumentation: Optional[QueryInstrumentation]):
+    """Install the instrumentation used by every DAO that was not given one explicitly."""
+    global _default_instrumentation
+    _default_instrumentation = instrumentation or NoopInstrumentation()
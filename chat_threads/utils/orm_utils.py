@@ -1,6 +1,7 @@
 from datetime import datetime
+from typing import Callable, Collection, Optional
 from pytz import timezone
-from sqlalchemy import DateTime, Column
+from sqlalchemy import DateTime, Column, event
 from sqlalchemy.orm import declarative_mixin, Mapped, declarative_base
 
 from chat_threads.utils.constants import UTC_TIME_ZONE
@@ -18,3 +19,35 @@ class TimestampMixin:
 
 Base = declarative_base()
 
+
+
+def pending_until_commit(session, owner, key: str, factory: Callable[[], Collection],
+                         on_commit: Callable[[Collection], None]) -> Collection:
+    """
+    ``owner``'s changes waiting for the transaction of ``session`` (an ``AsyncSession``): the collection made by
+    ``factory`` is passed to ``on_commit`` once the transaction commits and emptied when it rolls back. State is
+    kept per ``owner``, so two owners sharing a session never apply each other's changes.
+    """
+    sync_session = session.sync_session
+    info_key = (key, id(owner))
+    pending = sync_session.info.get(info_key)
+    if pending is None:
+        pending = sync_session.info[info_key] = factory()
+
+        @event.listens_for(sync_session, "after_commit")
+        def _apply_committed(committed_session):
+            try:
+                on_commit(pending)
+            finally:
+                pending.clear()
+
+        @event.listens_for(sync_session, "after_rollback")
+        def _forget_rolled_back(rolled_back_session):
+            pending.clear()
+
+    return pending
+
+
+def peek_pending(session, owner, key: str) -> Optional[Collection]:
+    """What ``pending_until_commit`` holds for ``owner`` on ``session``, without registering anything."""
+    return session.sync_session.info.get((key, id(owner)))
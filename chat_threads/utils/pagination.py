@@ -0,0 +1,96 @@
+import base64
+import json
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from chat_threads.utils.constants import ThreadSortOrder
+from chat_threads.utils.exceptions import InvalidCursorError
+
+CURSOR_NEXT = "next"
+CURSOR_PREV = "prev"
+# Marks search cursors, whose key is a page of ranked results rather than a position in a listing
+SEARCH_CURSOR = "rank"
+
+
+def build_pagination(total_count: int, page: int, page_size: int) -> dict:
+    total_pages = (total_count + page_size - 1) // page_size if page_size > 0 else 1
+    return {
+        "total_count": total_count,
+        "total_pages": total_pages,
+        "current_page": page,
+        "page_size": page_size,
+        "has_next": page < total_pages,
+        "has_previous": page > 1,
+    }
+
+
+def encode_cursor(direction: str, keys: list, search: bool = False,
+                  sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT) -> str:
+    payload = {
+        "d": direction,
+        "s": SEARCH_CURSOR if search else False,
+        "o": ThreadSortOrder(sort_order).value,
+        "k": [key.isoformat() if isinstance(key, datetime) else key for key in keys],
+    }
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, search: bool = False, sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT) -> tuple:
+    """
+    Decode an opaque cursor into ``(direction, keys)``.
+    A cursor issued for a search listing is rejected for a plain listing and vice versa, and so is a cursor
+    issued for another ``sort_order``: its keys are positions in a different ordering.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        direction, keys = payload["d"], payload["k"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursorError() from e
+
+    if direction not in (CURSOR_NEXT, CURSOR_PREV) or payload.get("s", False) != (SEARCH_CURSOR if search else False):
+        raise InvalidCursorError()
+    if payload.get("o") != ThreadSortOrder(sort_order).value:
+        raise InvalidCursorError()
+
+    expected_keys = 1 if search else 2
+    if not isinstance(keys, list) or len(keys) != expected_keys:
+        raise InvalidCursorError()
+
+    try:
+        if search:
+            page = int(keys[0])
+            if page < 1:
+                raise InvalidCursorError()
+            return direction, [page]
+        return direction, [datetime.fromisoformat(keys[0]), int(keys[1])]
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError() from e
+
+
+async def search_with_cursor(search: Callable[[int, int], Awaitable[dict]], page_size: int,
+                             cursor: Optional[str] = None, include_total_count: bool = False,
+                             sort_order: ThreadSortOrder = ThreadSortOrder.CREATED_AT) -> dict:
+    """
+    The cursor API over a ranked search, ``search(page, page_size)`` returning ``threads`` and a
+    ``build_pagination`` dict. Ranks are only known once every match is scored, so the cursors carry a page
+    number instead of a key.
+    """
+    page = decode_cursor(cursor, search=True, sort_order=sort_order)[1][0] if cursor else 1
+    result = await search(page, page_size)
+    pagination = result["pagination"]
+    has_next, has_previous = pagination["has_next"], pagination["has_previous"]
+    return {
+        "threads": result["threads"],
+        "pagination": {
+            "page_size": page_size,
+            "next_cursor": encode_cursor(CURSOR_NEXT, [page + 1], search=True,
+                                         sort_order=sort_order) if has_next else None,
+            "prev_cursor": encode_cursor(CURSOR_PREV, [page - 1], search=True,
+                                         sort_order=sort_order) if has_previous else None,
+            "has_next": has_next,
+            "has_previous": has_previous,
+            "total_count": pagination["total_count"] if include_total_count else None,
+        },
+    }
@@ -0,0 +1,118 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+from sqlalchemy import text
+
+from chat_threads.utils.constants import REPLICA_LAG_PROBE_INTERVAL, REPLICA_MIN_PRIMARY_WINDOW
+from chat_threads.utils.orm_utils import peek_pending, pending_until_commit
+
+PENDING_WRITES_KEY = "chat_threads_pending_writes"
+
+
+class ReplicaLagProbe:
+    """Tells how far, in seconds, the replica behind a reader session is behind the primary."""
+
+    async def current_lag(self, reader_session) -> float:
+        raise NotImplementedError
+
+
+class StaticReplicaLag(ReplicaLagProbe):
+    """Fixed lag: for replicas with a known lag bound, and to simulate a lagging replica in tests."""
+
+    def __init__(self, lag: float):
+        self.lag = lag
+
+    async def current_lag(self, reader_session) -> float:
+        return self.lag
+
+
+class PostgresReplicaLagProbe(ReplicaLagProbe):
+    """
+    Reads the replay lag of a Postgres streaming replica and reuses it for ``probe_interval`` seconds.
+    On a primary, or a replica that has replayed everything, the lag is 0.
+    """
+
+    LAG_QUERY = text(
+        "SELECT CASE WHEN NOT pg_is_in_recovery() "
+        "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+    )
+
+    def __init__(self, probe_interval: float = REPLICA_LAG_PROBE_INTERVAL, clock: Callable[[], float] = time.monotonic):
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self._lag = 0.0
+        self._probed_at: Optional[float] = None
+
+    async def current_lag(self, reader_session) -> float:
+        now = self.clock()
+        if self._probed_at is None or now - self._probed_at >= self.probe_interval:
+            result = await reader_session.execute(self.LAG_QUERY)
+            self._lag = float(result.scalar() or 0)
+            self._probed_at = now
+        return self._lag
+
+
+class ReadYourWritesTracker:
+    """
+    Remembers when each key (a user or a thread) was last written and sends reads for that key to the
+    primary until the replica has had time to replay the write: the larger of the replica lag reported by
+    ``lag_probe`` and ``min_primary_window``. Writes are only remembered for ``max_window`` seconds, so while
+    the replica lags more than that every read goes to the primary.
+
+    Share one tracker per process. To keep the guarantee across processes, hand ``token(key)`` to the client
+    and ``restore(key, token)`` it on the next request.
+    """
+
+    def __init__(self, lag_probe: Optional[ReplicaLagProbe] = None,
+                 min_primary_window: float = REPLICA_MIN_PRIMARY_WINDOW, max_window: float = 60.0,
+                 clock: Callable[[], float] = time.time):
+        self.lag_probe = lag_probe or PostgresReplicaLagProbe()
+        self.min_primary_window = min_primary_window
+        self.max_window = max_window
+        self.clock = clock
+        self._last_writes: "OrderedDict[Hashable, float]" = OrderedDict()
+
+    def _prune(self, now: float):
+        while self._last_writes:
+            key, written_at = next(iter(self._last_writes.items()))
+            if now - written_at <= self.max_window:
+                break
+            del self._last_writes[key]
+
+    def record_write(self, *keys: Hashable):
+        now = self.clock()
+        for key in keys:
+            self._last_writes[key] = now
+            self._last_writes.move_to_end(key)
+        self._prune(now)
+
+    def record_write_on_commit(self, session, *keys: Hashable):
+        """``record_write`` once ``session`` commits: the window starts when the write is visible to replicas."""
+        pending_until_commit(session, self, PENDING_WRITES_KEY, set,
+                             lambda committed_keys: self.record_write(*committed_keys)).update(keys)
+
+    def written_in(self, session, *keys: Hashable) -> bool:
+        """Whether ``session`` wrote to any of ``keys`` in a transaction that has not committed yet."""
+        pending = peek_pending(session, self, PENDING_WRITES_KEY)
+        return bool(pending) and any(key in pending for key in keys)
+
+    def token(self, key: Hashable) -> Optional[float]:
+        return self._last_writes.get(key)
+
+    def restore(self, key: Hashable, token: Optional[float]):
+        if token is not None and token > self._last_writes.get(key, 0):
+            self._last_writes[key] = token
+            self._last_writes.move_to_end(key)
+
+    async def requires_primary(self, reader_session, *keys: Hashable) -> bool:
+        written_at = [self._last_writes[key] for key in keys if key in self._last_writes]
+        since_write = self.clock() - max(written_at) if written_at else None
+        if since_write is not None and since_write <= self.min_primary_window:
+            return True
+        lag = await self.lag_probe.current_lag(reader_session)
+        if lag > self.max_window:
+            # Older writes are forgotten, and a replica this far behind may be missing any of them
+            return True
+        return since_write is not None and since_write <= lag
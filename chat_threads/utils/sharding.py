@@ -0,0 +1,167 @@
+import asyncio
+import uuid
+import zlib
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, TypeVar
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from chat_threads.utils.cache import LRUCache
+from chat_threads.utils.constants import SHARD_LOCATION_CACHE_SIZE, SHARD_LOCATION_CACHE_TTL
+
+T = TypeVar("T")
+
+# First byte of thread uuids that carry their shard index in the second byte
+SHARD_UUID_MARKER = 0xA5
+MAX_SHARDS = 256
+
+
+class ShardMap:
+    """Decides which shard owns a tenant: the org for org threads, the user for personal ones."""
+
+    def __init__(self, shards: Sequence[str]):
+        if not shards or len(shards) > MAX_SHARDS:
+            raise ValueError(f"A shard map needs between 1 and {MAX_SHARDS} shards")
+        self.shards = list(shards)
+
+    def shard_for(self, org_id: Optional[str], user_email: Optional[str]) -> str:
+        raise NotImplementedError
+
+    def shard_index(self, shard: str) -> int:
+        return self.shards.index(shard)
+
+
+class HashShardMap(ShardMap):
+    """
+    Spreads tenants over ``shards`` by a stable hash of the org id (or user email for personal threads).
+    ``overrides`` pins tenants, e.g. the largest orgs, to a shard of their own; keys are ``"org:<org_id>"``
+    or ``"user:<user_email>"``. Changing the shard list moves tenants, so grow by pinning or migrating.
+    """
+
+    def __init__(self, shards: Sequence[str], overrides: Optional[Dict[str, str]] = None):
+        super().__init__(shards)
+        self.overrides = dict(overrides or {})
+        unknown = set(self.overrides.values()) - set(self.shards)
+        if unknown:
+            raise ValueError(f"Overrides point to unknown shards: {sorted(unknown)}")
+
+    @staticmethod
+    def tenant_key(org_id: Optional[str], user_email: Optional[str]) -> str:
+        if org_id:
+            return f"org:{org_id}"
+        if user_email:
+            return f"user:{user_email}"
+        raise ValueError("A thread needs an org_id or a user_email to be placed on a shard")
+
+    def shard_for(self, org_id: Optional[str], user_email: Optional[str]) -> str:
+        key = self.tenant_key(org_id, user_email)
+        pinned = self.overrides.get(key)
+        if pinned is not None:
+            return pinned
+        return self.shards[zlib.crc32(key.encode("utf-8")) % len(self.shards)]
+
+
+def encode_shard_uuid(shard_index: int) -> uuid.UUID:
+    """A random (version 4) uuid whose first two bytes record ``shard_index``."""
+    raw = bytearray(uuid.uuid4().bytes)
+    raw[0] = SHARD_UUID_MARKER
+    raw[1] = shard_index
+    return uuid.UUID(bytes=bytes(raw))
+
+
+def decode_shard_uuid(thread_uuid: uuid.UUID) -> Optional[int]:
+    """The shard index of a uuid made by ``encode_shard_uuid``; a guess for uuids made before sharding."""
+    raw = thread_uuid.bytes
+    return raw[1] if raw[0] == SHARD_UUID_MARKER else None
+
+
+class ShardDirectory:
+    """Optional uuid -> shard lookup, for threads whose uuid does not encode their shard (or that moved)."""
+
+    async def get(self, thread_uuid: uuid.UUID) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, thread_uuid: uuid.UUID, shard: str):
+        raise NotImplementedError
+
+
+class InMemoryShardDirectory(ShardDirectory):
+    """Dictionary backed directory, meant for tests and local runs."""
+
+    def __init__(self, locations: Optional[Dict[uuid.UUID, str]] = None):
+        self.locations = dict(locations or {})
+
+    async def get(self, thread_uuid: uuid.UUID) -> Optional[str]:
+        return self.locations.get(thread_uuid)
+
+    async def set(self, thread_uuid: uuid.UUID, shard: str):
+        self.locations[thread_uuid] = shard
+
+
+class ShardRouter:
+    """
+    Owns one session factory per shard and routes work to them.
+
+    Threads are placed by ``shard_map`` and get uuids that encode their shard, so looking one up needs no
+    directory. Threads created before sharding (or moved since) are found through ``directory`` and, failing
+    that, by asking every shard concurrently; the answer is remembered in an in-process cache.
+    """
+
+    def __init__(self, shard_map: ShardMap, session_factories: Dict[str, Callable[[], AsyncSession]],
+                 directory: Optional[ShardDirectory] = None):
+        missing = set(shard_map.shards) - set(session_factories)
+        if missing:
+            raise ValueError(f"No session factory for shards: {sorted(missing)}")
+        self.shard_map = shard_map
+        self.session_factories = session_factories
+        self.directory = directory
+        self.locations = LRUCache(max_size=SHARD_LOCATION_CACHE_SIZE, ttl=SHARD_LOCATION_CACHE_TTL)
+
+    @property
+    def shards(self) -> List[str]:
+        return self.shard_map.shards
+
+    def shard_for_owner(self, org_id: Optional[str], user_email: Optional[str]) -> str:
+        return self.shard_map.shard_for(org_id, user_email)
+
+    def new_thread_uuid(self, shard: str) -> uuid.UUID:
+        return encode_shard_uuid(self.shard_map.shard_index(shard))
+
+    def encoded_shard(self, thread_uuid: uuid.UUID) -> Optional[str]:
+        shard_index = decode_shard_uuid(thread_uuid)
+        if shard_index is None or shard_index >= len(self.shards):
+            return None
+        return self.shards[shard_index]
+
+    async def remember(self, thread_uuid: uuid.UUID, shard: str):
+        self.locations.set(thread_uuid, shard)
+        if self.directory is not None:
+            await self.directory.set(thread_uuid, shard)
+
+    async def candidate_shard(self, thread_uuid: uuid.UUID) -> Optional[str]:
+        """Where ``thread_uuid`` should be, without querying any shard; None when only a fan out can tell."""
+        shard = self.locations.get(thread_uuid)
+        if shard is None and self.directory is not None:
+            shard = await self.directory.get(thread_uuid)
+        return shard or self.encoded_shard(thread_uuid)
+
+    @asynccontextmanager
+    async def session(self, shard: str):
+        async with self.session_factories[shard]() as session:
+            yield session
+
+    async def run(self, shard: str, operation: Callable[[AsyncSession], Awaitable[T]]) -> T:
+        async with self.session(shard) as session:
+            return await operation(session)
+
+    async def fan_out(self, operation: Callable[[str, AsyncSession], Awaitable[T]],
+                      shards: Optional[Sequence[str]] = None) -> Dict[str, T]:
+        """Run ``operation(shard, session)`` on every shard (or ``shards``) concurrently, each in its own session."""
+        shards = list(shards or self.shards)
+
+        async def on_shard(shard: str):
+            async with self.session(shard) as session:
+                return await operation(shard, session)
+
+        results = await asyncio.gather(*(on_shard(shard) for shard in shards))
+        return dict(zip(shards, results))
@@ -9,6 +9,12 @@ setup(
         'pytz',
         'pydantic'
     ],
+    extras_require={
+        'prometheus': ['prometheus_client'],
+    },
+    entry_points={
+        'console_scripts': ['chat-threads-transfer=chat_threads.threads.transfer:main'],
+    },
     author='Mitanshu Bhatt',
     author_email='mitanshubhatt@gofynd.com',
     description='Common utilities for Fex projects',